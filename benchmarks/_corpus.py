@@ -0,0 +1,186 @@
+'''
+Generates a synthetic corpus of (unformatted) python modules for the benchmarks.
+
+The modules are generated from a seed (so, the same seed always generates the same
+corpus) and come in a few sizes:
+
+- small: a single function or class (~50 lines).
+- medium: some classes and functions (~700 lines).
+- large: a very large module (~24000 lines, ~1MB).
+- invalid: a medium module with a syntax error (the formatter can't format it).
+'''
+
+from __future__ import unicode_literals
+
+import collections
+import os
+import random
+
+# The number of top-level blocks (classes/functions/constants) of each size.
+SIZES = collections.OrderedDict([
+    ('small', 1),
+    ('medium', 15),
+    ('large', 500),
+    ('invalid', 15),
+])
+
+_NAMES = [
+    'value', 'items', 'result', 'data', 'key', 'count', 'index', 'node', 'path', 'name',
+    'config', 'options', 'buffer', 'entry', 'total', 'other', 'current', 'target',
+]
+
+_OPERATORS = ['+', '-', '*', '/', '%', '//', '**', '<<', '>>', '&', '|', '^']
+
+_COMPARISONS = ['<', '<=', '==', '!=', '>', '>=', 'is', 'is not', 'in', 'not in']
+
+
+def _spaces(rng):
+    # Irregular spacing (so that the formatter has something to do).
+    return rng.choice(['', ' ', '  '])
+
+
+def _name(rng):
+    return rng.choice(_NAMES)
+
+
+def _expression(rng, depth=0):
+    kind = rng.randint(0, 7 if depth < 2 else 2)
+    if kind == 0:
+        return _name(rng)
+    if kind == 1:
+        return '%s' % (rng.randint(0, 1000),)
+    if kind == 2:
+        return rng.choice(["'text'", '"other"', "u'unicode'", "b'bytes'", 'None', 'True'])
+    if kind == 3:
+        return '%s%s%s%s%s' % (
+            _expression(rng, depth + 1), _spaces(rng), rng.choice(_OPERATORS), _spaces(rng),
+            _expression(rng, depth + 1))
+    if kind == 4:
+        args = [_expression(rng, depth + 1) for _ in range(rng.randint(0, 3))]
+        if rng.random() < .3:
+            args.append('%s=%s' % (_name(rng), _expression(rng, depth + 1)))
+        return '%s.%s(%s)' % (_name(rng), _name(rng), (',' + _spaces(rng)).join(args))
+    if kind == 5:
+        return '[%s for %s in %s if %s]' % (
+            _expression(rng, depth + 1), _name(rng), _name(rng), _condition(rng, depth + 1))
+    if kind == 6:
+        return '{%s}' % (','.join(
+            "'%s':%s%s" % (_name(rng), _spaces(rng), _expression(rng, depth + 1))
+            for _ in range(rng.randint(0, 3))),)
+    return '(%s,%s)' % (_expression(rng, depth + 1), _expression(rng, depth + 1))
+
+
+def _condition(rng, depth=0):
+    return '%s %s %s' % (_expression(rng, depth + 1), rng.choice(_COMPARISONS),
+                         _expression(rng, depth + 1))
+
+
+def _body(rng, indent, statements, depth=0):
+    lines = []
+    for _ in range(statements):
+        kind = rng.randint(0, 7 if depth < 2 else 3)
+        if kind == 0:
+            lines.append('%s# %s %s' % (indent, _name(rng), _name(rng)))
+        elif kind in (1, 2):
+            lines.append('%s%s%s=%s%s' % (
+                indent, _name(rng), _spaces(rng), _spaces(rng), _expression(rng)))
+        elif kind == 3:
+            lines.append('%s%s' % (indent, _expression(rng)))
+        elif kind == 4:
+            lines.append('%sif %s:' % (indent, _condition(rng)))
+            lines.extend(_body(rng, indent + '    ', rng.randint(1, 3), depth + 1))
+            lines.append('%selse :' % (indent,))
+            lines.extend(_body(rng, indent + '    ', rng.randint(1, 2), depth + 1))
+        elif kind == 5:
+            lines.append('%sfor %s,%s in enumerate( %s ):' % (
+                indent, _name(rng), _name(rng), _name(rng)))
+            lines.extend(_body(rng, indent + '    ', rng.randint(1, 3), depth + 1))
+        elif kind == 6:
+            lines.append('%stry:' % (indent,))
+            lines.extend(_body(rng, indent + '    ', rng.randint(1, 2), depth + 1))
+            lines.append('%sexcept (KeyError,ValueError) as e:' % (indent,))
+            lines.extend(_body(rng, indent + '    ', 1, depth + 1))
+        else:
+            lines.append("%swith open(%s,'r') as stream:" % (indent, _name(rng)))
+            lines.extend(_body(rng, indent + '    ', rng.randint(1, 2), depth + 1))
+    lines.append('%sreturn %s' % (indent, _expression(rng)))
+    return lines
+
+
+def _function(rng, index, indent=''):
+    params = [_name(rng) for _ in range(rng.randint(0, 3))]
+    if indent:
+        params.insert(0, 'self')
+    if rng.random() < .3:
+        params.append('*args')
+    if rng.random() < .3:
+        params.append('**kwargs')
+    lines = ['%sdef function_%s(%s):' % (indent, index, (',' + _spaces(rng)).join(params))]
+    if rng.random() < .5:
+        lines.append("%s    '''Docstring of function_%s.'''" % (indent, index))
+    lines.extend(_body(rng, indent + '    ', rng.randint(2, 8)))
+    return lines
+
+
+def _class(rng, index):
+    lines = ['class Class%s( %s ):' % (index, rng.choice(['object', 'Base', 'dict']))]
+    lines.append('    attribute=%s' % (_expression(rng),))
+    for method in range(rng.randint(1, 4)):
+        lines.append('')
+        lines.extend(_function(rng, '%s_%s' % (index, method), '    '))
+    return lines
+
+
+def generate_module(size, seed=0):
+    '''
+    :param str size:
+        One of the SIZES.
+
+    :param int seed:
+        The seed used to generate the module.
+
+    :return bytes:
+        The contents of the module.
+    '''
+    rng = random.Random('%s-%s' % (size, seed))
+    lines = ['# -*- coding: utf-8 -*-', 'import os,sys', 'from collections import (OrderedDict,',
+             '    namedtuple)']
+    for index in range(SIZES[size]):
+        lines.append('')
+        lines.append('')
+        kind = rng.randint(0, 4)
+        if kind == 0:
+            lines.append('CONSTANT_%s=%s' % (index, _expression(rng)))
+        elif kind in (1, 2):
+            lines.extend(_function(rng, index))
+        else:
+            lines.extend(_class(rng, index))
+
+    if size == 'invalid':
+        # Unbalanced parenthesis in the middle of the module.
+        line = rng.randint(len(lines) // 3, 2 * len(lines) // 3)
+        lines.insert(line, 'broken = call(1, 2')
+    lines.append('')
+    return '\n'.join(lines).encode('utf-8')
+
+
+def generate_tree(root, files_per_size, seed=0):
+    '''
+    Creates a tree of modules (with files of all the sizes but 'large') in the given
+    directory (the files are spread in subpackages with 10 files each).
+
+    :return list(str):
+        The paths of the files created.
+    '''
+    paths = []
+    sizes = [size for size in SIZES if size != 'large']
+    for i in range(files_per_size):
+        for size in sizes:
+            package = os.path.join(root, 'package_%s' % (len(paths) // 10,))
+            if not os.path.isdir(package):
+                os.makedirs(package)
+            path = os.path.join(package, '%s_%s.py' % (size, i))
+            with open(path, 'wb') as stream:
+                stream.write(generate_module(size, seed + i))
+            paths.append(path)
+    return paths
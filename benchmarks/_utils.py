@@ -0,0 +1,78 @@
+'''
+Helpers shared by the benchmarks.
+'''
+
+from __future__ import unicode_literals
+
+import json
+import os.path
+import sys
+import time
+
+# Allow running the benchmarks from a checkout without installing pydevf.
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    timer = time.time
+
+
+def percentile(sorted_values, pct):
+    '''
+    :param list(float) sorted_values:
+        The values (already sorted).
+
+    :param float pct:
+        The percentile to get (0-100).
+    '''
+    if not sorted_values:
+        return None
+    index = int(round((len(sorted_values) - 1) * pct / 100.0))
+    return sorted_values[index]
+
+
+def summarize(latencies):
+    '''
+    :param list(float) latencies:
+        Latencies (in seconds).
+
+    :return dict:
+        The summary of the latencies (in milliseconds).
+    '''
+    values = sorted(latencies)
+
+    def ms(value):
+        return None if value is None else round(value * 1000.0, 4)
+
+    return {
+        'count': len(values),
+        'mean_ms': ms(sum(values) / len(values)) if values else None,
+        'p50_ms': ms(percentile(values, 50)),
+        'p99_ms': ms(percentile(values, 99)),
+        'min_ms': ms(values[0]) if values else None,
+        'max_ms': ms(values[-1]) if values else None,
+    }
+
+
+def report(results, as_json=False, stream=None):
+    '''
+    Prints the results of a benchmark (a list of dicts) either as json or as a table.
+    '''
+    if stream is None:
+        stream = sys.stdout
+    if as_json:
+        stream.write(json.dumps(results, indent=2, sort_keys=True))
+        stream.write('\n')
+        return
+
+    if not results:
+        return
+    columns = list(results[0].keys())
+    rows = [[str(result.get(column)) for column in columns] for result in results]
+    widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(columns)]
+    stream.write('  '.join(column.ljust(width) for column, width in zip(columns, widths)) + '\n')
+    for row in rows:
+        stream.write('  '.join(value.ljust(width) for value, width in zip(row, widths)) + '\n')
@@ -0,0 +1,69 @@
+'''
+Measures the cold start of the formatter: the time for format_code() (which always
+launches a new java process) to format a trivial snippet with different java options:
+
+- jvm-defaults: no options (and no AppCDS archive).
+- startup-profile: only the startup profile (C1 only/serial GC).
+- appcds: only the AppCDS archive.
+- profile+appcds: the default (startup profile and AppCDS archive).
+
+The result cache is disabled while measuring.
+
+Usage:
+
+    python benchmarks/bench_cold_start.py [--runs 10] [--json]
+'''
+
+from __future__ import unicode_literals
+
+import argparse
+import collections
+import os
+
+from _utils import report, summarize, timer
+
+from pydevf import _jvm
+from pydevf import _pydevf
+
+VARIANTS = collections.OrderedDict([
+    ('jvm-defaults', '-Xshare:auto'),
+    ('startup-profile', ' '.join(_jvm.STARTUP_OPTIONS + ['-Xshare:auto'])),
+    ('appcds', ''),
+    ('profile+appcds', None),
+])
+
+
+def _measure(java_opts, runs):
+    if java_opts is None:
+        os.environ.pop(_jvm.JAVA_OPTS_ENV_VAR, None)
+    else:
+        os.environ[_jvm.JAVA_OPTS_ENV_VAR] = java_opts
+    _pydevf._java_launch_info.clear()
+
+    # The first call may create the AppCDS archive (not measured).
+    assert _pydevf.format_code('a  =  1\n') == 'a = 1\n'
+    latencies = []
+    for _ in range(runs):
+        initial = timer()
+        _pydevf.format_code('a  =  1\n')
+        latencies.append(timer() - initial)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10, help='Runs for each variant.')
+    parser.add_argument('--json', action='store_true', help='Output results as json.')
+    args = parser.parse_args()
+
+    _pydevf._configure_result_cache(enabled=False)
+    results = []
+    for name, java_opts in VARIANTS.items():
+        result = collections.OrderedDict([('variant', name)])
+        result.update(sorted(summarize(_measure(java_opts, args.runs)).items()))
+        results.append(result)
+    report(results, as_json=args.json)
+
+
+if __name__ == '__main__':
+    main()
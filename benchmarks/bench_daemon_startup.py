@@ -0,0 +1,95 @@
+'''
+Measures how long concurrent cold invocations take to get their first result from the
+daemon (i.e.: many processes started at once when no daemon is running, as happens
+with pre-commit or parallel test workers).
+
+Each run stops the daemon and then starts the given number of client processes at
+the same time, each formatting a trivial snippet through the daemon. The time from
+the start of the run until each client got its result is measured (the python
+startup of the clients is included).
+
+Usage:
+
+    python benchmarks/bench_daemon_startup.py [--clients 64] [--runs 3] [--json]
+'''
+
+from __future__ import unicode_literals
+
+import argparse
+import collections
+import os
+import subprocess
+import sys
+import time
+
+from _utils import ROOT_DIR, report, summarize
+
+import pydevf
+
+_CLIENT_CODE = '''
+import sys, time
+from pydevf import format_code_using_daemon
+sys.stdout.write('ready\\n')
+sys.stdout.flush()
+sys.stdin.readline()
+assert format_code_using_daemon('a  =  1\\n') == 'a = 1\\n'
+sys.stdout.write('%r\\n' % (time.time(),))
+'''
+
+
+def _run(clients):
+    pydevf.exit_daemon()
+    time.sleep(1)
+
+    env = dict(os.environ, PYTHONPATH=ROOT_DIR, PYDEVF_CACHE='0')
+    processes = [
+        subprocess.Popen(
+            [sys.executable, '-c', _CLIENT_CODE],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+        for _ in range(clients)
+    ]
+    # Wait for all the clients to start (so that the python startup isn't measured).
+    for process in processes:
+        assert process.stdout.readline().strip() == b'ready'
+
+    initial = time.time()
+    for process in processes:
+        process.stdin.write(b'go\n')
+        process.stdin.flush()
+
+    latencies = []
+    failures = 0
+    for process in processes:
+        output = process.communicate()[0]
+        if process.returncode != 0:
+            failures += 1
+        else:
+            latencies.append(float(output.strip()) - initial)
+    return latencies, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=64, help='Concurrent clients.')
+    parser.add_argument('--runs', type=int, default=3, help='Number of runs.')
+    parser.add_argument('--json', action='store_true', help='Output results as json.')
+    args = parser.parse_args()
+
+    results = []
+    try:
+        for run in range(args.runs):
+            latencies, failures = _run(args.clients)
+            result = collections.OrderedDict([
+                ('run', run),
+                ('clients', args.clients),
+                ('failures', failures),
+            ])
+            result.update(sorted(summarize(latencies).items()))
+            results.append(result)
+    finally:
+        pydevf.exit_daemon()
+    report(results, as_json=args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+'''
+Microbenchmark of the framing used to talk to the daemon: compares the current
+_read/_write with the previous implementation (header lines and body written with
+separate writes/flushes under a global lock, sockets without TCP_NODELAY and bodies
+read with a plain read).
+
+The round-trip latency is measured against an echo server over a tcp socket in the
+loopback interface (with 1 client and with concurrent clients).
+
+Usage:
+
+    python benchmarks/bench_framing.py [--requests 1000] [--clients 4] [--json]
+'''
+
+from __future__ import unicode_literals
+
+import argparse
+import collections
+import socket
+import threading
+
+from _utils import report, summarize, timer
+
+from pydevf import _pydevf
+from pydevf._pydevf import _DaemonConnection
+
+PAYLOADS = collections.OrderedDict([
+    ('small', b'a = 1\n' * 20),
+    ('large', b'a = 1\n' * 100000),
+])
+
+_legacy_write_lock = threading.Lock()
+
+
+def _legacy_read(stream, decode=True):
+    headers = {}
+    while True:
+        line = stream.readline()
+        if not line:
+            return headers, None
+        if not _pydevf._parse_header_line(line, headers):
+            break
+    size = int(headers['Content-Length'])
+    body = stream.read(size)
+    if decode:
+        body = body.decode('utf-8')
+    return headers, body
+
+
+def _legacy_write(stream, msg, additional_headers=None):
+    with _legacy_write_lock:
+        if not isinstance(msg, bytes):
+            msg = msg.encode('utf-8')
+        stream.write(('Content-Length: %s\r\n' % (len(msg),)).encode('ascii'))
+        for name, val in additional_headers or ():
+            stream.write(('%s: %s\r\n' % (name, val)).encode('utf-8'))
+        stream.write(b'\r\n')
+        stream.flush()
+        stream.write(msg)
+        stream.flush()
+
+
+IMPLEMENTATIONS = collections.OrderedDict([
+    ('legacy', (_legacy_read, _legacy_write, False)),
+    ('current', (_pydevf._read, _pydevf._write, True)),
+])
+
+
+def _set_no_delay(sock, no_delay):
+    if no_delay:
+        _pydevf._set_no_delay(sock)
+
+
+def _start_echo_server(read, write, no_delay):
+    server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_sock.bind(('127.0.0.1', 0))
+    server_sock.listen(16)
+
+    def handle(sock):
+        _set_no_delay(sock, no_delay)
+        connection = _DaemonConnection(sock)
+        try:
+            while True:
+                _header, body = read(connection.read_from_stream, decode=False)
+                if body is None:
+                    return
+                write(connection.write_to_stream, body, [('Result', 'Ok')])
+        finally:
+            connection.close()
+
+    def accept():
+        while True:
+            try:
+                sock, _addr = server_sock.accept()
+            except socket.error:
+                return
+            t = threading.Thread(target=handle, args=(sock,))
+            t.daemon = True
+            t.start()
+
+    t = threading.Thread(target=accept)
+    t.daemon = True
+    t.start()
+    return server_sock
+
+
+def _run_client(port, read, write, no_delay, payload, requests, latencies):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    _set_no_delay(sock, no_delay)
+    sock.connect(('127.0.0.1', port))
+    connection = _DaemonConnection(sock)
+    try:
+        for _ in range(requests):
+            initial = timer()
+            write(connection.write_to_stream, payload, [('Operation', 'format')])
+            _header, body = read(connection.read_from_stream, decode=False)
+            latencies.append(timer() - initial)
+            assert len(body) == len(payload)
+    finally:
+        connection.close()
+
+
+def _measure(port, read, write, no_delay, payload, requests, clients):
+    latencies = []
+    threads = [
+        threading.Thread(
+            target=_run_client,
+            args=(port, read, write, no_delay, payload, requests, latencies))
+        for _ in range(clients)
+    ]
+    initial = timer()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, timer() - initial
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='Requests per client for the small payload (the large one uses 1/20).')
+    parser.add_argument('--clients', type=int, default=4,
+                        help='Number of concurrent clients in the concurrent run.')
+    parser.add_argument('--json', action='store_true', help='Output results as json.')
+    args = parser.parse_args()
+
+    results = []
+    for name, (read, write, no_delay) in IMPLEMENTATIONS.items():
+        server_sock = _start_echo_server(read, write, no_delay)
+        port = server_sock.getsockname()[1]
+        try:
+            for payload_name, payload in PAYLOADS.items():
+                requests = args.requests
+                if payload_name != 'small':
+                    requests = max(1, requests // 20)
+                for clients in sorted(set([1, args.clients])):
+                    # Warm up.
+                    _measure(port, read, write, no_delay, payload, 5, clients)
+                    latencies, elapsed = _measure(
+                        port, read, write, no_delay, payload, requests, clients)
+                    result = collections.OrderedDict([
+                        ('framing', name),
+                        ('payload', payload_name),
+                        ('clients', clients),
+                        ('requests_per_sec', round(len(latencies) / elapsed, 1)),
+                    ])
+                    result.update(sorted(summarize(latencies).items()))
+                    results.append(result)
+        finally:
+            server_sock.close()
+    report(results, as_json=args.json)
+
+
+if __name__ == '__main__':
+    main()
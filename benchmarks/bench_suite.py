@@ -0,0 +1,359 @@
+'''
+Benchmarks the execution modes of the formatter on a synthetic corpus (see: _corpus.py)
+with small, medium, large and invalid modules:
+
+- format_code: launches a new java process for each snippet.
+- server: format_code_server (one java process started for each thread).
+- daemon: format_code_using_daemon (the daemon is stopped before each measurement, so,
+  the cold latency includes launching it).
+- cli / cli-no-daemon: the command line formatting a generated tree in place (the
+  concurrency is given as --jobs).
+
+For each mode, size and concurrency level the results have:
+
+- cold_ms: the mean latency of the first request of each thread (including the time to
+  start the java process or the daemon -- for the command line it's the first run).
+- the warm latencies (p50/p99, etc) of the other requests (or command line runs).
+- files_per_sec: the throughput of the warm requests.
+- peak_kb: the peak memory allocated by python (tracemalloc) while formatting one
+  snippet in each thread (measured in a separate pass, so that tracemalloc doesn't
+  affect the latencies).
+
+The result cache is disabled while measuring. With --json (or --output) the results
+are written as json along with the versions used (to track regressions).
+
+Usage:
+
+    python benchmarks/bench_suite.py [--modes format_code,server,daemon,cli,cli-no-daemon]
+        [--sizes small,medium,large,invalid] [--concurrency 1,4] [--requests 20]
+        [--cli-files 20] [--cli-runs 3] [--seed 0] [--json] [--output results.json]
+'''
+
+from __future__ import unicode_literals
+
+import argparse
+import collections
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from _utils import ROOT_DIR, report, summarize, timer
+import _corpus
+
+import pydevf
+from pydevf import _pydevf
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+API_MODES = ['format_code', 'server', 'daemon']
+CLI_MODES = ['cli', 'cli-no-daemon']
+
+# Distinct modules generated for each size (the requests cycle through them).
+_MAX_DISTINCT_MODULES = 5
+
+# Runs the command line (optionally writing the peak memory traced by tracemalloc to
+# the file given as the first argument).
+_CLI_CODE = '''
+import sys
+memory_file = sys.argv.pop(1)
+if memory_file:
+    import atexit, tracemalloc
+    tracemalloc.start()
+
+    def write_peak():
+        with open(memory_file, 'w') as stream:
+            stream.write('%s' % (tracemalloc.get_traced_memory()[1],))
+
+    atexit.register(write_peak)
+from pydevf import main
+main(args=sys.argv[1:], prog_name='pydevf')
+'''
+
+
+def _create_formatters(mode, concurrency):
+    '''
+    :return tuple(list(callable), callable):
+        A function to format code for each thread and a function to release them.
+    '''
+    if mode == 'format_code':
+        return [pydevf.format_code] * concurrency, lambda: None
+
+    if mode == 'server':
+        processes = [pydevf.start_format_server() for _ in range(concurrency)]
+
+        def stop():
+            for process in processes:
+                pydevf.stop_format_server(process)
+
+        return [
+            lambda code, process=process: pydevf.format_code_server(process, code)
+            for process in processes], stop
+
+    if mode == 'daemon':
+        pydevf.exit_daemon()
+        time.sleep(1)
+        return [pydevf.format_code_using_daemon] * concurrency, lambda: None
+
+    raise ValueError('Unexpected mode: %s' % (mode,))
+
+
+def _run_threads(formatters, codes, initial_time):
+    '''
+    Formats the codes (distributed among the threads -- one for each formatter).
+
+    :param float initial_time:
+        The first request of each thread is measured from this time (so that starting
+        the formatter is included in it).
+
+    :return tuple(list(float), list(float), int, float):
+        The cold latencies, the warm latencies, the number of errors and the time
+        taken by the warm requests.
+    '''
+    lock = threading.Lock()
+    cold = []
+    warm = []
+    errors = [0]
+    warm_times = []
+
+    def run(format_func, thread_codes):
+        thread_warm = []
+        thread_errors = 0
+        for i, code in enumerate(thread_codes):
+            start = timer()
+            try:
+                format_func(code)
+            except Exception:
+                thread_errors += 1
+            end = timer()
+            if i == 0:
+                cold_latency = end - initial_time
+                warm_start = end
+            else:
+                thread_warm.append(end - start)
+        with lock:
+            cold.append(cold_latency)
+            warm.extend(thread_warm)
+            errors[0] += thread_errors
+            warm_times.append((warm_start, end))
+
+    threads = [
+        threading.Thread(target=run, args=(format_func, codes[i::len(formatters)]))
+        for i, format_func in enumerate(formatters)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = max(end for _start, end in warm_times) - min(start for start, _end in warm_times)
+    return cold, warm, errors[0], elapsed
+
+
+def _measure_peak_memory(formatters, code):
+    '''
+    :return int|NoneType:
+        The peak memory (in KB) allocated by python to format the code once in each
+        thread (or None if tracemalloc isn't available).
+    '''
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        threads = [
+            threading.Thread(target=_ignore_errors, args=(format_func, code))
+            for format_func in formatters]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        tracemalloc.stop()
+
+
+def _ignore_errors(format_func, code):
+    try:
+        format_func(code)
+    except Exception:
+        pass
+
+
+def _measure_api(mode, size, concurrency, requests, seed):
+    modules = [
+        _corpus.generate_module(size, seed + i)
+        for i in range(min(requests, _MAX_DISTINCT_MODULES))]
+    # Each thread does at least one warm request.
+    count = max(requests, concurrency * 2)
+    codes = [modules[i % len(modules)] for i in range(count)]
+
+    initial_time = timer()
+    formatters, stop = _create_formatters(mode, concurrency)
+    try:
+        cold, warm, errors, elapsed = _run_threads(formatters, codes, initial_time)
+        peak_kb = _measure_peak_memory(formatters, modules[0])
+    finally:
+        stop()
+
+    result = collections.OrderedDict([
+        ('mode', mode),
+        ('size', size),
+        ('concurrency', concurrency),
+        ('requests', len(codes)),
+        ('errors', errors),
+        ('cold_ms', round(sum(cold) / len(cold) * 1000.0, 4)),
+    ])
+    result.update(sorted(summarize(warm).items()))
+    result['files_per_sec'] = round(len(warm) / elapsed, 2) if elapsed else None
+    result['peak_kb'] = peak_kb
+    return result
+
+
+def _run_cli(args, memory_file=''):
+    env = dict(os.environ, PYDEVF_CACHE='0')
+    start = timer()
+    process = subprocess.Popen(
+        [sys.executable, '-c', _CLI_CODE, memory_file] + args,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        env=env,
+    )
+    process.communicate()
+    return timer() - start, process.returncode
+
+
+def _measure_cli(mode, concurrency, files_per_size, runs, seed):
+    tmpdir = tempfile.mkdtemp(prefix='pydevf-bench')
+    try:
+        tree = os.path.join(tmpdir, 'tree')
+        memory_file = os.path.join(tmpdir, 'memory.txt')
+        args = [tree, '--no-cache', '--jobs', '%s' % (concurrency,)]
+        if mode == 'cli-no-daemon':
+            args.append('--no-daemon')
+        else:
+            pydevf.exit_daemon()
+            time.sleep(1)
+
+        latencies = []
+        files = 0
+        failures = 0
+        # The first run is the cold one and the last one measures the memory.
+        for run in range(runs + 2):
+            shutil.rmtree(tree, ignore_errors=True)
+            files = len(_corpus.generate_tree(tree, files_per_size, seed))
+            if run == runs + 1:
+                _run_cli(args, memory_file)
+            else:
+                elapsed, exit_code = _run_cli(args)
+                latencies.append(elapsed)
+                # Note: the tree has invalid files, so, the exit code is expected to be 1.
+                if exit_code not in (0, 1):
+                    failures += 1
+
+        try:
+            with open(memory_file, 'r') as stream:
+                peak_kb = int(stream.read()) // 1024
+        except (IOError, OSError, ValueError):
+            peak_kb = None
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    cold, warm = latencies[0], latencies[1:]
+    result = collections.OrderedDict([
+        ('mode', mode),
+        ('size', 'tree'),
+        ('concurrency', concurrency),
+        ('requests', files),
+        ('errors', failures),
+        ('cold_ms', round(cold * 1000.0, 4)),
+    ])
+    result.update(sorted(summarize(warm).items()))
+    result['files_per_sec'] = round(files * len(warm) / sum(warm), 2) if warm else None
+    result['peak_kb'] = peak_kb
+    return result
+
+
+def _get_environment():
+    return collections.OrderedDict([
+        ('pydevf_version', pydevf.__version__),
+        ('python', platform.python_version()),
+        ('implementation', platform.python_implementation()),
+        ('platform', platform.platform()),
+        ('cpus', _pydevf._get_cpu_count()),
+        ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+    ])
+
+
+def _split(value):
+    return [x.strip() for x in value.split(',') if x.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--modes', default=','.join(API_MODES + CLI_MODES),
+                        help='Comma-separated modes to measure.')
+    parser.add_argument('--sizes', default=','.join(_corpus.SIZES),
+                        help='Comma-separated module sizes (for the api modes).')
+    parser.add_argument('--concurrency', default='1,4',
+                        help='Comma-separated numbers of concurrent threads (or jobs).')
+    parser.add_argument('--requests', type=int, default=20,
+                        help='Requests for each mode/size/concurrency (api modes).')
+    parser.add_argument('--cli-files', type=int, default=20,
+                        help='Files of each size (but large) in the tree for the cli modes.')
+    parser.add_argument('--cli-runs', type=int, default=3,
+                        help='Warm runs of the cli modes.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the corpus.')
+    parser.add_argument('--json', action='store_true', help='Output results as json.')
+    parser.add_argument('--output', default=None, help='Also write the json to this file.')
+    args = parser.parse_args()
+
+    modes = _split(args.modes)
+    for mode in modes:
+        if mode not in API_MODES + CLI_MODES:
+            parser.error('Unexpected mode: %s' % (mode,))
+    sizes = _split(args.sizes)
+    for size in sizes:
+        if size not in _corpus.SIZES:
+            parser.error('Unexpected size: %s' % (size,))
+    concurrency_levels = [int(x) for x in _split(args.concurrency)]
+
+    _pydevf._configure_result_cache(enabled=False)
+    # The daemon (and the command line) must be able to import pydevf from the checkout.
+    os.environ['PYTHONPATH'] = os.path.pathsep.join(
+        [ROOT_DIR] + [x for x in os.environ.get('PYTHONPATH', '').split(os.path.pathsep) if x])
+    results = []
+    try:
+        for mode in modes:
+            for concurrency in concurrency_levels:
+                if mode in CLI_MODES:
+                    results.append(_measure_cli(
+                        mode, concurrency, args.cli_files, args.cli_runs, args.seed))
+                    continue
+                for size in sizes:
+                    results.append(_measure_api(
+                        mode, size, concurrency, args.requests, args.seed))
+    finally:
+        if 'daemon' in modes or 'cli' in modes:
+            pydevf.exit_daemon()
+
+    document = collections.OrderedDict([
+        ('environment', _get_environment()),
+        ('results', results),
+    ])
+    if args.output:
+        with open(args.output, 'w') as stream:
+            report(document, as_json=True, stream=stream)
+    if args.json:
+        report(document, as_json=True)
+    else:
+        report(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+'''
+Compares the round-trip latency of the daemon protocol over a tcp socket (loopback)
+and over a unix socket for small and large payloads.
+
+An echo server using the same framing as the daemon is used (so, only the transport
+is measured, not the java formatter).
+
+Usage:
+
+    python benchmarks/bench_transport.py [--requests 2000] [--json]
+'''
+
+from __future__ import unicode_literals
+
+import argparse
+import collections
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+from _utils import report, summarize, timer
+
+from pydevf._pydevf import _DaemonConnection, _read, _write
+
+PAYLOADS = collections.OrderedDict([
+    ('small', b'a = 1\n' * 20),
+    ('large', b'a = 1\n' * 100000),
+])
+
+
+def _echo_client(sock):
+    connection = _DaemonConnection(sock)
+    try:
+        while True:
+            header, body = _read(connection.read_from_stream, decode=False)
+            if body is None:
+                return
+            _write(connection.write_to_stream, body, [('Result', 'Ok')])
+    finally:
+        connection.close()
+
+
+def _start_echo_server(server_sock):
+    server_sock.listen(5)
+
+    def accept():
+        while True:
+            try:
+                sock, _addr = server_sock.accept()
+            except socket.error:
+                return
+            t = threading.Thread(target=_echo_client, args=(sock,))
+            t.daemon = True
+            t.start()
+
+    t = threading.Thread(target=accept)
+    t.daemon = True
+    t.start()
+
+
+def _create_servers(tmpdir):
+    servers = collections.OrderedDict()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    servers['tcp'] = (sock, socket.AF_INET, sock.getsockname())
+
+    if hasattr(socket, 'AF_UNIX'):
+        path = os.path.join(tmpdir, 'bench.sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        servers['unix'] = (sock, socket.AF_UNIX, path)
+
+    for sock, _family, _address in servers.values():
+        _start_echo_server(sock)
+    return servers
+
+
+def _measure(family, address, payload, requests):
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(address)
+    connection = _DaemonConnection(sock)
+    latencies = []
+    try:
+        for _ in range(requests):
+            initial = timer()
+            _write(connection.write_to_stream, payload, [('Operation', 'format')])
+            _header, body = _read(connection.read_from_stream, decode=False)
+            latencies.append(timer() - initial)
+            assert body == payload
+    finally:
+        connection.close()
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='Requests for the small payload (the large one uses 1/20).')
+    parser.add_argument('--json', action='store_true', help='Output results as json.')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='pydevf-bench')
+    try:
+        servers = _create_servers(tmpdir)
+        results = []
+        for payload_name, payload in PAYLOADS.items():
+            requests = args.requests if payload_name == 'small' else max(1, args.requests // 20)
+            for transport, (_sock, family, address) in servers.items():
+                # Warm up (connection, thread start, buffers).
+                _measure(family, address, payload, 5)
+                result = collections.OrderedDict([
+                    ('transport', transport),
+                    ('payload', payload_name),
+                    ('payload_bytes', len(payload)),
+                ])
+                result.update(sorted(summarize(
+                    _measure(family, address, payload, requests)).items()))
+                results.append(result)
+        report(results, as_json=args.json)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,5 @@
+import sys
+
 from pydevf.version import __version__
 
 __author__ = """Fabio Zadrozny"""
@@ -14,8 +16,29 @@ from pydevf._pydevf import (
     
     start_daemon_server,
     format_code_using_daemon,
+    format_many_using_daemon,
+    get_daemon_stats,
+    enable_tracing,
+    dump_trace,
     exit_daemon,
 )
 
+_ASYNC_API = ('format_code_async', 'format_many_async')
+
+if sys.version_info[:2] >= (3, 7):
+
+    def __getattr__(name):
+        # The asyncio API is only imported when used (importing asyncio is slow).
+        if name in _ASYNC_API:
+            from pydevf import _pydevf_async
+            return getattr(_pydevf_async, name)
+        raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+elif sys.version_info[:2] >= (3, 6):
+    from pydevf._pydevf_async import (
+        format_code_async,
+        format_many_async,
+    )
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,325 @@
+'''
+On-disk cache for formatting results.
+
+Entries are keyed by the hash of the contents to be formatted (computed just like
+`git hash-object`) and are stored in a directory which identifies the formatter
+(so, a new formatter version never reuses results from a previous version).
+
+Each entry starts with a marker byte:
+
+'=' the contents are already formatted (nothing else is stored).
+'+' the formatted contents follow.
+'!' the contents can't be formatted (syntax error): the error message follows.
+
+When the total size of the cache goes over its maximum size, the entries which
+were least recently used are removed.
+
+The FileIndex keeps the stat of files which were formatted so that unchanged
+files may be skipped without even being read.
+'''
+
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import os.path
+import sys
+import tempfile
+import threading
+import time
+
+ALREADY_FORMATTED = b'='
+FORMATTED = b'+'
+SYNTAX_ERROR = b'!'
+
+DEFAULT_MAX_SIZE = 200 * 1024 * 1024
+
+# Even if the cache didn't grow much, check whether it must be trimmed from
+# time to time.
+_TRIM_CHECK_INTERVAL = 60 * 60
+
+
+def get_user_cache_dir():
+    '''
+    :return str:
+        The directory where pydevf should keep its cached data for the current user.
+    '''
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+        return os.path.join(base, 'pydevf', 'Cache')
+
+    if sys.platform == 'darwin':
+        return os.path.join(os.path.expanduser('~'), 'Library', 'Caches', 'pydevf')
+
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'pydevf')
+
+
+# Files modified this close to the time they're recorded aren't trusted: a
+# change done right afterwards could keep the same mtime (depending on the
+# filesystem mtime granularity).
+_RACY_INTERVAL_NS = 2 * 1000000000
+
+
+def compute_content_hash(contents):
+    '''
+    :param bytes contents:
+
+    :return str:
+        The hash of the contents (the same as the git blob id of the contents).
+    '''
+    h = hashlib.sha1(('blob %d\0' % (len(contents),)).encode('ascii'))
+    h.update(contents)
+    return h.hexdigest()
+
+
+def _makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+
+
+def replace_file(source, target):
+    if hasattr(os, 'replace'):
+        os.replace(source, target)
+    else:
+        if sys.platform == 'win32' and os.path.exists(target):
+            os.remove(target)
+        os.rename(source, target)
+
+
+class ResultCache(object):
+
+    def __init__(self, cache_dir, identity, max_size=DEFAULT_MAX_SIZE):
+        '''
+        :param str cache_dir:
+            The directory where the cache is kept.
+
+        :param str identity:
+            Identifies the formatter whose results are cached.
+
+        :param int max_size:
+            The maximum size (in bytes) of the cached entries.
+        '''
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._results_dir = os.path.join(cache_dir, 'results')
+        self._entries_dir = os.path.join(self._results_dir, identity)
+        self._trim_stamp = os.path.join(cache_dir, 'last-trim')
+        self._lock = threading.Lock()
+        self._written = 0
+        self._checked_trim_stamp = False
+
+    def _get_entry_path(self, content_hash):
+        return os.path.join(self._entries_dir, content_hash[:2], content_hash[2:])
+
+    def get(self, content_hash):
+        '''
+        :param str content_hash:
+            The hash of the contents to be formatted (see: compute_content_hash).
+
+        :return tuple(bytes,bytes)|NoneType:
+            None if the entry is not cached or a tuple(marker, data) where the
+            marker is one of ALREADY_FORMATTED, FORMATTED or SYNTAX_ERROR.
+        '''
+        path = self._get_entry_path(content_hash)
+        try:
+            with open(path, 'rb') as stream:
+                data = stream.read()
+        except (IOError, OSError):
+            return None
+
+        if not data:
+            return None
+        try:
+            # Keep the access time in the mtime (atime is not reliable) for the LRU.
+            os.utime(path, None)
+        except OSError:
+            pass
+        return data[:1], data[1:]
+
+    def put(self, content_hash, marker, data=b''):
+        '''
+        :param str content_hash:
+            The hash of the contents to be formatted (see: compute_content_hash).
+
+        :param bytes marker:
+            One of ALREADY_FORMATTED, FORMATTED or SYNTAX_ERROR.
+
+        :param bytes data:
+            The formatted contents (FORMATTED) or error message (SYNTAX_ERROR).
+        '''
+        path = self._get_entry_path(content_hash)
+        directory = os.path.dirname(path)
+        try:
+            _makedirs(directory)
+            handle, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+            try:
+                with os.fdopen(handle, 'wb') as stream:
+                    stream.write(marker)
+                    stream.write(data)
+                replace_file(tmp_path, path)
+            except Exception:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+        except (IOError, OSError):
+            # The cache is just an optimization: errors writing are ignored.
+            return
+
+        self._on_written(len(data) + 1)
+
+    def put_result(self, content_hash, contents, formatted):
+        if contents == formatted:
+            self.put(content_hash, ALREADY_FORMATTED)
+        else:
+            self.put(content_hash, FORMATTED, formatted)
+
+    def _on_written(self, size):
+        with self._lock:
+            self._written += size
+            must_trim = self._written > self.max_size // 10
+            if not must_trim and not self._checked_trim_stamp:
+                self._checked_trim_stamp = True
+                try:
+                    last_trim = os.path.getmtime(self._trim_stamp)
+                except OSError:
+                    last_trim = 0
+                must_trim = time.time() - last_trim > _TRIM_CHECK_INTERVAL
+
+            if must_trim:
+                self._written = 0
+
+        if must_trim:
+            self.trim()
+
+    def trim(self):
+        '''
+        Removes the least recently used entries if the cache is bigger than its maximum
+        size (it's removed until it has 80% of its maximum size).
+        '''
+        entries = []
+        total = 0
+        for root, _dirs, files in os.walk(self._results_dir):
+            for filename in files:
+                path = os.path.join(root, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        if total > self.max_size:
+            entries.sort()
+            target = self.max_size * 0.8
+            for _mtime, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+
+        try:
+            _makedirs(self.cache_dir)
+            with open(self._trim_stamp, 'wb'):
+                pass
+        except (IOError, OSError):
+            pass
+
+
+def get_stat_key(st):
+    '''
+    :return list(int):
+        The (size, mtime_ns, inode) of the given stat result.
+    '''
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return [st.st_size, mtime_ns, st.st_ino]
+
+
+class FileIndex(object):
+    '''
+    Keeps the stat (size, mtime, inode) and the content hash of files which were
+    formatted so that files whose stat didn't change can be skipped without being read.
+    '''
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self._entries = {}
+        self._changed = False
+
+    def load(self):
+        try:
+            with open(self.index_path, 'rb') as stream:
+                entries = json.loads(stream.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            entries = {}
+        if isinstance(entries, dict):
+            self._entries = entries
+        return self
+
+    def is_unchanged(self, path):
+        '''
+        :return bool:
+            True if the file is known to be formatted and its stat didn't change since.
+        '''
+        entry = self._entries.get(os.path.abspath(path))
+        if entry is None:
+            return False
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return get_stat_key(st) == entry[:3]
+
+    def get_content_hash(self, path):
+        entry = self._entries.get(os.path.abspath(path))
+        if entry is None:
+            return None
+        return entry[3]
+
+    def record(self, path, st, content_hash):
+        '''
+        Records that the file with the given stat has the given (formatted) contents.
+        '''
+        key = get_stat_key(st)
+        if time.time() * 1000000000 - key[1] < _RACY_INTERVAL_NS:
+            # Racily clean: can't be trusted (it'll be recorded in a later run).
+            self.discard(path)
+            return
+        self._entries[os.path.abspath(path)] = key + [content_hash]
+        self._changed = True
+
+    def discard(self, path):
+        if self._entries.pop(os.path.abspath(path), None) is not None:
+            self._changed = True
+
+    def save(self):
+        if not self._changed:
+            return
+        directory = os.path.dirname(self.index_path)
+        try:
+            _makedirs(directory)
+            handle, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+            try:
+                with os.fdopen(handle, 'wb') as stream:
+                    stream.write(json.dumps(self._entries).encode('utf-8'))
+                replace_file(tmp_path, self.index_path)
+            except Exception:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+        except (IOError, OSError):
+            # The index is just an optimization: errors writing are ignored.
+            return
+        self._changed = False
@@ -0,0 +1,679 @@
+'''
+The command line interface (kept apart so that click is only imported when the
+command line is actually used and not when pydevf is imported as a library).
+'''
+
+from __future__ import unicode_literals
+
+import os.path
+import sys
+from functools import partial
+
+import click
+
+from . import _tracing
+from ._pydevf import (
+    _DEFAULT_WARMUP_ROUNDS,
+    _TIMEOUT_ENV_VAR,
+    _FileWriter,
+    _FormatFileNotAllowed,
+    _WorkerPool,
+    _configure_result_cache,
+    _format_file_using_daemon,
+    _format_using_cache,
+    _get_cpu_count,
+    _get_result_cache,
+    _get_timeout,
+    _get_unified_diff,
+    _imap_ordered,
+    _is_formatted_using_cache,
+    _is_formatted_using_daemon,
+    _load_file_index,
+    dump_trace,
+    enable_tracing,
+    exit_daemon,
+    format_code_using_daemon,
+    get_daemon_stats,
+    start_daemon_server,
+)
+from .version import __version__
+
+click.disable_unicode_literals_warning = True
+
+
+def _list_git_files(sources, git_mode, since, include_file, exclude_directory):
+    '''
+    :param str git_mode:
+        One of 'changed', 'since', 'staged' or 'tracked'.
+
+    :return list(tuple(str,str|NoneType)):
+        The files listed by git (see: _git) which are one of the sources (or inside
+        one of them) and match the include/exclude patterns along with the id of their
+        blob in the index (only available for staged files).
+    '''
+    from . import _git
+
+    listed = {}
+    found = set()
+    selected = []
+    for source in sources:
+        source = os.path.realpath(source)
+        directory = source if os.path.isdir(source) else os.path.dirname(source)
+        root = _git.get_repository_root(directory)
+        files = listed.get(root)
+        if files is None:
+            if git_mode == 'staged':
+                files = _git.list_staged_files(root)
+            elif git_mode == 'tracked':
+                files = [(path, None) for path in _git.list_tracked_files(root)]
+            else:
+                files = [(path, None) for path in _git.list_changed_files(
+                    root, since or 'HEAD', merge_base=since is not None)]
+
+            # Note: the exclude patterns are matched against the directories inside
+            # the repository.
+            included = []
+            for path, blob_id in files:
+                parts = path.split('/')
+                if not include_file(parts[-1]):
+                    continue
+                if any(exclude_directory(part) for part in parts[:-1]):
+                    continue
+                included.append((os.path.join(root, *parts), blob_id))
+            files = listed[root] = included
+
+        prefix = source if source.endswith(os.sep) else source + os.sep
+        for path, blob_id in files:
+            if path in found or not (path == source or path.startswith(prefix)):
+                continue
+            if not os.path.isfile(path):
+                continue  # i.e.: deleted (but not staged) or a submodule.
+            found.add(path)
+            selected.append((_get_display_path(path), blob_id))
+    return selected
+
+
+def _get_display_path(path):
+    '''
+    :return str:
+        The path relative to the current dir (if possible).
+    '''
+    try:
+        relative = os.path.relpath(path)
+    except ValueError:
+        return path  # i.e.: on another drive.
+    return path if relative.startswith(os.pardir) else relative
+
+
+def _skip_formatted_blobs(format_files, blob_ids):
+    '''
+    :param dict(str,str) blob_ids:
+        The id of the blob in the git index of the files whose contents in the working
+        tree are the ones in the index.
+
+    :return list(str):
+        The files without the ones which the result cache knows are already formatted
+        (the blob id is the same hash used as the key of the cache, so, those files
+        aren't even read).
+    '''
+    from . import _cache
+    cache = _get_result_cache()
+    if cache is None:
+        return format_files
+
+    remaining = []
+    for entry in format_files:
+        blob_id = blob_ids.get(entry)
+        if blob_id is not None:
+            cached = cache.get(blob_id)
+            if cached is not None and cached[0] == _cache.ALREADY_FORMATTED:
+                continue
+        remaining.append(entry)
+    return remaining
+
+
+@click.command(context_settings=dict(help_option_names=['-h', '--help']))
+@click.option(
+    '--include',
+    type=str,
+    default='*.py, *.pyw',
+    help='fnmatch-style files to include (comma separated).',
+    show_default=True,
+)
+@click.option(
+    '--exclude-dirs',
+    type=str,
+    default='*.git, *.hg, *.svn',
+    help='fnmatch-style dirs to exclude (comma separated).',
+    show_default=True,
+)
+@click.option(
+    '--no-daemon',
+    help='Do not automatically start a daemon service to be used among multiple processes.',
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    '--start-daemon',
+    help='Starts daemon service to be used among multiple processes.',
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    '--workers',
+    type=int,
+    default=None,
+    help='Maximum number of formatter processes used by the daemon started with '
+    '--start-daemon (defaults to the number of cpus).',
+)
+@click.option(
+    '--warmup',
+    type=int,
+    default=None,
+    help='Number of times that each formatter process of a daemon started by this '
+    'invocation formats the warm-up corpus while idle (defaults to the PYDEVF_WARMUP '
+    'environment variable or %s; 0 disables it).' % (_DEFAULT_WARMUP_ROUNDS,),
+)
+@click.option(
+    '--idle-timeout',
+    type=float,
+    default=None,
+    help='Minutes without requests after which a daemon started by this invocation exits '
+    '(defaults to the PYDEVF_IDLE_TIMEOUT environment variable; 0 means never).',
+)
+@click.option(
+    '--max-requests',
+    type=int,
+    default=None,
+    help='Number of requests after which a formatter process of a daemon started by this '
+    'invocation is recycled (defaults to the PYDEVF_MAX_REQUESTS environment variable; 0 '
+    'means no limit).',
+)
+@click.option(
+    '--max-rss',
+    type=int,
+    default=None,
+    help='RSS (in MB) over which a formatter process of a daemon started by this '
+    'invocation is recycled (defaults to the PYDEVF_MAX_RSS environment variable; 0 '
+    'means no limit).',
+)
+@click.option(
+    '--timeout',
+    type=float,
+    default=None,
+    help='Maximum number of seconds to format each file (a formatter process which takes '
+    'longer is killed and replaced). Also the default for a daemon started by this '
+    'invocation (defaults to the PYDEVF_TIMEOUT environment variable; 0 means no timeout).',
+)
+@click.option(
+    '--daemon-stats',
+    '--stats',
+    'stats',
+    help='Shows information on the running daemon such as the number of requests, '
+    'latency histograms and its formatter processes.',
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    '--stats-format',
+    type=click.Choice(['json', 'openmetrics']),
+    default='json',
+    help='The format used by --daemon-stats.',
+    show_default=True,
+)
+@click.option(
+    '--trace',
+    type=click.Path(file_okay=True, dir_okay=False, writable=True),
+    default=None,
+    help='Record the time spent on each step of the requests (including the ones done '
+    'in the daemon) and write it to the given file in the Chrome trace format (may be '
+    'viewed in chrome://tracing or https://ui.perfetto.dev).',
+)
+@click.option(
+    '--stop-daemon',
+    help='Stops a daemon service previously started in another process.',
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    '--no-cache',
+    help='Do not use the cache of formatting results.',
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    '--cache-dir',
+    type=click.Path(file_okay=False, dir_okay=True),
+    default=None,
+    help='Directory for the cache of formatting results (defaults to the PYDEVF_CACHE_DIR '
+    'environment variable or to the user cache dir).',
+)
+@click.option(
+    '--incremental',
+    help='Skip files whose size, mtime and inode did not change since they were last '
+    'formatted (without reading them).',
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    '--git-changed',
+    help='Only format the files changed (staged, unstaged or untracked) compared to HEAD '
+    'in the git repository of the sources (the current dir if no source is given).',
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    '--since',
+    metavar='REV',
+    default=None,
+    help='Only format the files changed since the merge-base of REV and HEAD in the git '
+    'repository of the sources (i.e.: the files changed in a branch, including the ones '
+    'not committed yet).',
+)
+@click.option(
+    '--staged',
+    help='Only format the files staged in the git repository of the sources (files '
+    'already formatted are skipped based on the id of their blob in the index).',
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    '--git-tracked',
+    help='Only format the files tracked in the git repository of the sources (instead '
+    'of walking the directories).',
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    '--check',
+    help='Don\'t write the files back: just list the files which would be changed '
+    '(exit code is 1 if some file would be changed).',
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    '--diff',
+    help='Don\'t write the files back: just show a unified diff with the changes for '
+    'each file.',
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    '--java-opts',
+    type=str,
+    default=None,
+    help='Options for the java formatter processes started by this invocation (used '
+    'instead of the default startup profile -- may also be set through the '
+    'PYDEVF_JAVA_OPTS environment variable).',
+)
+@click.option(
+    '--fsync',
+    help='Make sure that the changed files are flushed to disk before replacing the '
+    'original files (done in batches).',
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    '-j',
+    '--jobs',
+    type=int,
+    default=1,
+    help='Number of files formatted in parallel (0 means the number of cpus).',
+    show_default=True,
+)
+@click.option(
+    '-v',
+    '--verbose',
+    is_flag=True,
+    help='Enable verbose mode.',
+)
+@click.version_option(version=__version__)
+@click.argument(
+    'source',
+    nargs=-1,
+    type=click.Path(
+        exists=True, file_okay=True, dir_okay=True, readable=True, allow_dash=True
+    ),
+    is_eager=True,
+)
+@click.pass_context
+def main(
+        ctx, include='*.py', exclude_dirs=None, verbose=False, source=None, no_daemon=False,
+        start_daemon=False, stop_daemon=False, workers=None, jobs=1, no_cache=False,
+        cache_dir=None, incremental=False, fsync=False, check=False, diff=False,
+        java_opts=None, warmup=None, stats=False, idle_timeout=None, max_requests=None,
+        max_rss=None, timeout=None, stats_format='json', trace=None, git_changed=False,
+        since=None, staged=False, git_tracked=False):
+    import fnmatch
+
+    out = partial(click.secho, bold=True, err=True)
+    err = partial(click.secho, fg='red', err=True)
+
+    include = include.strip()
+    if include:
+        include = [x.strip() for x in include.split(',')]
+
+    exclude_dirs = exclude_dirs.strip()
+    if exclude_dirs:
+        exclude_dirs = [x.strip() for x in exclude_dirs.split(',')]
+
+    def include_file(filename):
+        if not include:
+            return True
+        for pat in include:
+            if fnmatch.fnmatch(filename, pat):
+                return True
+        return False
+
+    def exclude_directory(filename):
+        if not exclude_dirs:
+            return False
+        for pat in exclude_dirs:
+            if fnmatch.fnmatch(filename, pat):
+                return True
+        return False
+
+    if java_opts is not None:
+        # Note: also used by a daemon started by this process.
+        from . import _jvm
+        os.environ[_jvm.JAVA_OPTS_ENV_VAR] = java_opts
+
+    if warmup is not None:
+        # Note: also used by a daemon started by this process.
+        os.environ['PYDEVF_WARMUP'] = str(warmup)
+
+    for env_var, value in (
+            ('PYDEVF_IDLE_TIMEOUT', idle_timeout),
+            ('PYDEVF_MAX_REQUESTS', max_requests),
+            ('PYDEVF_MAX_RSS', max_rss),
+            (_TIMEOUT_ENV_VAR, timeout)):
+        if value is not None:
+            # Note: also used by a daemon started by this process.
+            os.environ[env_var] = str(value)
+
+    if trace:
+        # Note: also used by a daemon started by this process.
+        os.environ[_tracing.TRACE_ENV_VAR] = '1'
+        _tracing.set_process_name('pydevf')
+        enable_tracing(include_daemon=not no_daemon)
+        # Note: called even if the command exits through ctx.exit.
+        ctx.call_on_close(partial(dump_trace, trace, include_daemon=not no_daemon))
+
+    if start_daemon:
+        start_daemon_server(workers=workers)
+        ctx.exit(0)
+
+    if stop_daemon:
+        exit_daemon()
+        out('Daemon process stopped.')
+        ctx.exit(0)
+
+    if stats:
+        import json
+        openmetrics = stats_format == 'openmetrics'
+        daemon_stats = get_daemon_stats(openmetrics)
+        if daemon_stats is None:
+            out('Daemon process not running.')
+            ctx.exit(1)
+        if openmetrics:
+            click.echo(daemon_stats, nl=False)
+        else:
+            click.echo(json.dumps(daemon_stats, indent=2, sort_keys=True))
+        ctx.exit(0)
+
+    git_modes = [mode for mode, selected in (
+        ('changed', git_changed), ('since', since is not None), ('staged', staged),
+        ('tracked', git_tracked)) if selected]
+    if len(git_modes) > 1:
+        raise click.UsageError(
+            'Only one of --git-changed, --since, --staged and --git-tracked may be used.')
+    git_mode = git_modes[0] if git_modes else None
+    if git_mode is not None:
+        if '-' in source:
+            raise click.UsageError('Files selected through git can\'t be read from stdin.')
+        if not source:
+            source = ('.',)
+
+    if not source:
+        out('No files to format. Nothing to do.')
+        ctx.exit(0)
+
+    def on_finish():
+        pass
+
+    if jobs <= 0:
+        jobs = _get_cpu_count()
+
+    if no_cache:
+        _configure_result_cache(enabled=False)
+    elif cache_dir:
+        _configure_result_cache(enabled=True, cache_dir=cache_dir)
+
+    try:
+        if no_daemon:
+            # Note: the pool only starts new processes on demand (up to the number of jobs),
+            # so, no process is started if there's nothing to format.
+            pool = _WorkerPool(jobs, short_lived=True, timeout=_get_timeout())
+
+            def do_format(code_to_format):
+                return _format_using_cache(pool.format_code, code_to_format)
+
+            def is_formatted(code):
+                return pool.format_code(code) == code
+
+            def do_is_formatted(code_to_format):
+                return _is_formatted_using_cache(is_formatted, code_to_format)
+
+            def on_finish():
+                pool.stop()
+
+        else:
+            do_format = format_code_using_daemon
+
+            def do_is_formatted(code_to_format):
+                return _is_formatted_using_cache(_is_formatted_using_daemon, code_to_format)
+
+        if source == ('-',):
+            if sys.version_info[0] > 2:
+                read_from = sys.stdin.buffer
+                write_to = sys.stdout.buffer
+            else:
+                if sys.platform == "win32":
+                    # must read streams as binary on windows
+                    import msvcrt
+                    msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
+                    msvcrt.setmode(sys.stdin.fileno(), os.O_BINARY)
+
+                read_from = sys.stdin
+                write_to = sys.stdout
+
+            contents_as_bytes = read_from.read()
+            try:
+                if check and not diff:
+                    output = None
+                    changed = not do_is_formatted(contents_as_bytes)
+                else:
+                    output = do_format(contents_as_bytes)
+                    changed = output != contents_as_bytes
+            except Exception as e:
+                err('Error formatting contents: %s' % (str(e)))
+                ctx.exit(1)
+            else:
+                if check or diff:
+                    if diff and changed:
+                        write_to.write(
+                            _get_unified_diff('-', contents_as_bytes, output).encode('utf-8'))
+                        write_to.flush()
+                    if check and changed:
+                        out('Would reformat: -')
+                        ctx.exit(1)
+                else:
+                    write_to.write(output)
+                    write_to.flush()
+            ctx.exit(0)
+
+        else:
+            format_files = []
+            blob_ids = {}
+            if git_mode is not None:
+                from . import _git
+                try:
+                    git_files = _list_git_files(
+                        source, git_mode, since, include_file, exclude_directory)
+                except _git.GitError as e:
+                    err('%s' % (e,))
+                    ctx.exit(1)
+                for entry, blob_id in git_files:
+                    format_files.append(entry)
+                    if blob_id is not None:
+                        blob_ids[entry] = blob_id
+            else:
+                for entry in source:
+                    if os.path.isfile(entry):
+                        format_files.append(entry)
+                    else:
+                        for root, dirs, files in os.walk(entry):
+                            for filename in files:
+                                if include_file(os.path.basename(filename)):
+                                    format_files.append(os.path.join(root, filename))
+
+                            new_dirs = []
+                            for directory in dirs:
+                                if not exclude_directory(os.path.basename(directory)):
+                                    new_dirs.append(directory)
+                            dirs[:] = new_dirs[:]
+
+            # The same file may be reached through symlinks: format it only once.
+            found = set()
+            unique_files = []
+            for entry in format_files:
+                key = os.path.realpath(entry) if os.path.islink(entry) else os.path.abspath(entry)
+                if key not in found:
+                    found.add(key)
+                    unique_files.append(entry)
+            format_files = unique_files
+
+            all_files = format_files
+            if blob_ids:
+                format_files = _skip_formatted_blobs(format_files, blob_ids)
+                if verbose:
+                    out('Skipped %s files already formatted (based on their git blob id).' % (
+                        len(all_files) - len(format_files),))
+
+            file_index = None
+            if incremental:
+                from . import _cache
+                file_index = _load_file_index(cache_dir)
+                changed_files = [
+                    entry for entry in format_files if not file_index.is_unchanged(entry)]
+                if verbose:
+                    out('Skipped %s unchanged files.' % (len(format_files) - len(changed_files),))
+                format_files = changed_files
+
+            # Note: with --check or --diff files are never opened for writing.
+            write_files = not (check or diff)
+            file_writer = _FileWriter(fsync=fsync)
+
+            # In daemon mode the daemon reads and rewrites the files itself.
+            format_in_daemon = [write_files and not no_daemon]
+
+            def format_entry(entry):
+                if format_in_daemon[0]:
+                    try:
+                        changed, content_hash = _format_file_using_daemon(entry, fsync=fsync)
+                    except UnicodeEncodeError:
+                        pass  # Path can't be sent to the daemon: send the contents.
+                    except _FormatFileNotAllowed:
+                        # i.e.: connected through tcp or the daemon uses another cache:
+                        # send the contents of all the files.
+                        format_in_daemon[0] = False
+                    else:
+                        if file_index is not None:
+                            return changed, (os.stat(entry), content_hash), None
+                        return changed, None, None
+
+                with _tracing.span('file_read'), open(entry, 'rb') as stream:
+                    contents = stream.read()
+
+                diff_text = None
+                if check and not diff:
+                    # The formatted contents aren't needed (just whether it'd change).
+                    changed = not do_is_formatted(contents)
+                    new_contents = contents
+                else:
+                    new_contents = do_format(contents)
+                    changed = new_contents != contents
+
+                if changed:
+                    if diff:
+                        diff_text = _get_unified_diff(entry, contents, new_contents)
+
+                    # Note: unchanged files aren't rewritten (so, their mtime is kept).
+                    if not write_files or not file_writer.write(entry, new_contents):
+                        # Not written now: can't be recorded in the index.
+                        return changed, None, diff_text
+
+                if file_index is not None:
+                    index_info = (os.stat(entry), _cache.compute_content_hash(new_contents))
+                    return changed, index_info, diff_text
+                return changed, None, diff_text
+
+            def format_file(entry):
+                if _tracing.enabled:
+                    # All the spans related to the file have the same request id.
+                    with _tracing.request_context(_tracing.new_request_id()), \
+                            _tracing.span('format_file', entry):
+                        return format_entry(entry)
+                return format_entry(entry)
+
+            try:
+                exit_code = 0
+                changed_count = 0
+                total = len(format_files)
+                # Note: files are formatted in parallel but reported in order.
+                for i, (entry, result, exception) in enumerate(
+                        _imap_ordered(format_file, format_files, jobs)):
+                    if verbose:
+                        out('Formatted file: %s (%s of %s)' % (entry, i + 1, total))
+                    if exception is not None:
+                        err('Error formatting %s: %s' % (entry, exception))
+                        exit_code = 1
+                        if file_index is not None:
+                            file_index.discard(entry)
+                        continue
+
+                    changed, index_info, diff_text = result
+                    if changed:
+                        changed_count += 1
+                        if diff_text:
+                            click.echo(diff_text, nl=False)
+                        if check:
+                            out('Would reformat: %s' % (entry,))
+                            exit_code = 1
+
+                    if file_index is not None:
+                        if index_info is not None:
+                            file_index.record(entry, *index_info)
+                        else:
+                            file_index.discard(entry)
+
+                try:
+                    file_writer.flush()
+                except Exception as e:
+                    err('Error writing files: %s' % (e,))
+                    exit_code = 1
+            finally:
+                # Removes the temporary files which weren't renamed if it was aborted.
+                file_writer.discard()
+
+            if file_index is not None:
+                file_index.save()
+
+            if write_files:
+                out('%s of %s files changed.' % (changed_count, len(all_files)))
+            else:
+                out('%s of %s files would be changed.' % (changed_count, len(all_files)))
+            ctx.exit(exit_code)
+
+    finally:
+        on_finish()
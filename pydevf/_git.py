@@ -0,0 +1,140 @@
+'''
+Lists the files of a git repository which should be formatted (so that the command line
+doesn't need to walk the whole tree when only a few files changed):
+
+- changed: files changed since a revision (or since the merge-base of the revision and
+  HEAD if merge_base is True), including uncommitted and untracked files.
+- staged: files staged in the index (along with the id of their blob in the index).
+- tracked: all the files tracked by git.
+
+Deleted files are never listed.
+'''
+
+from __future__ import unicode_literals
+
+import os.path
+import subprocess
+import sys
+
+
+class GitError(RuntimeError):
+    '''
+    Raised when git can't be executed or fails (i.e.: not in a git repository).
+    '''
+
+
+def _decode_path(path):
+    if sys.version_info[0] < 3:
+        return path
+    return os.fsdecode(path)
+
+
+def _run_git(directory, args):
+    '''
+    :return bytes:
+        The output of the git command executed in the given directory.
+    '''
+    try:
+        process = subprocess.Popen(
+            ['git'] + args,
+            cwd=directory,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    except OSError as e:
+        raise GitError('Unable to execute git: %s' % (e,))
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        raise GitError('git %s failed: %s' % (
+            ' '.join(args), stderr.decode('utf-8', errors='replace').strip()))
+    return stdout
+
+
+def _split_paths(output):
+    return [_decode_path(path) for path in output.split(b'\0') if path]
+
+
+def get_repository_root(directory):
+    '''
+    :return str:
+        The root of the working tree of the git repository containing the directory.
+    '''
+    output = _run_git(directory, ['rev-parse', '--show-toplevel'])
+    return os.path.normpath(_decode_path(output.strip()))
+
+
+def _has_head(root):
+    try:
+        _run_git(root, ['rev-parse', '--verify', '--quiet', 'HEAD'])
+    except GitError:
+        return False
+    return True
+
+
+def list_changed_files(root, revision='HEAD', merge_base=False):
+    '''
+    :param str revision:
+        The files changed compared to this revision are listed.
+
+    :param bool merge_base:
+        If True, the files are compared with the merge-base of the revision and HEAD
+        (i.e.: the files changed in a branch compared with its target branch).
+
+    :return list(str):
+        The paths (relative to the root) of the files which were changed (committed or
+        not) plus the untracked files (which aren't ignored).
+    '''
+    if merge_base:
+        revision = _run_git(root, ['merge-base', revision, 'HEAD']).strip().decode('ascii')
+
+    untracked = _split_paths(
+        _run_git(root, ['ls-files', '-z', '--others', '--exclude-standard']))
+    if revision == 'HEAD' and not _has_head(root):
+        # No commits yet: everything in the index is new.
+        return _split_paths(_run_git(root, ['ls-files', '-z'])) + untracked
+
+    changed = _split_paths(_run_git(
+        root, ['diff', '--name-only', '-z', '--no-renames', '--diff-filter=d', revision, '--']))
+    return changed + untracked
+
+
+def list_staged_files(root):
+    '''
+    :return list(tuple(str,str|NoneType)):
+        The paths (relative to the root) of the files which are staged along with the
+        id of their blob in the index (None if the file in the working tree also has
+        unstaged changes, in which case the blob doesn't have its current contents).
+
+        Note: the blob id is the hash of the contents as stored by git (so, it only
+        matches the contents in the working tree when no filters -- such as end of line
+        conversions -- change them).
+    '''
+    if _has_head(root):
+        args = ['diff', '--cached', '--raw', '-z', '--no-abbrev', '--no-renames',
+                '--diff-filter=d', 'HEAD', '--']
+    else:
+        # No commits yet: compare with the empty tree.
+        empty_tree = _run_git(root, ['hash-object', '-t', 'tree', '--stdin']).strip()
+        args = ['diff', '--cached', '--raw', '-z', '--no-abbrev', '--no-renames',
+                '--diff-filter=d', empty_tree.decode('ascii'), '--']
+
+    # Each entry is ":<old mode> <new mode> <old id> <new id> <status>\0<path>\0".
+    fields = _run_git(root, args).split(b'\0')
+    staged = []
+    for i in range(0, len(fields) - 1, 2):
+        info, path = fields[i], fields[i + 1]
+        if not info.startswith(b':'):
+            break
+        staged.append((_decode_path(path), info.split()[3].decode('ascii')))
+
+    unstaged = set(_split_paths(_run_git(root, ['diff', '--name-only', '-z', '--no-renames'])))
+    return [(path, None if path in unstaged else blob_id) for path, blob_id in staged]
+
+
+def list_tracked_files(root):
+    '''
+    :return list(str):
+        The paths (relative to the root) of the files tracked by git.
+    '''
+    return _split_paths(_run_git(root, ['ls-files', '-z']))
@@ -0,0 +1,347 @@
+'''
+Options used to launch the java processes which run the formatter.
+
+To make the startup of the java process faster:
+
+- The classes used by the formatter are put in a class data sharing (AppCDS) archive
+  which is created on first use (once for each JDK/formatter version and for each set of
+  options which affect it, such as the GC or heap size) in the user cache dir and reused by
+  the processes launched afterwards.
+
+- Processes which are short-lived (i.e.: which format a single snippet or the files of a
+  single command line invocation) use a profile which favors startup (only the C1 JIT
+  compiler and the serial GC).
+
+The options of the profile may be overridden with the PYDEVF_JAVA_OPTS environment
+variable (in which case they're used instead of the profile). The AppCDS archive isn't
+used if those options include a -Xshare option.
+'''
+
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import os.path
+import re
+import shlex
+import subprocess
+import sys
+import zipfile
+
+from . import _cache
+
+JAVA_OPTS_ENV_VAR = 'PYDEVF_JAVA_OPTS'
+
+MAIN_CLASS = 'org.python.pydev.ast.formatter.PyFormatter'
+
+# Favors startup time (for processes which format only a few snippets).
+STARTUP_OPTIONS = ['-XX:TieredStopAtLevel=1', '-XX:+UseSerialGC']
+
+# The daemon workers are long lived (so, the C2 compiler is kept), but as each process
+# formats one snippet at a time the serial GC is enough.
+SERVER_OPTIONS = ['-XX:+UseSerialGC']
+
+# AppCDS archives with the classes from the application classpath may be created
+# with -Xshare:dump from java 11 onwards.
+_MIN_CDS_VERSION = 11
+
+# -Xverify:none is deprecated (and prints a warning) from java 13 onwards.
+_MAX_NO_VERIFY_VERSION = 12
+
+# Options which must match the ones used to create the AppCDS archive (otherwise the JVM
+# silently doesn't use it): the GC, heap size, compressed oops, verification and modules.
+_CDS_OPTION_PREFIXES = (
+    '-Xmx', '-Xms', '-Xmn', '-Xverify', '-Xbootclasspath', '--add-', '--patch-module',
+    '--module-path', '--upgrade-module-path', '--limit-modules', '--enable-preview',
+)
+_CDS_XX_OPTION_PATTERN = re.compile(r'-XX:[+-]?\w*(GC|Heap|Compressed|ObjectAlignment)\w*')
+
+# Used to record the classes loaded by the formatter when creating the archive.
+_SAMPLE_CODE = b'''
+class A(object):
+
+    def method(self, a, b=(1, 2), *args, **kwargs):
+        return [x for x in a if x] + {'a': b}.get('a', [])
+'''
+
+
+def find_java(java_executable):
+    '''
+    :return str|NoneType:
+        The full path to the java executable in the PATH (or None if not found).
+    '''
+    for dir_in_path in os.environ.get('PATH', '').split(os.path.pathsep):
+        path = os.path.join(dir_in_path, java_executable)
+        if os.path.isfile(path):
+            return os.path.abspath(path)
+    return None
+
+
+def parse_java_version(version_output):
+    '''
+    :param str version_output:
+        The output of `java -version`.
+
+    :return int|NoneType:
+        The major version of java (i.e.: 8 for 1.8.0_111 and 11 for 11.0.2).
+    '''
+    match = re.search(r'version "(\d+)(?:\.(\d+))?[^"]*"', version_output)
+    if match is None:
+        return None
+    major = int(match.group(1))
+    if major == 1 and match.group(2):
+        major = int(match.group(2))
+    return major
+
+
+def _get_stat_key(path):
+    try:
+        return _cache.get_stat_key(os.stat(path))
+    except OSError:
+        return None
+
+
+def get_java_version(java_path, cache_dir):
+    '''
+    :param str java_path:
+        The full path to the java executable.
+
+    :param str cache_dir:
+        The directory where the version is cached (so that `java -version` is only
+        executed again if the java executable changes).
+
+    :return int|NoneType:
+        The major version of java or None if it couldn't be determined.
+    '''
+    real_path = os.path.realpath(java_path)
+    stat_key = _get_stat_key(real_path)
+    versions_path = os.path.join(cache_dir, 'java-versions.json')
+    try:
+        with open(versions_path, 'rb') as stream:
+            versions = json.loads(stream.read().decode('utf-8'))
+        if not isinstance(versions, dict):
+            versions = {}
+    except (IOError, OSError, ValueError):
+        versions = {}
+
+    entry = versions.get(real_path)
+    if entry is not None and stat_key is not None and entry[:3] == stat_key:
+        return entry[3]
+
+    try:
+        process = subprocess.Popen(
+            [java_path, '-version'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        output = process.communicate()[0]
+    except OSError:
+        return None
+
+    version = parse_java_version(output.decode('utf-8', errors='replace'))
+    if version is not None and stat_key is not None:
+        versions[real_path] = stat_key + [version]
+        _write_file(versions_path, json.dumps(versions).encode('utf-8'))
+    return version
+
+
+def get_java_options(version, short_lived):
+    '''
+    :param int|NoneType version:
+        The major version of java (None if unknown).
+
+    :param bool short_lived:
+        Whether the process is expected to be short-lived (uses the startup profile).
+
+    :return list(str):
+        The options for the java process (from PYDEVF_JAVA_OPTS if set).
+    '''
+    override = os.environ.get(JAVA_OPTS_ENV_VAR)
+    if override is not None:
+        return shlex.split(override, posix=sys.platform != 'win32')
+
+    options = list(STARTUP_OPTIONS if short_lived else SERVER_OPTIONS)
+    if version is None or version <= _MAX_NO_VERIFY_VERSION:
+        options.append('-Xverify:none')
+    return options
+
+
+def get_cds_options(options):
+    '''
+    :param list(str) options:
+        The options used to launch java.
+
+    :return list(str):
+        The options which affect whether an AppCDS archive may be used (so, an archive
+        is created for each distinct set of them).
+    '''
+    cds_options = []
+    for i, option in enumerate(options):
+        if option.startswith(_CDS_OPTION_PREFIXES) or _CDS_XX_OPTION_PATTERN.match(option):
+            cds_options.append(option)
+            if option.startswith('--') and '=' not in option and i + 1 < len(options):
+                # i.e.: --add-opens java.base/java.lang=ALL-UNNAMED
+                if not options[i + 1].startswith('-'):
+                    cds_options.append(options[i + 1])
+    return cds_options
+
+
+def get_launch_args(java_path, version, options, target_jar, cache_dir, identity):
+    '''
+    :param list(str) options:
+        The options which will be used to launch java (see: get_java_options).
+
+    :param str identity:
+        Identifies the formatter (so that an archive isn't reused with another jar).
+
+    :return list(str):
+        The arguments to launch the formatter (after the java options): uses the AppCDS
+        archive when available (creating it if needed), otherwise just the jar.
+    '''
+    default = ['-jar', target_jar]
+    if version is None or version < _MIN_CDS_VERSION:
+        return default
+    if any(option.startswith('-Xshare') for option in options):
+        return default
+
+    java_key = hashlib.sha1(('%s|%s|%s' % (
+        os.path.realpath(java_path), version, ' '.join(get_cds_options(options)))
+    ).encode('utf-8')).hexdigest()[:16]
+    cds_dir = os.path.join(cache_dir, 'cds', '%s-%s' % (java_key, identity))
+    archive = os.path.join(cds_dir, 'formatter.jsa')
+    failed_marker = os.path.join(cds_dir, 'failed')
+    classpath = os.path.pathsep.join(
+        [os.path.join(cds_dir, 'formatter.jar')] + _get_manifest_jars(target_jar))
+
+    if not os.path.exists(archive):
+        if os.path.exists(failed_marker):
+            return default
+        if not _create_archive(java_path, options, target_jar, cds_dir, classpath, archive):
+            _write_file(failed_marker, b'')
+            return default
+
+    # Note: -Xlog:disable so that a mismatched archive doesn't print a warning in the
+    # stdout (which is used to communicate with the formatter).
+    return [
+        '-XX:SharedArchiveFile=%s' % (archive,),
+        '-Xshare:auto',
+        '-Xlog:disable',
+        '-cp',
+        classpath,
+        MAIN_CLASS,
+    ]
+
+
+def _get_manifest_jars(target_jar):
+    '''
+    :return list(str):
+        The jars in the Class-Path of the manifest of the given jar which actually exist.
+    '''
+    with zipfile.ZipFile(target_jar) as jar:
+        manifest = jar.read('META-INF/MANIFEST.MF').decode('utf-8')
+
+    # Long lines are continued in the next line starting with a space.
+    manifest = manifest.replace('\r\n', '\n').replace('\n ', '')
+    jars = []
+    base_dir = os.path.dirname(os.path.abspath(target_jar))
+    for line in manifest.splitlines():
+        if line.startswith('Class-Path:'):
+            for entry in line[len('Class-Path:'):].split():
+                path = os.path.join(base_dir, entry)
+                if entry.endswith('.jar') and os.path.isfile(path):
+                    jars.append(path)
+    return jars
+
+
+def _create_archive(java_path, options, target_jar, cds_dir, classpath, archive):
+    '''
+    Creates the AppCDS archive with the classes loaded to format some sample code.
+
+    Note: the formatter jar is copied without the Class-Path in its manifest (it has
+    a directory in it, which isn't supported when creating the archive).
+
+    :return bool:
+        Whether the archive was created.
+    '''
+    suffix = '.%s.tmp' % (os.getpid(),)
+    class_list = os.path.join(cds_dir, 'classes.lst' + suffix)
+    tmp_archive = archive + suffix
+    try:
+        _cache._makedirs(cds_dir)
+        _write_formatter_jar(target_jar, os.path.join(cds_dir, 'formatter.jar'))
+
+        base_args = [java_path] + options + ['-Xlog:disable']
+        process = subprocess.Popen(
+            base_args + ['-XX:DumpLoadedClassList=%s' % (class_list,), '-cp', classpath,
+                         MAIN_CLASS, '-single'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        process.communicate(_SAMPLE_CODE)
+        if process.returncode != 0 or not os.path.exists(class_list):
+            return False
+
+        process = subprocess.Popen(
+            base_args + ['-Xshare:dump', '-XX:SharedClassListFile=%s' % (class_list,),
+                         '-XX:SharedArchiveFile=%s' % (tmp_archive,), '-cp', classpath],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        process.communicate()
+        if process.returncode != 0 or not os.path.exists(tmp_archive):
+            return False
+
+        _cache.replace_file(tmp_archive, archive)
+        return True
+    except (IOError, OSError):
+        return False
+    finally:
+        for path in (class_list, tmp_archive):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _write_formatter_jar(target_jar, path):
+    '''
+    Copies the formatter jar to the given path without the Class-Path in its manifest.
+    '''
+    if os.path.exists(path):
+        return
+
+    tmp_path = path + '.%s.tmp' % (os.getpid(),)
+    try:
+        with zipfile.ZipFile(target_jar) as source, \
+                zipfile.ZipFile(tmp_path, 'w') as target:
+            for info in source.infolist():
+                data = source.read(info.filename)
+                if info.filename == 'META-INF/MANIFEST.MF':
+                    data = ('Manifest-Version: 1.0\r\nMain-Class: %s\r\n\r\n' % (
+                        MAIN_CLASS,)).encode('utf-8')
+                target.writestr(info, data)
+        _cache.replace_file(tmp_path, path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _write_file(path, contents):
+    tmp_path = path + '.%s.tmp' % (os.getpid(),)
+    try:
+        _cache._makedirs(os.path.dirname(path))
+        with open(tmp_path, 'wb') as stream:
+            stream.write(contents)
+        _cache.replace_file(tmp_path, path)
+    except (IOError, OSError):
+        # Just an optimization: errors writing are ignored.
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
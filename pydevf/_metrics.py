@@ -0,0 +1,257 @@
+'''
+Metrics collected by the daemon (shown through the `stats` operation).
+
+Latencies are kept in histograms with fixed buckets (so, recording a value is cheap
+and the memory used doesn't grow with the number of requests). The stats may be
+converted to the OpenMetrics text format (to be scraped by monitoring tools).
+'''
+
+from __future__ import unicode_literals
+
+import bisect
+import threading
+
+try:
+    from time import monotonic as _monotonic
+except ImportError:
+    from time import time as _monotonic
+
+# Upper bounds (in seconds) of the latency buckets.
+LATENCY_BUCKETS = (
+    .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+# The stages of a request whose latency is recorded:
+# queue_wait: waiting for an available java process.
+# format: formatting in the java process (including the communication with it).
+# transfer: writing the answer to the client (until it's flushed to the socket).
+# request: from the request being read until its answer is written.
+STAGES = ('queue_wait', 'format', 'transfer', 'request')
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def to_dict(self):
+        '''
+        :return dict:
+            With the 'count', 'sum' and the cumulative 'buckets' as a list of
+            [upper_bound, count] (the last upper bound is '+Inf').
+        '''
+        with self._lock:
+            counts = self._counts[:]
+            total = self._sum
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(list(self.buckets) + ['+Inf'], counts):
+            cumulative += count
+            buckets.append([bound, cumulative])
+        return {'count': cumulative, 'sum': total, 'buckets': buckets}
+
+
+class Metrics(object):
+    '''
+    Counters and latency histograms of the daemon (thread-safe).
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.errors = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.connections = 0
+        self.active_connections = 0
+        self.latency = dict((stage, Histogram()) for stage in STAGES)
+
+    def on_connection(self, delta):
+        with self._lock:
+            self.active_connections += delta
+            if delta > 0:
+                self.connections += delta
+
+    def on_request(self, operation):
+        with self._lock:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+
+    def on_received(self, size):
+        with self._lock:
+            self.bytes_in += size
+
+    def on_sent(self, size, elapsed):
+        with self._lock:
+            self.bytes_out += size
+        self.latency['transfer'].observe(elapsed)
+
+    def on_error(self, result):
+        with self._lock:
+            self.errors[result] = self.errors.get(result, 0) + 1
+
+    def observe(self, stage, value):
+        self.latency[stage].observe(value)
+
+    def get_stats(self):
+        with self._lock:
+            stats = {
+                'requests': dict(self.requests),
+                'errors': dict(self.errors),
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'connections': self.connections,
+                'active_connections': self.active_connections,
+            }
+        stats['latency'] = dict(
+            (stage, histogram.to_dict()) for stage, histogram in self.latency.items())
+        return stats
+
+
+class MeteredReader(object):
+    '''
+    Wraps a stream to record the bytes read from it.
+    '''
+
+    def __init__(self, stream, metrics):
+        self._stream = stream
+        self._metrics = metrics
+
+    def readline(self):
+        line = self._stream.readline()
+        self._metrics.on_received(len(line))
+        return line
+
+    def read(self, size):
+        data = self._stream.read(size)
+        self._metrics.on_received(len(data))
+        return data
+
+    def peek(self, size):
+        '''
+        :return bytes:
+            Blocks until some data is available (empty on EOF). Note: the bytes are only
+            recorded when they're actually read.
+        '''
+        peek = getattr(self._stream, 'peek', None)
+        if peek is None:
+            return b' '  # Not available (python 2): assume that there's data.
+        return peek(size)
+
+    def readinto(self, buf):
+        size = self._stream.readinto(buf)
+        self._metrics.on_received(size or 0)
+        return size
+
+
+class MeteredWriter(object):
+    '''
+    Wraps a stream to record the bytes written to it and the time to write each
+    message (which is flushed once after being written).
+    '''
+
+    def __init__(self, stream, metrics):
+        self._stream = stream
+        self._metrics = metrics
+        self._size = 0
+        self._start_time = None
+
+    def write(self, data):
+        if self._start_time is None:
+            self._start_time = _monotonic()
+        self._stream.write(data)
+        self._size += len(data)
+
+    def flush(self):
+        self._stream.flush()
+        if self._start_time is not None:
+            self._metrics.on_sent(self._size, _monotonic() - self._start_time)
+        self._size = 0
+        self._start_time = None
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % (','.join(
+        '%s="%s"' % (name, ('%s' % (value,)).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in labels),)
+
+
+def _format_value(value):
+    if value is None:
+        return 'NaN'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return repr(value) if isinstance(value, float) else '%s' % (value,)
+
+
+def to_openmetrics(stats):
+    '''
+    :param dict stats:
+        The stats of the daemon (see: _WorkerPool.get_stats).
+
+    :return unicode:
+        The stats in the OpenMetrics text format.
+    '''
+    lines = []
+
+    def add(name, metric_type, help_text, samples):
+        lines.append('# TYPE pydevf_%s %s' % (name, metric_type))
+        lines.append('# HELP pydevf_%s %s' % (name, help_text))
+        for suffix, labels, value in samples:
+            lines.append('pydevf_%s%s%s %s' % (
+                name, suffix, _format_labels(labels), _format_value(value)))
+
+    add('requests', 'counter', 'Requests received by operation.', [
+        ('_total', [('operation', operation)], count)
+        for operation, count in sorted(stats.get('requests', {}).items())])
+    add('errors', 'counter', 'Requests which failed by result.', [
+        ('_total', [('result', result)], count)
+        for result, count in sorted(stats.get('errors', {}).items())])
+    add('received_bytes', 'counter', 'Bytes received (headers and body).', [
+        ('_total', [], stats.get('bytes_in', 0))])
+    add('sent_bytes', 'counter', 'Bytes sent (headers and body).', [
+        ('_total', [], stats.get('bytes_out', 0))])
+    add('connections', 'counter', 'Connections accepted.', [
+        ('_total', [], stats.get('connections', 0))])
+    add('active_connections', 'gauge', 'Connections currently open.', [
+        ('', [], stats.get('active_connections', 0))])
+    add('queue_depth', 'gauge', 'Snippets waiting for a java process.', [
+        ('', [], stats.get('pending', 0))])
+    add('uptime_seconds', 'gauge', 'Time since the daemon was started.', [
+        ('', [], stats.get('uptime'))])
+
+    samples = []
+    for stage, histogram in sorted(stats.get('latency', {}).items()):
+        for bound, count in histogram['buckets']:
+            if bound != '+Inf':
+                bound = repr(float(bound))
+            samples.append(('_bucket', [('stage', stage), ('le', bound)], count))
+        samples.append(('_count', [('stage', stage)], histogram['count']))
+        samples.append(('_sum', [('stage', stage)], histogram['sum']))
+    add('latency_seconds', 'histogram', 'Latency of each stage of the requests.', samples)
+
+    workers = stats.get('workers', [])
+    for name, key, metric_type, help_text in (
+            ('worker_uptime_seconds', 'process_uptime', 'gauge',
+             'Time since the java process of the worker was started.'),
+            ('worker_rss_bytes', 'rss', 'gauge', 'Resident set size of the java process.'),
+            ('worker_requests', 'requests', 'counter', 'Snippets formatted by the worker.'),
+            ('worker_restarts', 'restarts', 'counter',
+             'Times that the java process of the worker was respawned.'),
+            ('worker_recycles', 'recycles', 'counter',
+             'Times that the java process of the worker was recycled.')):
+        suffix = '_total' if metric_type == 'counter' else ''
+        add(name, metric_type, help_text, [
+            (suffix, [('worker', i)], worker.get(key)) for i, worker in enumerate(workers)])
+
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
@@ -20,42 +20,65 @@ calls through:
 format_code_using_daemon(code_to_format)
 format_code_using_daemon(code_to_format)
 
+# Or to format many snippets in batches:
+for formatted, error in format_many_using_daemon(codes_to_format):
+    ...
+
+# Information on the daemon (requests, latencies, processes).
+get_daemon_stats()
+
 # Optional as the daemon is meant to be kept alive for invocations in different
 # processess.
 exit_daemon()
+
+The daemon may also be used from asyncio code (python 3.6 onwards) through:
+
+formatted = await format_code_async(code_to_format)
+
+async for formatted, error in format_many_async(codes_to_format):
+    ...
 '''
 
 from __future__ import unicode_literals
 
 import os.path
-import re
 import sys
 import tempfile
 import threading
-import traceback
 import weakref
+from functools import partial
 
-import click
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty  # @UnresolvedImport
 
-from .version import __version__
+try:
+    from time import monotonic as _monotonic
+except ImportError:
+    from time import time as _monotonic
 
-click.disable_unicode_literals_warning = True
+from . import _tracing
+from .version import __version__
 
 _MUTEX_NAME = 'pydev_code_formatter'
+if hasattr(os, 'getuid'):
+    # Each user has its own daemon.
+    _MUTEX_NAME += '_%s' % (os.getuid(),)
 
 if sys.version_info[0] < 3:
     text_type = unicode  # noqa @UndefinedVariable
 else:
     text_type = str
 
+# Note: only checked when a java process is about to be launched.
 target_jar = os.path.join(os.path.dirname(__file__), 'pydev_formatter.jar')
-if not os.path.exists(target_jar):
-    sys.stderr.write('%s must exist.\n' % (target_jar,))
-    sys.exit(1)
 
 _process_lock = threading.Lock()
-_read_lock = threading.Lock()
+_process_locks = weakref.WeakKeyDictionary()
 _write_lock = threading.Lock()
+_stream_locks_lock = threading.Lock()
+_stream_locks = weakref.WeakKeyDictionary()
 
 # Simple handling: start process and call format_code.
 
@@ -68,11 +91,50 @@ debug_opts = ['-Xdebug', '-Xrunjdwp:transport=dt_socket,address=8000,server=y,su
 debug_opts = []
 
 
-def _create_process(mode):
+_java_launch_lock = threading.Lock()
+_java_launch_info = {}
+
+
+def _get_java_launch_args(short_lived):
+    '''
+    :return list(str):
+        The arguments to launch the formatter (java executable, options and jar/class).
+    '''
+    from . import _jvm
+    with _java_launch_lock:
+        if 'version' not in _java_launch_info:
+            java_path = _java_launch_info.get('path')
+            if java_path is None:
+                java_path = _jvm.find_java(java_executable) or java_executable
+            _java_launch_info['path'] = java_path
+            _java_launch_info['version'] = _jvm.get_java_version(java_path, _get_cache_dir())
+
+        java_path = _java_launch_info['path']
+        version = _java_launch_info['version']
+        options = _jvm.get_java_options(version, short_lived)
+        key = tuple(options)
+        launch_args = _java_launch_info.get(key)
+        if launch_args is None:
+            # Note: may create the class data sharing archive (done once).
+            launch_args = _java_launch_info[key] = _jvm.get_launch_args(
+                java_path, version, options, target_jar, _get_cache_dir(),
+                _get_formatter_identity())
+
+    return [java_path] + debug_opts + options + launch_args
+
+
+def _create_process(mode, short_lived=False):
+    '''
+    :param str mode:
+        -single to format a single snippet or -multiple for a format server.
+
+    :param bool short_lived:
+        Whether the process should be optimized for startup time.
+    '''
     import subprocess
 
     process = subprocess.Popen(
-        [java_executable] + debug_opts + ['-Xverify:none', '-jar', target_jar, mode],
+        _get_java_launch_args(short_lived) + [mode],
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT
@@ -85,105 +147,620 @@ def _create_process(mode):
     return process
 
 
-def format_code(code_to_format):
+def format_code(code_to_format, timeout=None):
     '''
     Formats one code snippet and finishes the process.
 
     :param unicode|bytes code_to_format:
         The code to be formatted.
+
+    :param float timeout:
+        The maximum time (in seconds) to wait for the code to be formatted. If not given
+        uses the PYDEVF_TIMEOUT environment variable (0 means no timeout).
     '''
+    return _format_using_cache(
+        partial(_format_code_in_new_process, deadline=_get_deadline(timeout)), code_to_format)
+
+
+def _format_code_in_new_process(code_to_format, deadline=None):
     _check_java_in_path()
-    process = _create_process('-single')
+    process = _create_process('-single', short_lived=True)
 
     input_in_bytes = isinstance(code_to_format, bytes)
 
     if not input_in_bytes:
         code_to_format = code_to_format.encode(encoding='utf_8', errors='strict')
 
-    new_contents = process.communicate(input=code_to_format)[0]
+    watch = None
+    if deadline is not None:
+        watch = _watchdog.watch(deadline, partial(_kill_process, process))
+    try:
+        with _tracing.span('jvm_format'):
+            new_contents = process.communicate(input=code_to_format)[0]
+    finally:
+        if watch is not None and _watchdog.cancel(watch):
+            raise TimeoutError('Timed out formatting code (formatter process killed).')
     if not input_in_bytes:
         new_contents = new_contents.decode('utf-8')
 
     if process.returncode != 0:
-        raise RuntimeError('Unable to format. process.returncode == %s' % (
-            process.returncode,))
+        msg = 'Unable to format. process.returncode == %s' % (process.returncode,)
+        if process.returncode == 1 and not new_contents:
+            # This is what the formatter does when the code has a syntax error.
+            raise _FormatterSyntaxError(msg)
+        raise RuntimeError(msg)
     return new_contents
 
 
-def start_daemon_server():
+def start_daemon_server(
+        workers=None, warmup=None, idle_timeout=None, max_requests=None, max_rss=None,
+        timeout=None):
+    '''
+    Starts the daemon which answers the requests done through format_code_using_daemon.
+
+    :param int workers:
+        The maximum number of java formatter processes used to answer the requests
+        (if not given uses the PYDEVF_WORKERS environment variable or the number of
+        cpus available).
+
+    :param int warmup:
+        The number of times that each java process formats the warm-up corpus after
+        being started (while it has no requests to answer). If not given uses the
+        PYDEVF_WARMUP environment variable (0 disables the warm-up).
+
+    :param float idle_timeout:
+        The daemon exits after this many minutes without requests. If not given uses
+        the PYDEVF_IDLE_TIMEOUT environment variable (0 means it never exits).
+
+    :param int max_requests:
+        A java process is recycled after formatting this many snippets. If not given
+        uses the PYDEVF_MAX_REQUESTS environment variable (0 means no limit).
+
+    :param int max_rss:
+        A java process is recycled when its RSS goes over this many MB (only checked
+        on Linux). If not given uses the PYDEVF_MAX_RSS environment variable (0 means
+        no limit).
+
+    :param float timeout:
+        The default timeout (in seconds) for requests which don't specify one. If not
+        given uses the PYDEVF_TIMEOUT environment variable (0 means no timeout).
+    '''
     debug('Code formatter daemon main_server.')
+    _tracing.set_process_name('pydevf daemon')
     socket_started = []
 
     def start_daemon_inner():
         debug('Actually initialize code formatter daemon.')
-        import socket
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind(('127.0.0.1', 0))
-        # Get a port to an unused socket.
-        _addr, port = sock.getsockname()
+        sock, address = _create_daemon_socket()
+        # Listen before the address is published (so that clients can connect as soon
+        # as they get it -- when many clients connect at once they wait in the backlog).
+        sock.listen(_LISTEN_BACKLOG)
         socket_started.append(sock)
-        return port
+        return address
 
     port_mutex = PortMutex(_MUTEX_NAME, start_daemon_inner)
-    sys.stdout.write(str(port_mutex.port) + '\n')
+    sys.stdout.write(_format_address(port_mutex.port) + '\n')
     sys.stdout.flush()
-    debug('Gotten port: %s.' % (port_mutex.port,))
+    debug('Gotten address: %s.' % (port_mutex.port,))
 
     if port_mutex.get_mutex_aquired():
         # If we acquired the mutex, this is the process that'll be live
         # answering the messages (other processes will just print the
         # port to be used and will exit).
-        process = start_format_server()
+        pool = _WorkerPool(
+            _get_workers_count(workers),
+            warmup_rounds=_get_warmup_rounds(warmup),
+            max_requests=_get_number_option(max_requests, 'PYDEVF_MAX_REQUESTS'),
+            max_rss=_get_number_option(max_rss, 'PYDEVF_MAX_RSS') * 1024 * 1024,
+            timeout=_get_timeout(timeout),
+        )
+        pool.start()
+        idle_timeout = _get_number_option(idle_timeout, 'PYDEVF_IDLE_TIMEOUT', float)
+        if idle_timeout:
+            t = threading.Thread(
+                target=_exit_when_idle, args=(pool, port_mutex, idle_timeout * 60))
+            t.daemon = True
+            t.start()
         sock = socket_started[0]
         while True:
-            sock.listen(1)
             client_sock, _addr = sock.accept()
+            if pool.is_exiting():
+                client_sock.close()
+                continue
+            _set_no_delay(client_sock)
             debug('Accepted client. Will start handling.')
-            t = threading.Thread(target=_start_handling, args=(process, client_sock, port_mutex))
+            t = threading.Thread(target=_start_handling, args=(pool, client_sock, port_mutex))
             t.start()
     else:
         debug('Mutex not acquired.')
 
 
+def _exit_daemon_process(pool, port_mutex):
+    '''
+    Stops the java processes and exits the daemon (after that, clients start a new one).
+    '''
+    pool.stop()
+    if not isinstance(port_mutex.port, int):
+        try:
+            os.unlink(port_mutex.port)
+        except OSError:
+            pass
+    port_mutex.release_mutex()
+    os._exit(1)
+
+
+def _exit_when_idle(pool, port_mutex, idle_timeout):
+    '''
+    Exits the daemon after idle_timeout seconds without requests.
+    '''
+    import time
+    interval = max(.1, min(idle_timeout / 10., 30.))
+    while True:
+        time.sleep(interval)
+        # Note: no request may start after this check (so, none is killed mid-flight).
+        if pool.start_exit_if_idle(idle_timeout):
+            debug('Daemon idle for %.1fs: exiting.' % (idle_timeout,))
+            _exit_daemon_process(pool, port_mutex)
+
+
+_LISTEN_BACKLOG = 128
+
+# Set PYDEVF_TRANSPORT=tcp to always use a tcp socket to communicate with the daemon.
+_TRANSPORT_ENV_VAR = 'PYDEVF_TRANSPORT'
+
+# Unix socket paths are limited to ~108 bytes (sockaddr_un.sun_path).
+_MAX_UNIX_SOCKET_PATH = 100
+
+
+def _format_address(address):
+    '''
+    :param int|unicode address:
+        The port (int) or the path to the unix socket where the daemon listens.
+
+    :return unicode:
+        The address as published in the mutex file/written by the daemon to its stdout.
+    '''
+    if isinstance(address, int):
+        return text_type(address)
+    return 'unix:' + address
+
+
+def _parse_address(contents):
+    '''
+    :param bytes|unicode contents:
+        The contents as written by _format_address.
+
+    :return int|unicode:
+        The port or the path to the unix socket.
+
+    :raise ValueError:
+        If the contents are not a valid address.
+    '''
+    if isinstance(contents, bytes):
+        contents = contents.decode('utf-8')
+    contents = contents.strip()
+    if contents.startswith('unix:'):
+        if len(contents) == len('unix:'):
+            raise ValueError('Empty unix socket path.')
+        return contents[len('unix:'):]
+    return int(contents)
+
+
+def _get_unix_socket_path():
+    '''
+    :return unicode|NoneType:
+        The path where the unix socket of the daemon should be created or None if unix
+        sockets shouldn't be used (not available, disabled or no safe place for it).
+
+    The socket is put in a directory which only the current user may access (so,
+    filesystem permissions prevent other users from connecting to the daemon).
+    '''
+    import socket
+    import stat
+
+    if not hasattr(socket, 'AF_UNIX') or sys.platform == 'win32':
+        return None
+    if os.environ.get(_TRANSPORT_ENV_VAR, '').lower() == 'tcp':
+        return None
+
+    uid = os.getuid()
+    directory = os.path.join(tempfile.gettempdir(), 'pydevf-%s' % (uid,))
+    try:
+        os.mkdir(directory, 0o700)
+    except OSError:
+        if not os.path.isdir(directory):
+            debug_exception('Unable to create: %s' % (directory,))
+            return None
+
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != uid or stat.S_IMODE(st.st_mode) & 0o077:
+        debug('Not using unix socket: %s is not private.' % (directory,))
+        return None
+
+    path = os.path.join(directory, 'daemon.sock')
+    if len(path.encode(sys.getfilesystemencoding() or 'utf-8')) > _MAX_UNIX_SOCKET_PATH:
+        debug('Not using unix socket: path too long: %s' % (path,))
+        return None
+    return path
+
+
+def _create_daemon_socket():
+    '''
+    :return tuple(socket, int|unicode):
+        The socket where the daemon listens and its address (a unix socket path
+        when available, otherwise a port in the loopback interface).
+    '''
+    import socket
+
+    path = _get_unix_socket_path()
+    if path is not None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                # Only one daemon may have the mutex, so, an existing socket file is
+                # a leftover from a daemon which didn't exit cleanly.
+                os.unlink(path)
+            except OSError:
+                pass
+            sock.bind(path)
+        except Exception:
+            debug_exception('Unable to bind unix socket (falling back to tcp).')
+            sock.close()
+        else:
+            return sock, path
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    # Get a port to an unused socket.
+    _addr, port = sock.getsockname()
+    return sock, port
+
+
+def _set_no_delay(sock):
+    '''
+    Disables Nagle's algorithm in a tcp socket (requests and answers are small
+    messages which shouldn't wait to be coalesced with other writes).
+    '''
+    import socket
+    if sock.family == socket.AF_INET:
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (AttributeError, socket.error):
+            debug_exception('Unable to set TCP_NODELAY.')
+
+
+def _create_client_socket(address):
+    '''
+    :param int|unicode address:
+        The address of the daemon (see: _format_address).
+
+    :return socket:
+        A socket connected to the daemon.
+    '''
+    import socket
+
+    if isinstance(address, int):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        _set_no_delay(sock)
+        sock_address = ('127.0.0.1', address)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock_address = address
+    try:
+        sock.connect(sock_address)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
 def exit_daemon():
     debug('exit daemon')
-    write_to_stream, _read_from_stream = _connect_to_daemon_process(create_if_not_there=False)
-    if write_to_stream is None:
+    connection = _connect_to_daemon_process(create_if_not_there=False)
+    if connection is None:
         return  # No deamon running
-    _write(write_to_stream, 'exit daemon', [('Operation', 'exit_daemon')])
+    _write(connection.write_to_stream, 'exit daemon', [('Operation', 'exit_daemon')])
+    connection.close()
+    # Connections kept alive are no longer valid.
+    _daemon_client.close()
+
+
+def get_daemon_stats(openmetrics=False):
+    '''
+    :param bool openmetrics:
+        If True the stats are returned in the OpenMetrics text format.
+
+    :return dict|unicode|NoneType:
+        Information on the daemon (see: _WorkerPool.get_stats) such as the number of
+        requests, latency histograms of each stage of the requests and the processes
+        used or None if the daemon isn't running.
+    '''
+    import json
+    connection = _connect_to_daemon_process(create_if_not_there=False)
+    if connection is None:
+        return None
+    headers = [('Operation', 'stats')]
+    if openmetrics:
+        headers.append(('Format', 'openmetrics'))
+    try:
+        _write(connection.write_to_stream, '', headers)
+        header, body = _read(connection.read_from_stream)
+    finally:
+        connection.close()
+    _check_result(header, body)
+    if openmetrics:
+        return body
+    return json.loads(body)
+
+
+def _request_daemon_trace(enable=None):
+    '''
+    :param bool|NoneType enable:
+        If given, tracing is enabled/disabled in the daemon.
+
+    :return list(dict)|NoneType:
+        The trace events of the daemon or None if the daemon isn't running.
+    '''
+    import json
+    connection = _connect_to_daemon_process(create_if_not_there=False)
+    if connection is None:
+        return None
+    headers = [('Operation', 'trace')]
+    if enable is not None:
+        headers.append(('Trace-Enable', '1' if enable else '0'))
+    try:
+        _write(connection.write_to_stream, '', headers)
+        header, body = _read(connection.read_from_stream)
+    finally:
+        connection.close()
+    _check_result(header, body)
+    return json.loads(body)['traceEvents']
+
+
+def enable_tracing(enable=True, include_daemon=True):
+    '''
+    Enables (or disables) the tracing of the requests (see: dump_trace).
+
+    Note: tracing may also be enabled with the PYDEVF_TRACE=1 environment variable
+    (which is also inherited by a daemon launched afterwards).
+
+    :param bool include_daemon:
+        If True, tracing is also enabled/disabled in the daemon (if it's running).
+    '''
+    if enable:
+        _tracing.enable()
+    else:
+        _tracing.disable()
+    if include_daemon:
+        _request_daemon_trace(enable)
 
 
-def format_code_using_daemon(code_to_format):
+def dump_trace(path=None, include_daemon=True):
+    '''
+    :param unicode path:
+        If given, the trace is written to this file.
+
+    :param bool include_daemon:
+        If True, the spans of the daemon (if it's running) are merged with the spans of
+        this process (the timestamps are comparable as both are monotonic).
+
+    :return unicode:
+        The spans recorded in the Chrome trace format (may be viewed in
+        chrome://tracing or https://ui.perfetto.dev).
+    '''
+    events = _tracing.get_events()
+    if include_daemon:
+        events.extend(_request_daemon_trace() or [])
+    if path is not None:
+        _tracing.dump(path, events)
+    return _tracing.dumps(events)
+
+
+def format_code_using_daemon(code_to_format, timeout=None):
     '''
     :param unicode code_to_format:
+
+    :param float timeout:
+        The maximum time (in seconds) that the daemon may take to format the code
+        (including the time waiting for an available java process). If not given uses
+        the PYDEVF_TIMEOUT environment variable or the default timeout of the daemon.
+
+    :raise TimeoutError:
+        If the code wasn't formatted in time.
     '''
+    return _format_using_cache(
+        partial(_format_code_using_daemon, timeout=timeout), code_to_format)
+
+
+def _format_code_using_daemon(code_to_format, timeout=None):
     input_as_bytes = isinstance(code_to_format, bytes)
-    write_to_stream, read_from_stream = _connect_to_daemon_process()
-
-    # Ok, if gotten here the daemon process is already live and
-    # answering (and sock is the socket we want to work with).
-    # Ask our code to be formatted now.
-    _write(write_to_stream, code_to_format, [('Operation', 'format')])
-    header, body = _read(read_from_stream, decode=not input_as_bytes)
-    debug('here Result from formatting: %s - %s' % (header, body))
+
+    # Note: the connection to the daemon is kept alive to be reused in
+    # subsequent calls (and is transparently recreated if the daemon
+    # exited in the meanwhile).
+    header, body = _daemon_client.request(
+        code_to_format,
+        [('Operation', 'format'), ('Compare-Input', '1')] + _get_timeout_headers(timeout),
+        decode=not input_as_bytes)
+    if DEBUG:
+        debug('Result from formatting: %s - %s chars/bytes' % (header, len(body)))
     if 'Result' not in header:
         raise RuntimeError('Result not in header. Header:\n%s\nBody:%s\n' % (
             header, body))
 
-    if header['Result'] != 'Ok':
-        raise RuntimeError('%s\n%s' % (header, body))
-    _write(write_to_stream, '', [('Operation', 'exit_client')])
+    _check_result(header, body)
+    if header.get('Unchanged') == '1':
+        # The daemon doesn't send the code back if it was already formatted.
+        return code_to_format
     return body
 
 
-def start_format_server():
+def _is_formatted_using_daemon(code_to_format):
+    '''
+    :return bool:
+        True if the code is already formatted (the daemon only answers whether the
+        code would be changed, without sending the formatted code).
+    '''
+    header, body = _daemon_client.request(
+        code_to_format,
+        [('Operation', 'format'), ('Check-Only', '1')] + _get_timeout_headers())
+    if 'Result' not in header:
+        raise RuntimeError('Result not in header. Header:\n%s\nBody:%s\n' % (
+            header, body))
+
+    _check_result(header, body)
+    if 'Unchanged' not in header:
+        raise RuntimeError('Unchanged not in header. Header:\n%s\n' % (header,))
+    return header['Unchanged'] == '1'
+
+
+def _format_file_using_daemon(path, fsync=False):
+    '''
+    Asks the daemon to format the given file in place (only the path goes through
+    the socket: the daemon reads, formats and rewrites the file if changed).
+
+    The daemon only uses its own result cache (the client tells it which cache it uses
+    so that the daemon refuses the request if it's not the same one).
+
+    :param str path:
+        The file to be formatted.
+
+    :param bool fsync:
+        Whether the file should be flushed to disk before replacing the original.
+
+    :return tuple(bool,str):
+        Whether the file changed and the content hash of its (new) contents.
+
+    :raise _FormatFileNotAllowed:
+        If the daemon doesn't accept files from this connection (i.e.: not connected
+        through a unix socket) or uses a different cache, in which case the contents
+        must be sent instead.
+    '''
+    path = os.path.abspath(path)
+    if isinstance(path, bytes):
+        path = path.decode(sys.getfilesystemencoding())
+
+    # Raises UnicodeEncodeError if the path can't be sent in the headers.
+    path.encode('utf-8')
+
+    headers = [('Operation', 'format_file'), ('Path', path)] + _get_timeout_headers()
+    if fsync:
+        headers.append(('Fsync', '1'))
+    cache = _get_result_cache()
+    if cache is None:
+        headers.append(('No-Cache', '1'))
+    else:
+        headers.append(('Cache-Dir', os.path.abspath(cache.cache_dir)))
+
+    header, body = _daemon_client.request('', headers)
+    if 'Result' not in header:
+        raise RuntimeError('Result not in header. Header:\n%s\nBody:%s\n' % (
+            header, body))
+
+    _check_result(header, body)
+    return header['Changed'] == '1', header['Content-Hash']
+
+
+def format_many_using_daemon(codes_to_format, batch_size=100, timeout=None):
+    '''
+    Formats many code snippets using the daemon (the snippets are sent in batches,
+    so, this is much faster than calling format_code_using_daemon for each one).
+
+    :param iterable(unicode|bytes) codes_to_format:
+        The codes to be formatted.
+
+    :param int batch_size:
+        The maximum number of snippets sent to the daemon in a single request.
+
+    :param float timeout:
+        The timeout (in seconds) for each snippet (see: format_code_using_daemon). A
+        snippet which isn't formatted in time has a timeout error message.
+
+    :return iterable(tuple(unicode|bytes,unicode)):
+        Yields a tuple(formatted_code, error_message) for each code to be formatted
+        (in the same order in which they were given). If the code was formatted
+        error_message is None, otherwise formatted_code is None.
+    '''
+    batch = []
+    for code_to_format in codes_to_format:
+        batch.append(code_to_format)
+        if len(batch) >= batch_size:
+            for result in _format_batch_using_daemon(batch, timeout):
+                yield result
+            batch = []
+
+    if batch:
+        for result in _format_batch_using_daemon(batch, timeout):
+            yield result
+
+
+def _format_batch_using_daemon(batch, timeout=None):
+    contents, additional_headers = _encode_batch(batch)
+    header, body = _daemon_client.request(
+        contents, additional_headers + _get_timeout_headers(timeout), decode=False)
+    return _decode_batch_results(batch, header, body)
+
+
+def _encode_batch(batch):
+    '''
+    :return tuple(bytes,list(tuple(unicode,unicode))):
+        The contents and headers of the format_many message to format the given batch.
+    '''
+    contents = []
+    for code_to_format in batch:
+        if not isinstance(code_to_format, bytes):
+            code_to_format = code_to_format.encode('utf-8')
+        contents.append(code_to_format)
+
+    return b''.join(contents), [
+        ('Operation', 'format_many'),
+        ('Lengths', ','.join(str(len(c)) for c in contents)),
+    ]
+
+
+def _decode_batch_results(batch, header, body):
+    '''
+    :return list(tuple(unicode|bytes,unicode)):
+        The (formatted_code, error_message) for each code in the batch given the
+        answer to the format_many message.
+    '''
+    if header.get('Result') != 'Ok':
+        raise RuntimeError('%s\n%s' % (header, body))
+
+    results = header['Results'].split(',')
+    lengths = [int(x) for x in header['Lengths'].split(',')]
+    assert len(results) == len(lengths) == len(batch)
+
+    ret = []
+    offset = 0
+    for code_to_format, result, length in zip(batch, results, lengths):
+        formatted = body[offset:offset + length]
+        offset += length
+        if result != 'Ok':
+            ret.append((None, formatted.decode('utf-8', errors='replace')))
+        elif isinstance(code_to_format, bytes):
+            ret.append((formatted, None))
+        else:
+            ret.append((formatted.decode('utf-8'), None))
+    return ret
+
+
+def start_format_server(short_lived=False):
     '''
     Starts a format server so that it can be reused among multiple invocations
     (uses the process stdin/stdout to communicate with it).
+
+    The server is supervised: if its java process dies, a new process is started
+    (transparently -- the returned process is still used to refer to the server).
+
+    :param bool short_lived:
+        If True the process is optimized for startup time (instead of throughput).
     '''
     _check_java_in_path()
-    process = _create_process('-multiple')
+    process = _create_process('-multiple', short_lived)
+    with _process_lock:
+        _supervised_processes[process] = _SupervisedProcess(process, short_lived)
 
     return process
 
@@ -192,33 +769,1229 @@ def stop_format_server(process):
     '''
     Stops a given format server.
     '''
-    process.kill()
+    supervised = _supervised_processes.get(process)
+    if supervised is None:
+        process.kill()
+    else:
+        supervised.stop()
 
 
-def format_code_server(process, code_to_format):
+def format_code_server(process, code_to_format, timeout=None):
     '''
     Formats code using a server previously started (which can be used
     among multiple invocations).
 
+    If the java process of the server died (before or while formatting), a new
+    process is started and the code is formatted again (once).
+
     :param unicode code_to_format:
         The code to be formatted.
+
+    :param float timeout:
+        The maximum time (in seconds) to wait for the code to be formatted (including
+        the time waiting for other threads using the same server). If not given uses
+        the PYDEVF_TIMEOUT environment variable (0 means no timeout).
+
+    :raise TimeoutError:
+        If the code wasn't formatted in time (the java process is killed and a new one
+        is started in the next call).
+    '''
+    return _format_code_server(process, code_to_format, _get_deadline(timeout))
+
+
+def _format_code_server(process, code_to_format, deadline=None):
+    debug('Getting lock to format code.')
+    supervised = _supervised_processes.get(process)
+    lock = _get_process_lock(process)
+    _acquire_lock(lock, deadline)
+    try:
+        if supervised is None:
+            return _format_code_in_process(process, code_to_format, deadline)
+        return supervised.format_code(code_to_format, deadline)
+    finally:
+        lock.release()
+
+
+def _acquire_lock(lock, deadline=None):
+    '''
+    :param float|NoneType deadline:
+        The monotonic time until which it may wait for the lock (None to wait forever).
+
+    :raise TimeoutError:
+        If the lock couldn't be acquired until the deadline.
+    '''
+    if deadline is None:
+        lock.acquire()
+        return
+
+    if sys.version_info[0] > 2:
+        acquired = lock.acquire(timeout=max(0, deadline - _monotonic()))
+    else:
+        # Python 2 locks don't accept a timeout.
+        import time
+        while True:
+            acquired = lock.acquire(False)
+            if acquired or _monotonic() >= deadline:
+                break
+            time.sleep(.01)
+
+    if not acquired:
+        raise TimeoutError('Timed out waiting for other threads using the formatter.')
+
+
+_TIMEOUT_ENV_VAR = 'PYDEVF_TIMEOUT'
+
+
+def _get_timeout(timeout=None):
+    '''
+    :return float:
+        The given timeout (in seconds) or the one from the PYDEVF_TIMEOUT environment
+        variable if not given (0 means no timeout).
+    '''
+    return _get_number_option(timeout, _TIMEOUT_ENV_VAR, float)
+
+
+def _get_deadline(timeout=None):
+    '''
+    :return float|NoneType:
+        The monotonic time until which a request may run (None if there's no timeout).
+    '''
+    timeout = _get_timeout(timeout)
+    if not timeout:
+        return None
+    return _monotonic() + timeout
+
+
+def _get_timeout_headers(timeout=None):
+    '''
+    :return list(tuple(unicode,unicode)):
+        The headers with the timeout of a request to the daemon (if no timeout was given
+        nor set in PYDEVF_TIMEOUT the daemon uses its own default).
+    '''
+    if timeout is None and _TIMEOUT_ENV_VAR not in os.environ:
+        return []
+    return [('Timeout', '%s' % (_get_timeout(timeout),))]
+
+
+class _Watchdog(object):
+    '''
+    Calls callbacks when their deadlines expire (a single thread is used for all the
+    deadlines, so, watching a request is cheap).
+    '''
+
+    class _Entry(object):
+
+        def __init__(self, deadline, callback):
+            self.deadline = deadline
+            self.callback = callback
+            self.cancelled = False
+            self.expired = False
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._heap = []
+        self._count = 0
+        self._active = 0
+        self._thread = None
+
+    def watch(self, deadline, callback):
+        '''
+        :param float deadline:
+            The monotonic time at which the callback should be called.
+
+        :return object:
+            The handle to be passed to cancel().
+        '''
+        import heapq
+        entry = self._Entry(deadline, callback)
+        with self._condition:
+            self._count += 1
+            self._active += 1
+            heapq.heappush(self._heap, (deadline, self._count, entry))
+            if len(self._heap) > 2 * self._active + 1000:
+                # Cancelled entries are only removed lazily: compact from time to time.
+                self._heap = [item for item in self._heap if not item[2].cancelled]
+                heapq.heapify(self._heap)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+        return entry
+
+    def cancel(self, entry):
+        '''
+        :return bool:
+            True if the callback was already called (the deadline expired).
+        '''
+        with self._condition:
+            if not entry.cancelled and not entry.expired:
+                entry.cancelled = True
+                self._active -= 1
+            return entry.expired
+
+    def _run(self):
+        import heapq
+        while True:
+            with self._condition:
+                while True:
+                    while self._heap and self._heap[0][2].cancelled:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    timeout = self._heap[0][0] - _monotonic()
+                    if timeout <= 0:
+                        entry = heapq.heappop(self._heap)[2]
+                        entry.expired = True
+                        self._active -= 1
+                        break
+                    self._condition.wait(timeout)
+            try:
+                entry.callback()
+            except Exception:
+                debug_exception('Error on watchdog callback.')
+
+
+_watchdog = _Watchdog()
+
+
+def _kill_process(process):
+    try:
+        process.kill()
+    except OSError:
+        pass
+
+
+class _FormatterProcessDied(RuntimeError):
+    '''
+    Raised when the java process of a format server exited (or its output is broken).
+    '''
+
+
+def _format_code_in_process(process, code_to_format, deadline=None):
+    '''
+    Formats code in the given java process (the process lock must be held).
+
+    :param float|NoneType deadline:
+        If given, the process is killed if the code isn't formatted until then.
+
+    :raise _FormatterProcessDied:
+        If the process exited before answering.
+
+    :raise TimeoutError:
+        If the deadline expired.
+    '''
+    if process.poll() is not None:
+        raise _FormatterProcessDied(
+            'Formatting server process already exited (returncode: %s).' % (
+                process.returncode,))
+
+    watch = None
+    if deadline is not None:
+        if deadline <= _monotonic():
+            raise TimeoutError('Timed out waiting for the formatter.')
+        watch = _watchdog.watch(deadline, partial(_kill_process, process))
+
+    input_as_bytes = isinstance(code_to_format, bytes)
+    error = None
+    try:
+        with _tracing.span('jvm_format'):
+            debug('Writing code to format to server.')
+            _write(process.stdin, code_to_format)
+            debug('Written code to format to server.')
+            header, body = _read(process.stdout, decode=not input_as_bytes)
+        if body is None:
+            error = 'Formatting server process exited while formatting.'
+    except (IOError, OSError, RuntimeError) as e:
+        error = 'Error communicating with formatting server: %s' % (e,)
+    finally:
+        expired = watch is not None and _watchdog.cancel(watch)
+
+    if expired:
+        # Make sure that it's already dead when the error is seen (so that it's
+        # respawned afterwards).
+        process.wait()
+        if error is not None:
+            raise TimeoutError('Timed out formatting code (formatter process killed).')
+    if error is not None:
+        raise _FormatterProcessDied(error)
+    debug('Read formatted code from server.')
+    _check_result(header, body)
+
+    return body
+
+
+# The supervisors of the processes started by start_format_server.
+_supervised_processes = weakref.WeakKeyDictionary()
+
+
+def _get_current_process(process):
+    '''
+    :return subprocess.Popen:
+        The java process currently used by the given server (which is not the same
+        process if it was respawned).
+    '''
+    supervised = _supervised_processes.get(process)
+    if supervised is None:
+        return process
+    return supervised.process
+
+
+def _get_restarts(process):
+    '''
+    :return int:
+        The number of times that the java process of the given server was respawned.
+    '''
+    supervised = _supervised_processes.get(process)
+    if supervised is None:
+        return 0
+    return supervised.restarts
+
+
+class _SupervisedProcess(object):
+    '''
+    Keeps the java process of a format server alive: if the process dies it's replaced
+    by a new one (and the code which was being formatted is formatted again, once).
+
+    Note: the methods which use the process must be called with the lock of the
+    original process held (see: format_code_server).
+    '''
+
+    def __init__(self, process, short_lived):
+        self.process = process
+        self.short_lived = short_lived
+        self.restarts = 0
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    def format_code(self, code_to_format, deadline=None):
+        try:
+            return _format_code_in_process(self.get_live_process(), code_to_format, deadline)
+        except _FormatterProcessDied:
+            debug_exception('Formatter process died (retrying in a new process).')
+        self.respawn()
+        return _format_code_in_process(self.process, code_to_format, deadline)
+
+    def get_live_process(self):
+        '''
+        :return subprocess.Popen:
+            The current process (a new one is started if it exited).
+        '''
+        if self.process.poll() is not None:
+            self.respawn()
+        return self.process
+
+    def respawn(self):
+        '''
+        Stops the current process and replaces it by a new one.
+        '''
+        if self._stopped:
+            raise _FormatterProcessDied('Formatting server was stopped.')
+
+        process = _create_process('-multiple', self.short_lived)
+        with self._lock:
+            if self._stopped:
+                process.kill()
+                raise _FormatterProcessDied('Formatting server was stopped.')
+            old_process = self.process
+            self.process = process
+            self.restarts += 1
+        debug('Formatter process %s replaced by: %s.' % (old_process.pid, process.pid))
+        try:
+            old_process.kill()
+            old_process.wait()
+        except OSError:
+            pass
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            process = self.process
+        process.kill()
+
+
+class _FormatterSyntaxError(RuntimeError):
+    '''
+    Raised when the code can't be formatted because it has a syntax error.
+    '''
+
+
+class _FormatFileNotAllowed(RuntimeError):
+    '''
+    Raised when the daemon refuses to format a file in place (only done for clients of
+    the same user connected through the unix socket).
+    '''
+
+
+def _check_result(header, body):
+    result = header['Result']
+    if result != 'Ok':
+        if result == 'SyntaxError':
+            raise _FormatterSyntaxError('%s\n%s' % (header, body))
+        if result == 'Timeout':
+            raise TimeoutError('%s\n%s' % (header, body))
+        if result == 'NotAllowed':
+            raise _FormatFileNotAllowed('%s\n%s' % (header, body))
+        raise RuntimeError('%s\n%s' % (header, body))
+
+
+def _get_error_result(exception):
+    if isinstance(exception, _FormatterSyntaxError):
+        return 'SyntaxError'
+    if isinstance(exception, TimeoutError):
+        return 'Timeout'
+    return 'Error'
+
+
+# ==================================================================================================
+# Result cache
+# ==================================================================================================
+
+_result_cache_lock = threading.Lock()
+_result_cache = None
+_result_cache_configured = False
+
+
+def _get_formatter_identity():
+    '''
+    :return str:
+        Identifies the formatter (version and jar) so that cached results from a
+        different formatter aren't reused.
+    '''
+    import hashlib
+    st = os.stat(target_jar)
+    identity = '%s|%s|%s' % (__version__, st.st_size, int(st.st_mtime))
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()[:16]
+
+
+def _get_cache_dir(cache_dir=None):
+    if not cache_dir:
+        from . import _cache
+        cache_dir = os.environ.get('PYDEVF_CACHE_DIR') or _cache.get_user_cache_dir()
+    return cache_dir
+
+
+def _load_file_index(cache_dir=None):
+    '''
+    :return _cache.FileIndex:
+        The index with the stat of files previously formatted (with the current formatter).
+    '''
+    from . import _cache
+    index_path = os.path.join(
+        _get_cache_dir(cache_dir), 'index', '%s.json' % (_get_formatter_identity(),))
+    return _cache.FileIndex(index_path).load()
+
+
+def _configure_result_cache(enabled=None, cache_dir=None, max_size=None):
+    '''
+    Configures the cache of formatting results used by format_code, format_code_using_daemon
+    and by the command line.
+
+    :param bool enabled:
+        Whether results should be cached (if None uses the PYDEVF_CACHE environment
+        variable -- enabled unless it's '0' or 'false').
+
+    :param str cache_dir:
+        The directory for the cache (if None uses the PYDEVF_CACHE_DIR environment
+        variable or the default cache dir for the user).
+
+    :param int max_size:
+        The maximum size of the cache in bytes (if None uses the PYDEVF_CACHE_MAX_SIZE
+        environment variable with the size in megabytes or 200 MB).
+    '''
+    global _result_cache
+    global _result_cache_configured
+    from . import _cache
+
+    if enabled is None:
+        enabled = os.environ.get('PYDEVF_CACHE', '1').lower() not in ('0', 'false')
+
+    cache = None
+    if enabled:
+        cache_dir = _get_cache_dir(cache_dir)
+
+        if max_size is None:
+            try:
+                max_size = int(os.environ.get('PYDEVF_CACHE_MAX_SIZE', '0')) * 1024 * 1024
+            except ValueError:
+                max_size = 0
+            if max_size <= 0:
+                max_size = _cache.DEFAULT_MAX_SIZE
+
+        cache = _cache.ResultCache(cache_dir, _get_formatter_identity(), max_size)
+
+    with _result_cache_lock:
+        _result_cache = cache
+        _result_cache_configured = True
+
+
+def _get_result_cache():
+    '''
+    :return _cache.ResultCache|NoneType:
+        The cache for formatting results or None if disabled.
+    '''
+    if not _result_cache_configured:
+        _configure_result_cache()
+    return _result_cache
+
+
+def _format_using_cache(format_func, code_to_format):
+    '''
+    Formats the given code with format_func if the result for it isn't cached
+    (also caches the results, including syntax errors, when format_func is called).
+
+    Note: format_func must accept bytes (text is encoded to compute its hash and the
+    encoded contents are formatted).
+    '''
+    return _format_using_result_cache(_get_result_cache(), format_func, code_to_format)
+
+
+def _format_using_result_cache(cache, format_func, code_to_format):
+    if cache is None:
+        return format_func(code_to_format)
+
+    from . import _cache
+
+    input_as_bytes = isinstance(code_to_format, bytes)
+    if input_as_bytes:
+        contents = code_to_format
+    else:
+        contents = code_to_format.encode('utf-8')
+
+    content_hash = _cache.compute_content_hash(contents)
+    cached = cache.get(content_hash)
+    if cached is not None:
+        marker, data = cached
+        if marker == _cache.ALREADY_FORMATTED:
+            return code_to_format
+
+        if marker == _cache.FORMATTED:
+            if input_as_bytes:
+                return data
+            return data.decode('utf-8')
+
+        if marker == _cache.SYNTAX_ERROR:
+            raise _FormatterSyntaxError(data.decode('utf-8', errors='replace'))
+
+    try:
+        # Note: the contents are already encoded (so, format as bytes and just decode
+        # the result if the input was text).
+        formatted = format_func(contents)
+    except _FormatterSyntaxError as e:
+        cache.put(content_hash, _cache.SYNTAX_ERROR, ('%s' % (e,)).encode('utf-8'))
+        raise
+
+    cache.put_result(content_hash, contents, formatted)
+    if input_as_bytes:
+        return formatted
+    if formatted == contents:
+        return code_to_format
+    return formatted.decode('utf-8')
+
+
+def _is_formatted_using_cache(is_formatted_func, code_to_format):
+    '''
+    Checks whether the given code is already formatted with is_formatted_func if
+    that isn't known from the cache (is_formatted_func must accept bytes).
+    '''
+    cache = _get_result_cache()
+    if cache is None:
+        return is_formatted_func(code_to_format)
+
+    from . import _cache
+
+    if isinstance(code_to_format, bytes):
+        contents = code_to_format
+    else:
+        contents = code_to_format.encode('utf-8')
+
+    content_hash = _cache.compute_content_hash(contents)
+    cached = cache.get(content_hash)
+    if cached is not None:
+        marker, data = cached
+        if marker == _cache.ALREADY_FORMATTED:
+            return True
+
+        if marker == _cache.FORMATTED:
+            return False
+
+        if marker == _cache.SYNTAX_ERROR:
+            raise _FormatterSyntaxError(data.decode('utf-8', errors='replace'))
+
+    try:
+        is_formatted = is_formatted_func(contents)
+    except _FormatterSyntaxError as e:
+        cache.put(content_hash, _cache.SYNTAX_ERROR, ('%s' % (e,)).encode('utf-8'))
+        raise
+
+    if is_formatted:
+        # Note: when not formatted the formatted contents aren't available to be cached.
+        cache.put(content_hash, _cache.ALREADY_FORMATTED)
+    return is_formatted
+
+# ==================================================================================================
+# End result cache
+# ==================================================================================================
+
+
+def _get_process_lock(process):
+    '''
+    :return threading.Lock:
+        The lock which must be held while communicating with the given process (each
+        process has its own lock so that different processes may be used in parallel).
+    '''
+    with _process_lock:
+        lock = _process_locks.get(process)
+        if lock is None:
+            lock = _process_locks[process] = threading.Lock()
+        return lock
+
+
+# ==================================================================================================
+# Daemon worker pool
+# ==================================================================================================
+
+def _get_cpu_count():
+    import multiprocessing
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def _get_workers_count(workers=None):
+    if not workers:
+        try:
+            workers = int(os.environ.get('PYDEVF_WORKERS', '0'))
+        except ValueError:
+            workers = 0
+
+    if not workers:
+        workers = _get_cpu_count()
+    return max(1, workers)
+
+
+# Number of times that the warm-up corpus is formatted by each daemon worker.
+_DEFAULT_WARMUP_ROUNDS = 50
+
+
+def _get_number_option(value, env_var, convert=int, default=0):
+    '''
+    :return int|float:
+        The given value or (if None) the value from the given environment variable
+        (negative values are considered 0).
+    '''
+    if value is None:
+        try:
+            value = convert(os.environ.get(env_var, default))
+        except ValueError:
+            value = default
+    return max(0, value)
+
+
+def _get_warmup_rounds(warmup=None):
+    return _get_number_option(warmup, 'PYDEVF_WARMUP', default=_DEFAULT_WARMUP_ROUNDS)
+
+
+def _iter_warmup_snippets(warmup_rounds):
+    from ._warmup_corpus import CORPUS
+    for _ in range(warmup_rounds):
+        for code in CORPUS:
+            yield code
+
+
+# The workers check whether their process must be respawned (if it died) or recycled
+# at this interval (in seconds) even if there are no requests.
+_MAINTENANCE_INTERVAL = 1.0
+
+# The RSS of a worker process is checked at most once in this interval (in seconds).
+_RSS_CHECK_INTERVAL = 1.0
+
+# If it wasn't possible to start a replacement process, wait this long (in seconds)
+# before trying again.
+_RECYCLE_RETRY_INTERVAL = 60.0
+
+
+def _get_process_rss(pid):
+    '''
+    :return int|NoneType:
+        The resident set size (in bytes) of the given process or None if it can't be
+        determined (only available on Linux).
+    '''
+    try:
+        with open('/proc/%s/statm' % (pid,), 'rb') as stream:
+            pages = int(stream.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class _FormatTask(object):
+
+    def __init__(self, code_to_format, on_done=None, timeout=0):
+        self.code_to_format = code_to_format
+        self.on_done = on_done
+        self.result = None
+        self.exception = None
+        self.error = None
+        self.event = threading.Event()
+        self.submit_time = _monotonic()
+        self.start_time = None
+        self.trace_id = _tracing.get_request_id() if _tracing.enabled else None
+        # Note: the time waiting in the queue also counts for the timeout.
+        self.deadline = self.submit_time + timeout if timeout else None
+        # Watches the deadline while the task is in the queue (see: _WorkerPool.submit).
+        self.watch = None
+        self._lock = threading.Lock()
+        self._started = False
+        self._expired = False
+
+    def start(self):
+        '''
+        Called when a worker gets the task from the queue.
+
+        :return bool:
+            False if the task already expired while waiting in the queue (in which
+            case it was already finished and must be skipped).
+        '''
+        with self._lock:
+            if self._expired:
+                return False
+            self._started = True
+            self.start_time = _monotonic()
+            return True
+
+    def expire(self):
+        '''
+        Fails the task with a TimeoutError if it's still waiting in the queue.
+
+        :return bool:
+            True if the task expired (False if a worker already started it, in which
+            case the formatter process is killed if it doesn't finish in time).
+        '''
+        with self._lock:
+            if self._started:
+                return False
+            self._expired = True
+            self.start_time = _monotonic()
+        self.exception = TimeoutError('Timed out waiting in the queue for a formatter.')
+        self.error = '%s' % (self.exception,)
+        return True
+
+
+class _ReplacementProcess(threading.Thread):
+    '''
+    Starts (and warms up) a java process which will replace the process of a worker
+    (the worker keeps answering requests with its current process meanwhile).
+    '''
+
+    def __init__(self, pool):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._pool = pool
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self.process = None
+        self.start_time = _monotonic()
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            process = start_format_server(self._pool.short_lived)
+        except Exception:
+            debug_exception('Error starting replacement process.')
+            self.done.set()
+            return
+
+        with self._lock:
+            if self._cancelled:
+                stop_format_server(process)
+                self.done.set()
+                return
+            self.process = process
+
+        for code in _iter_warmup_snippets(self._pool.warmup_rounds):
+            if self._cancelled:
+                break
+            try:
+                _format_code_server(process, code)
+            except _FormatterSyntaxError:
+                pass  # Expected (the corpus has code with syntax errors).
+            except Exception:
+                debug_exception('Error warming up replacement process.')
+                self.cancel()
+                break
+        self.done.set()
+
+    def cancel(self):
+        '''
+        Stops the replacement process (if it was already started) or makes sure it's
+        stopped as soon as it's started.
+        '''
+        with self._lock:
+            self._cancelled = True
+            process = self.process
+            self.process = None
+        if process is not None:
+            stop_format_server(process)
+
+
+class _Worker(threading.Thread):
+    '''
+    A thread which owns a java formatter process and formats the tasks gotten from
+    the pool queue.
+
+    If the pool has warm-up rounds, the warm-up corpus is formatted while there are
+    no tasks in the queue (so, requests may be answered while warming up, but they
+    may have to wait for a warm-up snippet to be formatted).
+
+    If the process dies, it's respawned (while idle, it's checked periodically; while
+    formatting, the task is retried once in the new process -- see: _SupervisedProcess).
+
+    If the pool has a maximum number of requests or a maximum RSS per process, the
+    process is recycled when it goes over it: a replacement process is started (and
+    warmed up) in the background and the current process is only stopped after the
+    replacement is ready (it's swapped between tasks, so, no request is lost).
+    '''
+
+    def __init__(self, pool):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._pool = pool
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._replacement = None
+        self._next_rss_check = 0
+        self._next_recycle = 0
+        self.start_time = _monotonic()
+        self.process = start_format_server(pool.short_lived)
+        self.ready_time = _monotonic()
+        self.process_start_time = self.start_time
+        self.process_requests = 0
+        self.recycles = 0
+        self._previous_restarts = 0
+        self.warmup_snippets = 0
+        self.warmup_time = 0.0
+        self.warmed_up = pool.warmup_rounds == 0
+        self.requests = 0
+        self.first_request_time = None
+
+    def run(self):
+        pool = self._pool
+        warmup_snippets = None
+        if not self.warmed_up:
+            warmup_snippets = _iter_warmup_snippets(pool.warmup_rounds)
+        while True:
+            if warmup_snippets is not None:
+                try:
+                    task = pool._get_task(block=False)
+                except Empty:
+                    self._warm_up(warmup_snippets)
+                    if self.warmed_up:
+                        warmup_snippets = None
+                        pool._on_warmed_up()
+                    continue
+            else:
+                try:
+                    task = pool._get_task(timeout=_MAINTENANCE_INTERVAL)
+                except Empty:
+                    self._maintain()
+                    continue
+
+            if task is None:
+                return
+            if not task.start():
+                continue  # Expired while waiting in the queue (already answered).
+            initial_time = task.start_time
+            if _tracing.enabled:
+                _tracing.record(
+                    'queue_wait', task.submit_time, initial_time, request_id=task.trace_id)
+            try:
+                with _tracing.request_context(task.trace_id):
+                    task.result = _format_code_server(
+                        self.process, task.code_to_format, task.deadline)
+            except Exception as e:
+                debug_exception()
+                task.exception = e
+                task.error = _get_traceback_as_text()
+            if self.first_request_time is None:
+                self.first_request_time = _monotonic() - initial_time
+            self.requests += 1
+            self.process_requests += 1
+            pool._finish_task(task)
+            self._maintain()
+
+    def _warm_up(self, warmup_snippets):
+        code = next(warmup_snippets, None)
+        if code is None:
+            debug('Worker warmed up (%s snippets in %.2fs).' % (
+                self.warmup_snippets, self.warmup_time))
+            self.warmed_up = True
+            return
+        initial_time = _monotonic()
+        try:
+            _format_code_server(self.process, code)
+        except _FormatterSyntaxError:
+            pass  # Expected (the corpus has code with syntax errors).
+        except Exception:
+            debug_exception('Error warming up worker.')
+            self.warmed_up = True
+            return
+        self.warmup_time += _monotonic() - initial_time
+        self.warmup_snippets += 1
+
+    def _get_recycle_reason(self):
+        '''
+        :return unicode|NoneType:
+            The reason why the process must be recycled or None if it shouldn't be
+            recycled.
+        '''
+        pool = self._pool
+        if pool.max_requests and self.process_requests >= pool.max_requests:
+            return '%s requests' % (self.process_requests,)
+
+        if pool.max_rss:
+            now = _monotonic()
+            if now >= self._next_rss_check:
+                self._next_rss_check = now + _RSS_CHECK_INTERVAL
+                rss = _get_process_rss(_get_current_process(self.process).pid)
+                if rss is not None and rss > pool.max_rss:
+                    return 'rss: %.1f MB' % (rss / (1024. * 1024.),)
+        return None
+
+    def _maintain(self):
+        '''
+        Respawns the process if it died, starts a replacement for the process if it
+        must be recycled and swaps it for the current process when it's ready (only
+        called between tasks).
+        '''
+        supervised = _supervised_processes.get(self.process)
+        if supervised is not None and supervised.process.poll() is not None:
+            debug('Worker process %s exited: respawning.' % (supervised.process.pid,))
+            try:
+                with _get_process_lock(self.process):
+                    supervised.get_live_process()
+            except Exception:
+                debug_exception('Error respawning worker process.')
+
+        replacement = self._replacement
+        if replacement is not None:
+            if replacement.done.is_set():
+                self._replacement = None
+                self._swap_process(replacement)
+            return
+
+        if _monotonic() < self._next_recycle:
+            return
+        reason = self._get_recycle_reason()
+        if reason is not None:
+            debug('Recycling worker process: %s (%s).' % (self.process.pid, reason))
+            with self._lock:
+                if self._stopped:
+                    return
+                self._replacement = _ReplacementProcess(self._pool)
+                self._replacement.start()
+
+    def _swap_process(self, replacement):
+        with self._lock:
+            new_process = replacement.process
+            if new_process is None or self._stopped:
+                debug('Unable to recycle worker process: %s.' % (self.process.pid,))
+                self._next_recycle = _monotonic() + _RECYCLE_RETRY_INTERVAL
+                return
+            old_process = self.process
+            self.process = new_process
+            self.process_start_time = replacement.start_time
+            self.process_requests = 0
+            self.recycles += 1
+            self._previous_restarts += _get_restarts(old_process)
+        debug('Worker process %s replaced by: %s.' % (old_process.pid, new_process.pid))
+        stop_format_server(old_process)
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            replacement = self._replacement
+            process = self.process
+        if replacement is not None:
+            replacement.cancel()
+        stop_format_server(process)
+
+    def get_stats(self):
+        now = _monotonic()
+        process = self.process
+        restarts = self._previous_restarts + _get_restarts(process)
+        process = _get_current_process(process)
+        return {
+            'pid': process.pid,
+            'uptime': now - self.start_time,
+            'startup_time': self.ready_time - self.start_time,
+            'warmed_up': self.warmed_up,
+            'warmup_snippets': self.warmup_snippets,
+            'warmup_time': self.warmup_time,
+            'requests': self.requests,
+            'first_request_time': self.first_request_time,
+            'process_uptime': now - self.process_start_time,
+            'process_requests': self.process_requests,
+            'rss': _get_process_rss(process.pid),
+            'recycles': self.recycles,
+            'restarts': restarts,
+            'recycling': self._replacement is not None,
+        }
+
+
+class _WorkerPool(object):
+    '''
+    Manages the java processes used by the daemon.
+
+    Starts with a single process and lazily spawns new ones (up to max_workers) when
+    there are more tasks pending than idle workers.
+
+    When short_lived is True, the processes are optimized for startup time (used
+    when the pool only lives for a single command line invocation).
+
+    Each worker formats the warm-up corpus warmup_rounds times after it's started
+    (while there's nothing else to do).
+
+    The process of a worker is recycled after it formats max_requests snippets or
+    when its RSS goes over max_rss bytes (0 means no limit).
+
+    A task which isn't finished in timeout seconds (including the time waiting in the
+    queue) fails with a TimeoutError (if it was being formatted, the java process is
+    killed and respawned). 0 means no timeout.
     '''
-    debug('Getting lock to format code.')
-    with _process_lock:
-        if process.returncode is not None:
-            raise RuntimeError('Formatting server process already exited. Output: %s' % (
-                process.communicate(),))
-
-        input_as_bytes = isinstance(code_to_format, bytes)
-        debug('Writing code to format to server.')
-        _write(process.stdin, code_to_format)
-        debug('Written code to format to server.')
-        header, body = _read(process.stdout, decode=not input_as_bytes)
-        debug('Read formatted code from server.')
-        if header['Result'] != 'Ok':
-            raise RuntimeError('%s\n%s' % (header, body))
 
-    return body
+    def __init__(self, max_workers, short_lived=False, warmup_rounds=0, max_requests=0,
+                 max_rss=0, timeout=0):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        from . import _metrics
+        self.metrics = _metrics.Metrics()
+        self.short_lived = short_lived
+        self.warmup_rounds = warmup_rounds
+        self.max_requests = max_requests
+        self.max_rss = max_rss
+        self.start_time = _monotonic()
+        self.first_request_latency = None
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._workers = []
+        self._idle = 0
+        self._warming = 0
+        self._pending = 0
+        self._active = 0
+        self._requests_in_progress = 0
+        self._exiting = False
+        self._last_activity = self.start_time
+
+    def start(self):
+        with self._lock:
+            self._add_worker()
+
+    def _add_worker(self):
+        # Note: must be called with the lock held.
+        debug('Starting worker %s of %s.' % (len(self._workers) + 1, self.max_workers))
+        worker = _Worker(self)
+        self._workers.append(worker)
+        if not worker.warmed_up:
+            self._warming += 1
+        worker.start()
+
+    def _get_task(self, block=True, timeout=None):
+        '''
+        :raise Empty:
+            If block is False (or the timeout elapsed) and there's no task available.
+        '''
+        with self._lock:
+            self._idle += 1
+        try:
+            task = self._queue.get(block, timeout)
+        finally:
+            with self._lock:
+                self._idle -= 1
+        if task is not None:
+            with self._lock:
+                self._pending -= 1
+        return task
+
+    def _on_warmed_up(self):
+        with self._lock:
+            self._warming -= 1
+
+    def _finish_task(self, task):
+        if task.watch is not None:
+            _watchdog.cancel(task.watch)
+        self._on_task_done(task)
+        task.event.set()
+        if task.on_done is not None:
+            task.on_done(task)
+
+    def _expire_task(self, task):
+        # Called by the watchdog when the deadline of a task expires.
+        if task.expire():
+            debug('Task expired while waiting in the queue.')
+            self._finish_task(task)
+
+    def _on_task_done(self, task):
+        now = _monotonic()
+        if self.first_request_latency is None:
+            self.first_request_latency = now - task.submit_time
+        with self._lock:
+            self._active -= 1
+            self._last_activity = now
+        metrics = self.metrics
+        metrics.observe('queue_wait', task.start_time - task.submit_time)
+        metrics.observe('format', now - task.start_time)
+        if task.exception is not None:
+            metrics.on_error(_get_error_result(task.exception))
+
+    def get_idle_time(self):
+        '''
+        :return float:
+            The time (in seconds) since the last task or request was finished (0 if some
+            task is still pending or some request is being received/handled).
+        '''
+        with self._lock:
+            if self._active or self._requests_in_progress:
+                return 0.0
+            return _monotonic() - self._last_activity
+
+    def begin_request(self):
+        '''
+        Called when a connection starts receiving a request (so that the daemon doesn't
+        exit while it's received and handled).
+
+        :return bool:
+            False if the daemon is exiting (in which case the request must not be
+            handled).
+        '''
+        with self._lock:
+            if self._exiting:
+                return False
+            self._requests_in_progress += 1
+            self._last_activity = _monotonic()
+            return True
+
+    def end_request(self):
+        with self._lock:
+            self._requests_in_progress -= 1
+            self._last_activity = _monotonic()
+
+    def start_exit_if_idle(self, idle_timeout):
+        '''
+        Atomically checks whether the pool is idle and, if it is, refuses new requests
+        from then on (so, nothing is in flight when the daemon exits).
+
+        :return bool:
+            True if there was no task nor request in progress for idle_timeout seconds.
+        '''
+        with self._lock:
+            if self._active or self._requests_in_progress:
+                return False
+            if _monotonic() - self._last_activity < idle_timeout:
+                return False
+            self._exiting = True
+            return True
+
+    def is_exiting(self):
+        with self._lock:
+            return self._exiting
+
+    def get_stats(self):
+        '''
+        :return dict:
+            Information on the pool and its workers (times in seconds).
+        '''
+        with self._lock:
+            workers = self._workers[:]
+            pending = self._pending
+        workers_stats = [worker.get_stats() for worker in workers]
+        stats = self.metrics.get_stats()
+        stats.update({
+            'uptime': _monotonic() - self.start_time,
+            'max_workers': self.max_workers,
+            'pending': pending,
+            'idle_time': self.get_idle_time(),
+            'warmup_rounds': self.warmup_rounds,
+            'max_requests': self.max_requests,
+            'max_rss': self.max_rss,
+            'timeout': self.timeout,
+            'first_request_latency': self.first_request_latency,
+            'restarts': sum(worker_stats['restarts'] for worker_stats in workers_stats),
+            'workers': workers_stats,
+        })
+        return stats
+
+    def submit(self, code_to_format, on_done=None, timeout=None):
+        '''
+        Schedules the given code to be formatted in one of the available workers.
+
+        :param callable on_done:
+            If given, it's called with the task (in the worker thread) when finished.
+
+        :param float timeout:
+            The timeout for the task (if not given, the timeout of the pool is used).
+
+        :return _FormatTask:
+            The task whose event is set when the code is formatted.
+        '''
+        if timeout is None:
+            timeout = self.timeout
+        task = _FormatTask(code_to_format, on_done, timeout)
+        with self._lock:
+            self._pending += 1
+            self._active += 1
+            self._last_activity = task.submit_time
+            # Note: a worker which is warming up is also considered available (it
+            # gets the task as soon as the current warm-up snippet is formatted).
+            available = self._idle + self._warming
+            if self._pending > available and len(self._workers) < self.max_workers:
+                self._add_worker()
+        if task.deadline is not None:
+            # So that the task doesn't wait in the queue (i.e.: behind a task which is
+            # stuck) for longer than its timeout.
+            task.watch = _watchdog.watch(task.deadline, partial(self._expire_task, task))
+        self._queue.put(task)
+        return task
+
+    def format_code(self, code_to_format, timeout=None):
+        '''
+        Formats the given code in one of the available workers (blocks until it's
+        formatted).
+
+        :raise RuntimeError:
+            If it was not possible to format the code.
+
+        :raise TimeoutError:
+            If the code wasn't formatted in time.
+        '''
+        task = self.submit(code_to_format, timeout=timeout)
+        task.event.wait()
+        if task.exception is not None:
+            raise task.exception
+        return task.result
+
+    def stop(self):
+        with self._lock:
+            workers = self._workers[:]
+        for worker in workers:
+            self._queue.put(None)
+            worker.stop()
+
+
+def _get_traceback_as_text():
+    if sys.version_info[0] < 3:
+        from StringIO import StringIO
+    else:
+        from io import StringIO
+    import traceback
+    s = StringIO()
+    traceback.print_exc(file=s)
+    v = s.getvalue()
+    if isinstance(v, bytes):
+        v = v.decode('utf-8', errors='replace')
+    return v
 
 
 class Null:
@@ -306,6 +2079,7 @@ def check_valid_mutex_name(mutex_name):
     # To be windows/linux compatible we can't use non-valid filesystem names
     # (as on linux it's a file-based lock).
 
+    import re
     regexp = re.compile(r'[\*\?"<>|/\\:]')
     result = regexp.findall(mutex_name)
     if result is not None and len(result) > 0:
@@ -328,7 +2102,7 @@ if sys.platform == 'win32':
                 # Ok, mutex gotten (no exception raised). Go on and start the
                 # server (which should return the port).
                 port = on_create_server()
-                os.write(handle, str(port).encode('ascii'))
+                os.write(handle, _format_address(port).encode('utf-8'))
                 os.lseek(handle, 0, os.SEEK_SET)
                 os.fsync(handle)
                 self._port = port
@@ -346,7 +2120,7 @@ if sys.platform == 'win32':
                     with io.open(filename, 'rb') as stream:
                         contents = stream.read().strip()
                         try:
-                            self._port = int(contents)
+                            self._port = _parse_address(contents)
                         except ValueError:
                             time.sleep(.1)
                             continue
@@ -369,6 +2143,7 @@ if sys.platform == 'win32':
                         try:
                             os.close(handle)
                         except Exception:
+                            import traceback
                             traceback.print_exc()
                         try:
                             # Removing is optional as we'll try to remove on startup anyways (but
@@ -415,7 +2190,8 @@ else:  # Linux
                 # Ok, mutex gotten (no exception raised). Go on and start the
                 # server (which should return the port).
                 port = on_create_server()
-                handle.write(str(port).encode('ascii'))
+                handle.write(_format_address(port).encode('utf-8'))
+                handle.truncate()
                 handle.flush()
                 self._port = port
 
@@ -426,7 +2202,7 @@ else:  # Linux
                     with io.open(filename, 'rb') as stream:
                         contents = stream.read()
                         try:
-                            self._port = int(contents.strip())
+                            self._port = _parse_address(contents)
                             break
                         except ValueError:
                             import time
@@ -450,15 +2226,17 @@ else:  # Linux
                         release_mutex.called = True
                         # Clear data on file before releasing lock.
                         handle.seek(0)
-                        handle.write(b' ' * 100)
+                        handle.truncate()
                         handle.flush()
                         try:
                             fcntl.flock(handle, fcntl.LOCK_UN)
                         except Exception:
+                            import traceback
                             traceback.print_exc()
                         try:
                             handle.close()
                         except Exception:
+                            import traceback
                             traceback.print_exc()
                         try:
                             # Removing is pretty much optional (but let's do it to keep the
@@ -515,38 +2293,40 @@ DEBUG = os.getenv('DEBUG_PYDEVF', 'False') in ('1', 'True', 'true')
 DEBUG_FILE = os.path.join(os.path.dirname(__file__), '__debug_output__.txt')
 
 
+_debug_stream = None
+
+
+def _get_debug_stream():
+    '''
+    :return file-like:
+        The (binary) stream to DEBUG_FILE (kept open instead of being opened for each
+        message). Must be called with the _debug_lock held.
+    '''
+    global _debug_stream
+    if _debug_stream is None or _debug_stream.name != DEBUG_FILE:
+        if _debug_stream is not None:
+            _debug_stream.close()
+        _debug_stream = open(DEBUG_FILE, 'ab')
+    return _debug_stream
+
+
 def debug(msg):
     if DEBUG:
+        if not isinstance(msg, bytes):
+            msg = msg.encode('utf-8')
+        if not msg.endswith(b'\r') and not msg.endswith(b'\n'):
+            msg += b'\n'
         with _debug_lock:
-            _pid_prefix = _pid_msg
-            if isinstance(msg, bytes):
-                _pid_prefix = _pid_prefix.encode('utf-8')
-
-                if not msg.endswith(b'\r') and not msg.endswith(b'\n'):
-                    msg += b'\n'
-                mode = 'a+b'
-            else:
-                if not msg.endswith('\r') and not msg.endswith('\n'):
-                    msg += '\n'
-                mode = 'a+'
-            with open(DEBUG_FILE, mode) as stream:
-                stream.write(_pid_prefix)
-                stream.write(msg)
+            stream = _get_debug_stream()
+            stream.write(_pid_msg.encode('utf-8') + msg)
+            stream.flush()
 
 
 def debug_exception(msg=None):
     if DEBUG:
         if msg:
             debug(msg)
-
-        with _debug_lock:
-            with open(DEBUG_FILE, 'a+') as stream:
-                _pid_prefix = _pid_msg
-                if isinstance(msg, bytes):
-                    _pid_prefix = _pid_prefix.encode('utf-8')
-                stream.write(_pid_prefix)
-
-                traceback.print_exc(file=stream)
+        debug(_get_traceback_as_text())
 
 #===================================================================================================
 # End debug helpers
@@ -559,47 +2339,97 @@ def _read(stream, decode=True):
     :return tuple(dict,unicode):
         Returns the header and message read.
     '''
-    try:
-        headers = {}
-        while True:
-            # Interpret the http protocol headers
-            line = stream.readline()  # The trailing \r\n should be there.
-            if DEBUG:
-                debug('Read: %s' % (line,))
-
-            if not line:  # EOF
-                return headers, None
-            line = line.strip().decode('ascii')
-            if not line:  # Read just a new line without any contents
-                break
-            try:
-                name, value = line.split(': ', 1)
-            except ValueError:
-                raise RuntimeError('Invalid header line: {}.'.format(line))
-            headers[name] = value
-
-        if not headers:
-            raise RuntimeError('Got message without headers.')
-
-        size = int(headers['Content-Length'])
-        if size == 0:
-            if decode:
-                body = ''
+    # Note: on a server the span also includes the time waiting for the message.
+    with _tracing.span('read'):
+        try:
+            headers = {}
+            while True:
+                # Interpret the http protocol headers
+                line = stream.readline()  # The trailing \r\n should be there.
+                if not line:  # EOF
+                    return headers, None
+                if not _parse_header_line(line, headers):
+                    break
+
+            if not headers:
+                raise RuntimeError('Got message without headers.')
+
+            size = int(headers['Content-Length'])
+            if size == 0:
+                if decode:
+                    body = ''
+                else:
+                    body = b''
+            elif decode:
+                # Get the actual contents to be formatted (decoded directly from the
+                # buffer where it's read).
+                body = _read_body_into_buffer(stream, size).decode('utf-8')
             else:
-                body = b''
-        else:
-            # Get the actual contents to be formatted.
-            body = stream.read(size)
-            if decode:
-                body = body.decode('utf-8')
-    except Exception:
-        debug_exception()
-        raise
+                # Note: the buffered stream already reads directly into the returned bytes.
+                body = stream.read(size)
+                if len(body) != size:
+                    raise RuntimeError(
+                        'Expected to read %s bytes. Found: %s (EOF).' % (size, len(body)))
+        except Exception:
+            debug_exception()
+            raise
     if DEBUG:
-        debug('Read: header: %s\nbody: %s' % (headers, body))
+        debug('Read: header: %s\nbody: %s bytes' % (headers, len(body)))
     return headers, body
 
 
+def _read_body_into_buffer(stream, size):
+    '''
+    :return bytearray|bytes:
+        The next `size` bytes in the stream (read into a buffer preallocated with the
+        expected size).
+    '''
+    readinto = getattr(stream, 'readinto', None)
+    if readinto is None:
+        # i.e.: socket files in python 2.
+        body = stream.read(size)
+        pos = len(body)
+    else:
+        body = bytearray(size)
+        view = memoryview(body)
+        pos = 0
+        while pos < size:
+            n = readinto(view[pos:])
+            if not n:
+                break
+            pos += n
+
+    if pos != size:
+        raise RuntimeError('Expected to read %s bytes. Found: %s (EOF).' % (size, pos))
+    return body
+
+
+def _parse_header_line(line, headers):
+    '''
+    :param bytes line:
+        The header line read.
+
+    :param dict headers:
+        The headers where the header in the line should be added.
+
+    :return bool:
+        False if the line is the empty line which signals the end of the headers.
+    '''
+    line = line.strip().decode('utf-8')
+    if not line:  # Read just a new line without any contents
+        return False
+    try:
+        name, value = line.split(': ', 1)
+    except ValueError:
+        raise RuntimeError('Invalid header line: {}.'.format(line))
+    headers[name] = value
+    return True
+
+
+# Messages up to this size are copied to a single buffer along with the header.
+_COALESCE_MAX_SIZE = 64 * 1024
+
+
 def _write(stream, msg, additional_headers=None):
     '''
     Writes a message (using an http-like protocol where we write the headers
@@ -610,379 +2440,889 @@ def _write(stream, msg, additional_headers=None):
     :param unicode msg:
     :param list(tuple(unicode,unicode)) additional_headers:
     '''
-    with _write_lock:
-        if DEBUG:
-            debug('Write: %s - additional_headers: %s' % (msg, additional_headers))
+    if DEBUG:
+        debug('Write: %s chars/bytes - additional_headers: %s' % (len(msg), additional_headers))
 
-        if isinstance(msg, bytes):
-            as_bytes = msg
+    header, as_bytes = _encode_message(msg, additional_headers)
+    with _tracing.span('write'), _get_stream_lock(stream):
+        if len(as_bytes) <= _COALESCE_MAX_SIZE:
+            # The whole frame is written at once (so, it's sent in a single syscall).
+            stream.write(header + as_bytes)
         else:
-            as_bytes = msg.encode(encoding='utf_8', errors='strict')
-        header = 'Content-Length: %s\r\n' % (len(as_bytes),)
-        stream.write(header.encode(encoding='utf_8', errors='strict'))
-        if additional_headers:
-            for header, val in additional_headers:
+            # Big messages aren't copied just to add the header (a single flush
+            # is still done in the end).
+            stream.write(header)
+            stream.write(as_bytes)
+        stream.flush()
 
-                header = header.replace('\r', '\\r')
-                header = header.replace('\n', '\\n')
 
-                val = val.replace('\r', '\\r')
-                val = val.replace('\n', '\\n')
+def _get_stream_lock(stream):
+    '''
+    :return threading.Lock:
+        The lock which must be held while writing to the given stream (writes to
+        different streams don't block each other).
+    '''
+    with _stream_locks_lock:
+        try:
+            lock = _stream_locks.get(stream)
+            if lock is None:
+                lock = _stream_locks[stream] = threading.Lock()
+        except TypeError:
+            # Not weak-referenceable (i.e.: socket files in python 2).
+            return _write_lock
+        return lock
 
-                stream.write(header.encode('ascii'))
-                stream.write(': '.encode('ascii'))
-                stream.write(val.encode('utf-8', errors='strict'))
-                stream.write('\r\n'.encode('ascii'))
 
-        stream.write('\r\n'.encode('ascii'))
-        stream.flush()
-        stream.write(as_bytes)
-        stream.flush()
+def _encode_message(msg, additional_headers=None):
+    '''
+    :return tuple(bytes,bytes):
+        The header (including the empty line which ends it) and the contents of the message.
+    '''
+    if isinstance(msg, bytes):
+        as_bytes = msg
+    else:
+        as_bytes = msg.encode(encoding='utf_8', errors='strict')
+    header = ['Content-Length: %s\r\n' % (len(as_bytes),)]
+    if additional_headers:
+        for name, val in additional_headers:
+
+            name = name.replace('\r', '\\r')
+            name = name.replace('\n', '\\n')
+
+            val = val.replace('\r', '\\r')
+            val = val.replace('\n', '\\n')
+
+            header.append('%s: %s\r\n' % (name, val))
+
+    header.append('\r\n')
+    return ''.join(header).encode('utf-8', errors='strict'), as_bytes
+
+
+def _handle_format_many(pool, header, body, write_to_stream, answer_headers=()):
+    '''
+    Formats the documents in the body (the header 'Lengths' has the length in bytes of
+    each document) and writes the results with the 'Results' header (with Ok or Error
+    for each document) and the 'Lengths' of the formatted documents/error messages.
+    '''
+    tasks = []
+    offset = 0
+    timeout = _get_request_timeout(header)
+    lengths = header.get('Lengths')
+    if lengths:
+        for length in lengths.split(','):
+            length = int(length)
+            tasks.append(pool.submit(body[offset:offset + length], timeout=timeout))
+            offset += length
+
+    results = []
+    contents = []
+    for task in tasks:
+        task.event.wait()
+        if task.error is not None:
+            results.append(_get_error_result(task.exception))
+            contents.append(task.error.encode('utf-8'))
+        else:
+            results.append('Ok')
+            contents.append(task.result)
+
+    _write(write_to_stream, b''.join(contents), additional_headers=[
+        ('Result', 'Ok'),
+        ('Results', ','.join(results)),
+        ('Lengths', ','.join(str(len(c)) for c in contents)),
+    ] + list(answer_headers))
+
+
+def _is_trusted_peer(sock):
+    '''
+    :return bool:
+        Whether the client connected to the socket may ask the daemon to read and
+        rewrite files: only clients of the same user connected through the unix socket
+        (anyone who can reach the port may connect through tcp).
+    '''
+    import socket
+    if not hasattr(socket, 'AF_UNIX') or sock.family != socket.AF_UNIX:
+        return False
+    if not hasattr(socket, 'SO_PEERCRED'):
+        # The socket is in a directory only the user can access (see: _get_unix_socket_path).
+        return True
+    import struct
+    try:
+        credentials = sock.getsockopt(
+            socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    except socket.error:
+        debug_exception('Unable to get the credentials of the client.')
+        return False
+    _pid, uid, _gid = struct.unpack('3i', credentials)
+    return uid == os.getuid()
+
+
+def _is_same_path(path1, path2):
+    return os.path.normcase(os.path.abspath(path1)) == os.path.normcase(os.path.abspath(path2))
+
+
+def _handle_format_file(pool, header, write_to_stream, answer_headers=(), trusted_peer=False):
+    '''
+    Formats the file in the 'Path' header in place (the file is only rewritten if
+    it changed) and answers with whether it 'Changed' along with the 'Content-Hash'
+    of its new contents (the file contents never go through the socket).
+
+    The result cache of the daemon is used unless 'No-Cache: 1' is given ('Cache-Dir'
+    is only compared with the dir of the cache of the daemon: if it's not the same the
+    answer is a 'NotAllowed' result). 'Fsync: 1' requests the file to be flushed to disk
+    before replacing the original.
+
+    :param bool trusted_peer:
+        Whether the client may ask for files to be rewritten (see: _is_trusted_peer).
+        If not, the answer is a 'NotAllowed' result (the client must send the contents).
+    '''
+    from . import _cache
+    if not trusted_peer:
+        _write(write_to_stream, 'Files are only formatted for clients of the same user.', [
+            ('Result', 'NotAllowed')] + list(answer_headers))
+        return
+
+    path = header['Path']
+    cache = None
+    if header.get('No-Cache') != '1':
+        cache = _get_result_cache()
+        if cache is None or not _is_same_path(cache.cache_dir, header.get('Cache-Dir', '')):
+            _write(write_to_stream, 'The daemon uses a different result cache.', [
+                ('Result', 'NotAllowed')] + list(answer_headers))
+            return
+    try:
+        if not os.path.isabs(path):
+            raise ValueError('Expected absolute path. Found: %s' % (path,))
+        with _tracing.span('file_read'), open(path, 'rb') as stream:
+            contents = stream.read()
+        format_func = partial(pool.format_code, timeout=_get_request_timeout(header))
+        new_contents = _format_using_result_cache(cache, format_func, contents)
+        changed = new_contents != contents
+        if changed:
+            # Note: fsync is done for the file itself (there's no batch to sync).
+            _FileWriter(fsync=header.get('Fsync') == '1', batch_size=1).write(
+                path, new_contents)
+    except Exception as e:
+        debug_exception('Error formatting: %s' % (path,))
+        _write(write_to_stream, '%s' % (e,), [
+            ('Result', _get_error_result(e))] + list(answer_headers))
+        return
+
+    _write(write_to_stream, '', [
+        ('Result', 'Ok'),
+        ('Changed', '1' if changed else '0'),
+        ('Content-Hash', _cache.compute_content_hash(new_contents)),
+    ] + list(answer_headers))
+
+
+def _get_request_timeout(header):
+    '''
+    :return float|NoneType:
+        The timeout in the 'Timeout' header of a request (None if not given, in which
+        case the default timeout of the daemon is used).
+    '''
+    timeout = header.get('Timeout')
+    if timeout is None:
+        return None
+    return max(0, float(timeout))
+
+
+def _get_format_answer(header, code_to_format, task):
+    '''
+    :return tuple(unicode,list(tuple(unicode,unicode))):
+        The message and headers to answer a format request given its finished task.
+    '''
+    if task.exception is not None:
+        return task.error, [('Result', _get_error_result(task.exception))]
+
+    formatted = task.result
+    check_only = header.get('Check-Only') == '1'
+    if check_only or header.get('Compare-Input') == '1':
+        # The client already has the input: don't send it back
+        # if it didn't change (or if only the check is needed).
+        unchanged = formatted == code_to_format
+        if unchanged or check_only:
+            return '', [('Result', 'Ok'), ('Unchanged', '1' if unchanged else '0')]
+
+    return formatted, [('Result', 'Ok')]
+
+
+class _PipelinedAnswers(threading.Thread):
+    '''
+    Writes the answers to format requests which have a Request-Id (which may be
+    answered in any order, as soon as they're formatted, while the client keeps on
+    sending new requests).
+    '''
+
+    def __init__(self, write_to_stream, metrics):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._write_to_stream = write_to_stream
+        self._metrics = metrics
+        self._queue = Queue()
+
+    def on_format_done(self, request_id, header, code_to_format, task):
+        self._queue.put((request_id, header, code_to_format, task))
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            request_id, header, code_to_format, task = item
+            msg, additional_headers = _get_format_answer(header, code_to_format, task)
+            additional_headers.append(('Request-Id', request_id))
+            try:
+                _write(self._write_to_stream, msg, additional_headers)
+            except Exception:
+                debug_exception('Unable to write answer (client exited?).')
+                return
+            self._metrics.observe('request', _monotonic() - task.submit_time)
+
+    def stop(self):
+        self._queue.put(None)
 
 
-def _start_handling(process, socket, port_mutex):
+def _handle_trace(header, write_to_stream, answer_headers):
+    '''
+    Enables/disables tracing if requested (Trace-Enable header) and answers with the
+    spans of the daemon (in the Chrome trace format).
+    '''
+    enable = header.get('Trace-Enable')
+    if enable == '1':
+        _tracing.enable()
+    elif enable == '0':
+        _tracing.disable()
+    _write(write_to_stream, _tracing.dumps(), [('Result', 'Ok')] + answer_headers)
+
+
+def _start_handling(pool, socket, port_mutex):
+    from . import _metrics
+    metrics = pool.metrics
+    metrics.on_connection(1)
+    pipelined_answers = None
     try:
-        read_from_stream = socket.makefile('rb')
-        write_to_stream = socket.makefile('wb')
+        trusted_peer = _is_trusted_peer(socket)
+        read_from_stream = _metrics.MeteredReader(socket.makefile('rb'), metrics)
+        write_to_stream = _metrics.MeteredWriter(socket.makefile('wb'), metrics)
         while True:
             debug('On receive loop.')
-            header, body = _read(read_from_stream)
-            debug('Received: %s - %s' % (header, body))
-            if body is None:
+            # Blocks until the client starts sending a request (idle connections don't
+            # keep the daemon alive).
+            if not read_from_stream.peek(1):
                 debug('Client exited.')
-                break  # Client exited (without calling exit_client).
+                break
+            if not pool.begin_request():
+                debug('Daemon exiting: not handling request.')
+                break
+            try:
+                header, body = _read(read_from_stream, decode=False)
+                if DEBUG:
+                    debug('Received: %s - %s bytes' % (
+                        header, None if body is None else len(body)))
+                if body is None:
+                    debug('Client exited.')
+                    break  # Client exited (without calling exit_client).
+
+                request_time = _monotonic()
+                operation = header['Operation']
+                metrics.on_request(operation)
+
+                # The spans of the request have the request id of the client.
+                with _tracing.request_context(header.get('Trace-Id')), \
+                        _tracing.span('request', operation):
+                    # When a request has a Request-Id, its answer has the same Request-Id.
+                    request_id = header.get('Request-Id')
+                    answer_headers = [('Request-Id', request_id)] if request_id is not None else []
+
+                    if operation == 'format':
+                        debug('Operation: Format code.')
+                        # Note: the code is kept as bytes (it's only decoded by the client
+                        # if it was given as text).
+                        code_to_format = body
+                        if request_id is not None:
+                            # Pipelined request: answered when done (possibly out of order).
+                            if pipelined_answers is None:
+                                pipelined_answers = _PipelinedAnswers(write_to_stream, metrics)
+                                pipelined_answers.start()
+                            on_done = partial(
+                                pipelined_answers.on_format_done, request_id, header,
+                                code_to_format)
+                            pool.submit(code_to_format, on_done, _get_request_timeout(header))
+                            continue
 
-            operation = header['Operation']
-            if operation == 'format':
-                debug('Operation: Format code.')
-                try:
-                    formatted = format_code_server(process, body)
-                except Exception:
-                    debug_exception()
-                    if sys.version_info[0] < 3:
-                        from StringIO import StringIO
-                        s = StringIO()
-                    else:
-                        from io import StringIO
-                        s = StringIO()
-                    traceback.print_exc(file=s)
-                    v = s.getvalue()
-                    if isinstance(v, bytes):
-                        v = v.decode('utf-8', errors='replace')
-                    _write(
-                        write_to_stream, s.getvalue(), additional_headers=[('Result', 'Error')])
-                else:
-                    debug('Formatted code (returning it).')
-                    _write(write_to_stream, formatted, additional_headers=[('Result', 'Ok')])
+                        task = pool.submit(code_to_format, timeout=_get_request_timeout(header))
+                        task.event.wait()
+                        msg, additional_headers = _get_format_answer(header, code_to_format, task)
+                        debug('Formatted code (returning it).')
+                        _write(write_to_stream, msg, additional_headers)
+
+                    elif operation == 'format_many':
+                        debug('Operation: Format many.')
+                        _handle_format_many(pool, header, body, write_to_stream, answer_headers)
+
+                    elif operation == 'format_file':
+                        debug('Operation: Format file.')
+                        _handle_format_file(
+                            pool, header, write_to_stream, answer_headers, trusted_peer)
+
+                    elif operation == 'stats':
+                        debug('Operation: stats.')
+                        import json
+                        stats = pool.get_stats()
+                        if header.get('Format') == 'openmetrics':
+                            msg = _metrics.to_openmetrics(stats)
+                        else:
+                            msg = json.dumps(stats)
+                        _write(write_to_stream, msg, [('Result', 'Ok')] + answer_headers)
 
-            elif operation == 'ping':
-                debug('Operation: ping (answer pong).')
-                _write(write_to_stream, 'pong')
+                    elif operation == 'trace':
+                        debug('Operation: trace.')
+                        _handle_trace(header, write_to_stream, answer_headers)
 
-            elif operation == 'exit_client':
-                debug('Stop handling client.')
-                break
+                    elif operation == 'ping':
+                        debug('Operation: ping (answer pong).')
+                        with _tracing.span('ping'):
+                            _write(write_to_stream, 'pong', answer_headers)
 
-            elif operation == 'exit_daemon':
-                debug('Exit daemon.')
-                stop_format_server(process)
-                port_mutex.release_mutex()
-                os._exit(1)
-                break
+                    elif operation == 'exit_client':
+                        debug('Stop handling client.')
+                        break
 
-            else:
-                raise AssertionError('Error: unhandled operation: %s' % (operation,))
+                    elif operation == 'exit_daemon':
+                        debug('Exit daemon.')
+                        _exit_daemon_process(pool, port_mutex)
+                        break
+
+                    else:
+                        raise AssertionError('Error: unhandled operation: %s' % (operation,))
+
+                metrics.observe('request', _monotonic() - request_time)
+            finally:
+                pool.end_request()
     except Exception:
         debug_exception()
+        metrics.on_error('Internal')
         raise
     finally:
+        metrics.on_connection(-1)
+        if pipelined_answers is not None:
+            pipelined_answers.stop()
         debug('Stop handling client.')
 
 
 try:
-    TimeoutError
+    # Note: also available in this module (so that it can be imported in python 2).
+    TimeoutError = TimeoutError  # @ReservedAssignment
 except NameError:
 
     class TimeoutError(Exception):  # @ReservedAssignment
         pass
 
-_checked_java_in_path = False
-
 
 def _check_java_in_path():
-    global _checked_java_in_path
-    if _checked_java_in_path:
+    '''
+    Checks that the formatter jar exists and that java is in the PATH (the PATH is only
+    scanned once: the java found is the one used to launch the formatter processes).
+    '''
+    if 'path' in _java_launch_info:
         return
-    path = os.environ.get('PATH')
-    dirs_in_path = path.split(os.path.pathsep)
-    for dir_in_path in dirs_in_path:
-        if os.path.exists(os.path.join(dir_in_path, java_executable)):
-            break
-    else:
+    if not os.path.exists(target_jar):
+        raise AssertionError('%s must exist.' % (target_jar,))
+
+    from . import _jvm
+    java_path = _jvm.find_java(java_executable)
+    if java_path is None:
         raise AssertionError('Did not find %s in\n%s' % (
-            java_executable, '\n'.join(dirs_in_path)))
+            java_executable, '\n'.join(os.environ.get('PATH', '').split(os.path.pathsep))))
+    with _java_launch_lock:
+        _java_launch_info.setdefault('path', java_path)
 
-    _checked_java_in_path = True
 
+# Time (in seconds) to wait for the answer of the ping done on new tcp connections.
+_PING_TIMEOUT = 5
 
-def _connect_to_daemon_process(attempt=0, create_if_not_there=True):
-    debug('connect attempt: %s' % (attempt,))
 
-    port_mutex = PortMutex(_MUTEX_NAME, lambda:-1)
-    port_to_use = -1
-    if not port_mutex.get_mutex_aquired():
-        # We didn't acquire the mutex (so, it may be from a live server
-        # or another temporary which returns -1).
-        port_to_use = port_mutex.port
-        check_java_in_path = False
-    else:
-        check_java_in_path = True
-        # Was able to acquire mutex (which means there's no server up).
-        if not create_if_not_there:
-            return None, None
+class _DaemonConnection(object):
 
-    # Always release the mutex here as soon as possible because this one
-    # is never the 'real' daemon.
-    port_mutex.release_mutex()
+    def __init__(self, sock):
+        self.sock = sock
+        self.write_to_stream = sock.makefile('wb')
+        self.read_from_stream = sock.makefile('rb')
+
+    def check_daemon(self):
+        '''
+        Checks that the daemon is the one listening on the other side (through a ping).
+
+        Used on new tcp connections: the published port may be stale (the daemon exited)
+        and now be used by some other process.
+
+        :raise RuntimeError:
+            If the answer isn't the one from the daemon (or it doesn't answer in time).
+        '''
+        self.sock.settimeout(_PING_TIMEOUT)
+        try:
+            with _tracing.span('ping'):
+                _write(self.write_to_stream, 'ping', [('Operation', 'ping')])
+                _header, body = _read(self.read_from_stream)
+        except Exception as e:
+            raise RuntimeError('Unable to ping daemon: %s' % (e,))
+        finally:
+            self.sock.settimeout(None)
+        if body != 'pong':
+            raise RuntimeError('Expected pong from daemon. Found: %r' % (body,))
+
+    def close(self):
+        for closeable in (self.write_to_stream, self.read_from_stream, self.sock):
+            try:
+                closeable.close()
+            except Exception:
+                pass
+
+
+class _DaemonClient(object):
+    '''
+    Keeps connections to the daemon alive so that they can be reused among multiple
+    calls (a connection is used by a single thread at a time, so, a new connection
+    is created if all the connections are in use).
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle_connections = []
+        self._pid = os.getpid()
+
+    def _acquire_connection(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Connections from the parent process can't be reused after a fork.
+                self._idle_connections = []
+                self._pid = os.getpid()
+
+            if self._idle_connections:
+                return self._idle_connections.pop()
+
+        return _connect_to_daemon_process()
+
+    def _release_connection(self, connection):
+        with self._lock:
+            if self._pid == os.getpid():
+                self._idle_connections.append(connection)
+                return
+        connection.close()
+
+    def request(self, msg, additional_headers, decode=True):
+        '''
+        Sends a message to the daemon and waits for its answer.
+
+        If the connection was broken (i.e.: the daemon exited or was restarted), the
+        request is retried once in a new connection.
+
+        :return tuple(dict,unicode|bytes):
+            The header and the body of the answer.
+        '''
+        if _tracing.enabled:
+            # The daemon records its spans with the same request id.
+            request_id = _tracing.get_request_id() or _tracing.new_request_id()
+            additional_headers = list(additional_headers) + [('Trace-Id', request_id)]
+            with _tracing.request_context(request_id), _tracing.span('client_request'):
+                return self._request(msg, additional_headers, decode)
+        return self._request(msg, additional_headers, decode)
+
+    def _request(self, msg, additional_headers, decode):
+        for attempt in (0, 1):
+            connection = self._acquire_connection()
+            try:
+                _write(connection.write_to_stream, msg, additional_headers)
+                header, body = _read(connection.read_from_stream, decode=decode)
+                if body is None:
+                    raise RuntimeError('Connection to daemon closed.')
+            except Exception:
+                debug_exception('Error communicating with daemon (attempt: %s).' % (attempt,))
+                connection.close()
+                if attempt == 1:
+                    raise
+            else:
+                self._release_connection(connection)
+                return header, body
+
+    def close(self):
+        with self._lock:
+            connections = self._idle_connections
+            self._idle_connections = []
+        for connection in connections:
+            connection.close()
+
+
+_daemon_client = _DaemonClient()
 
-    if check_java_in_path:
+
+def _read_published_address():
+    '''
+    :return int|unicode|NoneType:
+        The address published by the daemon in the mutex file (without checking
+        whether the daemon is really running) or None if there's no address there.
+    '''
+    filename = os.path.join(tempfile.gettempdir(), _MUTEX_NAME)
+    try:
+        with open(filename, 'rb') as stream:
+            address = _parse_address(stream.read())
+    except (IOError, OSError, ValueError):
+        return None
+    if address == -1:
+        # Temporarily written by a process which checked whether the daemon is running.
+        return None
+    return address
+
+
+class _LaunchLock(object):
+    '''
+    A system-wide lock held while checking whether the daemon is running and launching it
+    (so, when many processes start at once, only one launches the daemon while the
+    others block until it's ready).
+    '''
+
+    def __init__(self):
+        self._filename = os.path.join(tempfile.gettempdir(), _MUTEX_NAME + '_launch')
+        self._handle = None
+
+    def __enter__(self):
+        self._handle = open(self._filename, 'ab')
+        try:
+            if sys.platform == 'win32':
+                import msvcrt
+                self._handle.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(self._handle.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except (IOError, OSError):
+                        continue  # LK_LOCK gives up after 10 seconds: keep on waiting.
+            else:
+                import fcntl
+                fcntl.flock(self._handle, fcntl.LOCK_EX)
+        except Exception:
+            self._handle.close()
+            raise
+        return self
+
+    def __exit__(self, *args):
+        try:
+            if sys.platform == 'win32':
+                import msvcrt
+                self._handle.seek(0)
+                msvcrt.locking(self._handle.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self._handle, fcntl.LOCK_UN)
+        finally:
+            self._handle.close()
+
+
+def _get_daemon_launch_code():
+    '''
+    :return unicode:
+        The code to run the daemon in a new python process (the options of the daemon
+        are given through environment variables). The command line isn't used so that
+        the daemon doesn't need to import it.
+
+        The dir of this package is put first in the sys.path (and the current dir is
+        removed from it) so that a pydevf in the current dir or installed elsewhere
+        isn't imported instead.
+    '''
+    package_parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return (
+        'import sys; sys.path[:] = [%r] + [p for p in sys.path if p not in (%r, \'\')]; '
+        'from pydevf._pydevf import start_daemon_server; start_daemon_server()'
+    ) % (package_parent_dir, package_parent_dir)
+
+
+def _get_daemon_address(create_if_not_there=True, check_running=False):
+    '''
+    :param bool check_running:
+        If False, the address published by the daemon is returned without checking
+        whether it's really running (the caller must call it again with check_running=True
+        if it's not possible to connect to that address).
+
+    :return int|unicode|NoneType:
+        The port or unix socket path where the daemon is listening. If there's no daemon
+        running, it's started (unless create_if_not_there is False, in which case
+        None is returned).
+    '''
+    if not check_running:
+        address = _read_published_address()
+        if address is not None:
+            return address
+
+    if create_if_not_there:
         _check_java_in_path()
 
-    if port_to_use == -1:
-        # Release it and launch process which will keep the mutex live.
+    with _tracing.span('daemon_mutex'), _LaunchLock():
+        port_mutex = PortMutex(_MUTEX_NAME, lambda:-1)
+        mutex_acquired = port_mutex.get_mutex_aquired()
+        # Always release the mutex here as soon as possible because this one
+        # is never the 'real' daemon.
+        port_mutex.release_mutex()
+
+        if not mutex_acquired:
+            # The daemon is running (it holds the mutex).
+            return port_mutex.port
+
+        if not create_if_not_there:
+            return None
+
+        # Launch the process which will keep the mutex live. Note: it only writes its
+        # address after it's listening (so, it can be connected to right away) and other
+        # processes wait for the launch lock instead of launching it again.
         DETACHED_PROCESS = 8
         import subprocess
         kwargs = {}
         if sys.platform == 'win32':
             kwargs['creationflags'] = DETACHED_PROCESS
-        daemon_process = subprocess.Popen(
-            [sys.executable, os.path.dirname(__file__), '--start-daemon'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            stdin=subprocess.PIPE,
-            **kwargs
-        )
-        line1 = daemon_process.stdout.readline()
+        else:
+            # The daemon must not inherit the launch lock.
+            kwargs['close_fds'] = True
+        with _tracing.span('launch_daemon'):
+            daemon_process = subprocess.Popen(
+                [sys.executable, '-c', _get_daemon_launch_code()],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                stdin=subprocess.PIPE,
+                **kwargs
+            )
+            line1 = daemon_process.stdout.readline()
         try:
-            port_to_use = int(line1.strip())
+            return _parse_address(line1)
         except Exception:
             print(line1)
             for line in daemon_process.stdout.readlines():
                 print(line)
             raise
 
-    import socket
-    import time
-
-    # Ok, gotten the port, let's check if it's already live.
-    initial_time = time.time()
-    max_time = initial_time + 5
 
-    def did_timeout():
-        return time.time() > max_time
+def _connect_to_daemon_process(create_if_not_there=True):
+    '''
+    :return _DaemonConnection|NoneType:
+        A connection to the daemon (which is started if needed, unless create_if_not_there
+        is False, in which case None is returned if it's not running).
+    '''
+    import time
 
-    while True:
+    check_running = False
+    for attempt in range(3):
+        debug('connect attempt: %s' % (attempt,))
+        address = _get_daemon_address(create_if_not_there, check_running)
+        if address is None:
+            return None
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect(('127.0.0.1', port_to_use))
-
-            # Create file-like streams.
-            write_to_stream = sock.makefile('wb')
-            read_from_stream = sock.makefile('rb')
-
-            _write(write_to_stream, 'ping', additional_headers=[('Operation', 'ping')])
-            debug('wait for pong...')
-            header, body = _read(read_from_stream)
-            if body == 'pong':
-                break
-            else:
-                raise RuntimeError('Waiting for pong. Found: %s - %s' % (header, body))
+            with _tracing.span('connect'):
+                connection = _DaemonConnection(_create_client_socket(address))
         except Exception:
-            if did_timeout():
-                if attempt < 2:
-                    return _connect_to_daemon_process(attempt + 1)
-                raise
+            debug_exception('Unable to connect to: %s' % (address,))
         else:
-            if did_timeout():
-                if attempt < 2:
-                    return _connect_to_daemon_process(attempt + 1)
-                else:
-                    raise TimeoutError('Unable to start and connect to daemon.')
-        time.sleep(.1)
-    return write_to_stream, read_from_stream
+            try:
+                if isinstance(address, int):
+                    # A stale port may now be used by another process (the unix socket
+                    # is in a directory which only the user may access).
+                    connection.check_daemon()
+                return connection
+            except Exception:
+                debug_exception('Not the daemon at: %s' % (address,))
+                connection.close()
+
+        # The published address may be stale (or the daemon may be exiting).
+        check_running = True
+        if attempt > 0:
+            time.sleep(.1 * attempt)
+
+    raise TimeoutError('Unable to start and connect to daemon.')
 
 #===================================================================================================
 # Main command line handling
 #===================================================================================================
 
 
-@click.command(context_settings=dict(help_option_names=['-h', '--help']))
-@click.option(
-    '--include',
-    type=str,
-    default='*.py, *.pyw',
-    help='fnmatch-style files to include (comma separated).',
-    show_default=True,
-)
-@click.option(
-    '--exclude-dirs',
-    type=str,
-    default='*.git, *.hg, *.svn',
-    help='fnmatch-style dirs to exclude (comma separated).',
-    show_default=True,
-)
-@click.option(
-    '--no-daemon',
-    help='Do not automatically start a daemon service to be used among multiple processes.',
-    default=False,
-    is_flag=True,
-)
-@click.option(
-    '--start-daemon',
-    help='Starts daemon service to be used among multiple processes.',
-    default=False,
-    is_flag=True,
-)
-@click.option(
-    '--stop-daemon',
-    help='Stops a daemon service previously started in another process.',
-    default=False,
-    is_flag=True,
-)
-@click.option(
-    '-v',
-    '--verbose',
-    is_flag=True,
-    help='Enable verbose mode.',
-)
-@click.version_option(version=__version__)
-@click.argument(
-    'source',
-    nargs=-1,
-    type=click.Path(
-        exists=True, file_okay=True, dir_okay=True, readable=True, allow_dash=True
-    ),
-    is_eager=True,
-)
-@click.pass_context
-def main(
-        ctx, include='*.py', exclude_dirs=None, verbose=False, source=None, no_daemon=False,
-        start_daemon=False, stop_daemon=False
-    ):
-    from functools import partial
-    import fnmatch
-
-    out = partial(click.secho, bold=True, err=True)
-    err = partial(click.secho, fg='red', err=True)
-
-    include = include.strip()
-    if include:
-        include = [x.strip() for x in include.split(',')]
-
-    exclude_dirs = exclude_dirs.strip()
-    if exclude_dirs:
-        exclude_dirs = [x.strip() for x in exclude_dirs.split(',')]
-
-    def include_file(filename):
-        if not include:
+class _FileWriter(object):
+    '''
+    Replaces the contents of files atomically (the new contents are written to a
+    temporary file which is then renamed over the original file).
+
+    When fsync is requested, each temporary file is synced before being renamed (so
+    that a crash can't leave a file with partial contents) and the renames are delayed
+    so that each directory is synced only once for each batch of files.
+
+    Pending temporary files are removed by discard() (so that an aborted run doesn't
+    leave them around).
+    '''
+
+    def __init__(self, fsync=False, batch_size=100):
+        self._fsync = fsync
+        self._batch_size = batch_size
+        self._lock = threading.Lock()
+        self._pending = []
+
+    def write(self, path, contents):
+        '''
+        :return bool:
+            True if the file was already replaced and False if it'll only be replaced
+            on a later call to flush().
+        '''
+        from . import _cache
+        # Replace the target of symlinks (and not the symlink itself).
+        path = os.path.realpath(path)
+        directory, basename = os.path.split(path)
+        st = os.stat(path)
+        handle, tmp_path = tempfile.mkstemp(dir=directory, prefix='.%s.' % (basename,))
+        # Without batches the file is renamed (and its directory synced) right away.
+        sync_now = self._fsync and self._batch_size <= 1
+        try:
+            with _tracing.span('file_write'), os.fdopen(handle, 'wb') as stream:
+                stream.write(contents)
+                if self._fsync:
+                    stream.flush()
+                    with _tracing.span('fsync'):
+                        os.fsync(stream.fileno())
+            os.chmod(tmp_path, st.st_mode & 0o7777)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+        if not self._fsync or sync_now:
+            _cache.replace_file(tmp_path, path)
+            if sync_now:
+                _fsync_directory(directory)
             return True
-        for pat in include:
-            if fnmatch.fnmatch(filename, pat):
-                return True
-        return False
 
-    def exclude_directory(filename):
-        if not exclude_dirs:
-            return False
-        for pat in exclude_dirs:
-            if fnmatch.fnmatch(filename, pat):
-                return True
+        with self._lock:
+            self._pending.append((tmp_path, path))
+            must_flush = len(self._pending) >= self._batch_size
+        if must_flush:
+            self.flush()
         return False
 
-    if start_daemon:
-        start_daemon_server()
-        ctx.exit(0)
+    def flush(self):
+        from . import _cache
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+        if not pending:
+            return
+
+        # Note: the temporary files were already synced when written.
+        directories = set()
+        errors = []
+        for tmp_path, path in pending:
+            try:
+                _cache.replace_file(tmp_path, path)
+            except Exception as e:
+                errors.append('%s: %s' % (path, e))
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            else:
+                directories.add(os.path.dirname(path))
+
+        # Make sure the renames are persisted too.
+        for directory in directories:
+            _fsync_directory(directory)
+
+        if errors:
+            raise IOError('Unable to replace:\n%s' % ('\n'.join(errors),))
+
+    def discard(self):
+        '''
+        Removes the temporary files which weren't renamed yet (the original files are
+        kept unchanged).
+        '''
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+        for tmp_path, _path in pending:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
 
-    if stop_daemon:
-        exit_daemon()
-        out('Daemon process stopped.')
-        ctx.exit(0)
+def _fsync_directory(directory):
+    if sys.platform != 'win32':
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
 
-    if not source:
-        out('No files to format. Nothing to do.')
-        ctx.exit(0)
 
-    def on_finish():
-        pass
+def _get_unified_diff(filename, contents, new_contents):
+    '''
+    :param bytes contents:
+    :param bytes new_contents:
 
-    try:
-        if no_daemon:
-            process = start_format_server()
-            do_format = lambda code_to_format: format_code_server(process, code_to_format)
+    :return unicode:
+        The unified diff from the contents to the new contents.
+    '''
+    import difflib
+    lines = difflib.unified_diff(
+        contents.decode('utf-8', errors='replace').splitlines(True),
+        new_contents.decode('utf-8', errors='replace').splitlines(True),
+        '%s\t(original)' % (filename,),
+        '%s\t(formatted)' % (filename,),
+    )
+    return ''.join(line if line.endswith('\n') else line + '\n' for line in lines)
 
-            def on_finish():
-                stop_format_server(process)
 
-        else:
-            do_format = format_code_using_daemon
+def _imap_ordered(func, items, jobs):
+    '''
+    Calls func(item) for each item using up to `jobs` threads.
 
-        if source == ('-',):
-            if sys.version_info[0] > 2:
-                read_from = sys.stdin.buffer
-                write_to = sys.stdout.buffer
-            else:
-                if sys.platform == "win32":
-                    # must read streams as binary on windows
-                    import msvcrt
-                    msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
-                    msvcrt.setmode(sys.stdin.fileno(), os.O_BINARY)
+    :return iterable(tuple(object,object,Exception)):
+        Yields tuple(item, result, exception) for each item in the same order of
+        the items (as soon as the result of that item is available).
+    '''
+    items = list(items)
 
-                read_from = sys.stdin
-                write_to = sys.stdout
+    def call(item):
+        try:
+            return func(item), None
+        except Exception as e:
+            debug_exception()
+            return None, e
+
+    if jobs <= 1 or len(items) <= 1:
+        for item in items:
+            yield (item,) + call(item)
+        return
 
-            contents_as_bytes = read_from.read()
-            try:
-                output = do_format(contents_as_bytes)
-            except Exception as e:
-                err('Error formatting contents: %s' % (str(e)))
-                ctx.exit(1)
-            else:
-                write_to.write(output)
-                write_to.flush()
-            ctx.exit(0)
+    results = [None] * len(items)
+    events = [threading.Event() for _ in items]
+    indexes = iter(range(len(items)))
+    lock = threading.Lock()
 
-        else:
-            format_files = []
-            for entry in source:
-                if os.path.isfile(entry):
-                    format_files.append(entry)
-                else:
-                    for root, dirs, files in os.walk(entry):
-                        for filename in files:
-                            if include_file(os.path.basename(filename)):
-                                format_files.append(os.path.join(root, filename))
-
-                        new_dirs = []
-                        for directory in dirs:
-                            if not exclude_directory(os.path.basename(directory)):
-                                new_dirs.append(directory)
-                        dirs[:] = new_dirs[:]
-
-            total = len(format_files)
-            for i, entry in enumerate(format_files):
-                if verbose:
-                    out('Format file: %s (%s of %s)' % (entry, i + 1, total))
-                with open(entry, 'rb') as stream:
-                    contents = stream.read()
-
-                new_contents = do_format(contents)
-                with open(entry, 'wb') as stream:
-                    stream.write(new_contents)
-
-            ctx.exit(0)
+    def run():
+        while True:
+            with lock:
+                i = next(indexes, None)
+            if i is None:
+                return
+            results[i] = call(items[i])
+            events[i].set()
 
-    finally:
-        on_finish()
+    for _ in range(min(jobs, len(items))):
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+
+    for i, item in enumerate(items):
+        events[i].wait()
+        yield (item,) + results[i]
+
+
+def main(*args, **kwargs):
+    '''
+    The command line entry point (click is only imported when it's called).
+    '''
+    from ._cli import main as command
+    return command(*args, **kwargs)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,311 @@
+'''
+asyncio API to format code using the daemon (requires python 3.6 onwards):
+
+formatted = await format_code_async(code_to_format)
+
+async for formatted, error in format_many_async(codes_to_format):
+    ...
+
+A single connection to the daemon is kept alive for each event loop and is only used
+through asyncio streams: requests are sent with a Request-Id without waiting for the
+previous answers (which the daemon may send in any order). The only blocking part
+(finding out the port of the daemon and starting it if needed) is run in an executor.
+'''
+
+import asyncio
+import collections
+import itertools
+import weakref
+
+from . import _pydevf
+from ._pydevf import debug, debug_exception
+
+_clients = weakref.WeakKeyDictionary()
+
+
+async def _read_async(reader, decode=True):
+    '''
+    :return tuple(dict,unicode|bytes):
+        Returns the header and message read (the body is None on EOF).
+    '''
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line:  # EOF
+            return headers, None
+        if not _pydevf._parse_header_line(line, headers):
+            break
+
+    if not headers:
+        raise RuntimeError('Got message without headers.')
+
+    size = int(headers['Content-Length'])
+    if size == 0:
+        body = b''
+    else:
+        body = await reader.readexactly(size)
+    if decode:
+        body = body.decode('utf-8')
+    return headers, body
+
+
+async def _write_async(writer, lock, msg, additional_headers=None):
+    '''
+    :param asyncio.Lock lock:
+        The write and the drain are done while holding it (concurrent calls to drain()
+        in the same stream aren't supported before python 3.10: an AssertionError is
+        raised if the transport is paused).
+    '''
+    header, as_bytes = _pydevf._encode_message(msg, additional_headers)
+    async with lock:
+        # A single write so that the whole frame is sent at once.
+        writer.write(header + as_bytes)
+        await writer.drain()
+
+
+class _AsyncDaemonConnection(object):
+    '''
+    A connection to the daemon where many requests may be in flight at the same time
+    (answers are matched to the requests through the Request-Id header).
+    '''
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self._pending = collections.OrderedDict()
+        self._request_ids = itertools.count(1)
+        self._reader_task = None
+        # Many requests share the stream (only one of them may write and drain at a time).
+        self._write_lock = asyncio.Lock()
+        self.closed = False
+
+    def start(self):
+        self._reader_task = asyncio.ensure_future(self._read_answers())
+
+    async def _read_answers(self):
+        try:
+            while True:
+                header, body = await _read_async(self.reader, decode=False)
+                if body is None:
+                    raise ConnectionError('Connection to daemon closed.')
+
+                request_id = header.get('Request-Id')
+                if request_id is None:
+                    # A daemon which doesn't support pipelining answers in order.
+                    if not self._pending:
+                        continue
+                    request_id = next(iter(self._pending))
+
+                future = self._pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result((header, body))
+        except Exception as e:
+            debug_exception('Stopped reading answers from daemon.')
+            self.close(ConnectionError('Connection to daemon lost: %s' % (e,)))
+
+    async def request(self, msg, additional_headers):
+        '''
+        :return tuple(dict,bytes):
+            The header and the body of the answer.
+        '''
+        if self.closed:
+            raise ConnectionError('Connection to daemon closed.')
+
+        request_id = str(next(self._request_ids))
+        future = asyncio.get_event_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            await _write_async(
+                self.writer, self._write_lock, msg,
+                list(additional_headers) + [('Request-Id', request_id)])
+            return await future
+        finally:
+            self._pending.pop(request_id, None)
+
+    def close(self, exception=None):
+        self.closed = True
+        pending = list(self._pending.values())
+        self._pending.clear()
+        for future in pending:
+            if not future.done():
+                future.set_exception(exception or ConnectionError('Connection to daemon closed.'))
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+
+
+async def _check_daemon(reader, writer):
+    '''
+    Checks that the daemon is the one listening on the other side of a new connection
+    (see: _DaemonConnection.check_daemon). The connection is closed if it's not.
+    '''
+    try:
+        await _write_async(writer, asyncio.Lock(), 'ping', [('Operation', 'ping')])
+        _header, body = await asyncio.wait_for(_read_async(reader), _pydevf._PING_TIMEOUT)
+        if body != 'pong':
+            raise RuntimeError('Expected pong from daemon. Found: %r' % (body,))
+    except BaseException:
+        writer.close()
+        raise
+
+
+class _AsyncDaemonClient(object):
+    '''
+    Keeps a connection to the daemon alive to be used by all the requests done in the
+    same event loop.
+    '''
+
+    def __init__(self):
+        self._connection = None
+        self._connect_lock = None
+
+    async def _connect(self):
+        loop = asyncio.get_event_loop()
+        check_running = False
+        for attempt in range(3):
+            debug('async connect attempt: %s' % (attempt,))
+            address = await loop.run_in_executor(
+                None, _pydevf._get_daemon_address, True, check_running)
+            try:
+                if isinstance(address, int):
+                    reader, writer = await asyncio.open_connection('127.0.0.1', address)
+                    # A stale port may now be used by another process.
+                    await _check_daemon(reader, writer)
+                else:
+                    reader, writer = await asyncio.open_unix_connection(address)
+            except Exception:
+                debug_exception('Unable to connect to: %s' % (address,))
+                # The published address may be stale (or the daemon may be exiting).
+                check_running = True
+                if attempt > 0:
+                    await asyncio.sleep(.1 * attempt)
+                continue
+
+            connection = _AsyncDaemonConnection(reader, writer)
+            connection.start()
+            return connection
+
+        raise TimeoutError('Unable to start and connect to daemon.')
+
+    async def _get_connection(self):
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+
+        async with self._connect_lock:
+            if self._connection is None or self._connection.closed:
+                self._connection = await self._connect()
+            return self._connection
+
+    async def request(self, msg, additional_headers, decode=True):
+        '''
+        Sends a message to the daemon and waits for its answer (if the connection was
+        broken the request is retried once in a new connection).
+
+        :return tuple(dict,unicode|bytes):
+            The header and the body of the answer.
+        '''
+        for attempt in (0, 1):
+            connection = await self._get_connection()
+            try:
+                header, body = await connection.request(msg, additional_headers)
+            except ConnectionError:
+                debug_exception('Error communicating with daemon (attempt: %s).' % (attempt,))
+                connection.close()
+                if attempt == 1:
+                    raise
+            else:
+                if decode:
+                    body = body.decode('utf-8')
+                return header, body
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def _get_client():
+    loop = asyncio.get_event_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = _AsyncDaemonClient()
+    return client
+
+
+async def format_code_async(code_to_format, timeout=None):
+    '''
+    Formats the given code using the daemon.
+
+    :param unicode|bytes code_to_format:
+        The code to be formatted.
+
+    :param float timeout:
+        The maximum time (in seconds) that the daemon may take to format the code
+        (see: format_code_using_daemon).
+
+    :return unicode|bytes:
+        The formatted code (with the same type of the code given).
+    '''
+    input_as_bytes = isinstance(code_to_format, bytes)
+    header, body = await _get_client().request(
+        code_to_format,
+        [('Operation', 'format'), ('Compare-Input', '1')] + _pydevf._get_timeout_headers(timeout),
+        decode=not input_as_bytes)
+    if 'Result' not in header:
+        raise RuntimeError('Result not in header. Header:\n%s\nBody:%s\n' % (
+            header, body))
+
+    _pydevf._check_result(header, body)
+    if header.get('Unchanged') == '1':
+        return code_to_format
+    return body
+
+
+async def format_many_async(codes_to_format, batch_size=100, timeout=None):
+    '''
+    Formats many code snippets using the daemon (sent in batches).
+
+    :param iterable(unicode|bytes)|async iterable(unicode|bytes) codes_to_format:
+        The codes to be formatted.
+
+    :param int batch_size:
+        The maximum number of snippets sent to the daemon in a single request.
+
+    :param float timeout:
+        The timeout (in seconds) for each snippet (see: format_many_using_daemon).
+
+    :return async iterable(tuple(unicode|bytes,unicode)):
+        Yields a tuple(formatted_code, error_message) for each code to be formatted
+        (in the same order in which they were given). If the code was formatted
+        error_message is None, otherwise formatted_code is None.
+    '''
+    client = _get_client()
+
+    async def format_batch(batch):
+        contents, additional_headers = _pydevf._encode_batch(batch)
+        additional_headers += _pydevf._get_timeout_headers(timeout)
+        header, body = await client.request(contents, additional_headers, decode=False)
+        return _pydevf._decode_batch_results(batch, header, body)
+
+    if not hasattr(codes_to_format, '__aiter__'):
+        codes_to_format = _as_async_iterable(codes_to_format)
+
+    batch = []
+    async for code_to_format in codes_to_format:
+        batch.append(code_to_format)
+        if len(batch) >= batch_size:
+            for result in await format_batch(batch):
+                yield result
+            batch = []
+
+    if batch:
+        for result in await format_batch(batch):
+            yield result
+
+
+async def _as_async_iterable(iterable):
+    for item in iterable:
+        yield item
@@ -0,0 +1,262 @@
+'''
+Low-overhead tracing of the requests (the traces may be viewed in chrome://tracing or
+https://ui.perfetto.dev).
+
+Spans are kept in memory in a ring buffer (only the most recent spans are kept) with
+monotonic timestamps (which are comparable among the processes of the same machine, so,
+the traces of the clients and the daemon may be merged). Each span is associated with
+the request id of the thread which recorded it (the client sends its request id to the
+daemon, so, the spans of the daemon have the same request id of the client).
+
+Tracing is enabled with the PYDEVF_TRACE=1 environment variable (or enable()). When
+disabled, span() just returns a shared object which does nothing.
+
+If the PYDEVF_TRACE_FILE environment variable is set, the buffer is flushed to that file
+(in the Chrome trace format) in a background thread from time to time and at exit
+('{pid}' in the path is replaced by the process id).
+'''
+
+from __future__ import unicode_literals
+
+import collections
+import itertools
+import os
+import threading
+
+try:
+    from time import monotonic as _monotonic
+except ImportError:
+    from time import time as _monotonic
+
+try:
+    from threading import get_ident as _get_ident
+except ImportError:
+    from thread import get_ident as _get_ident  # @UnresolvedImport
+
+TRACE_ENV_VAR = 'PYDEVF_TRACE'
+TRACE_FILE_ENV_VAR = 'PYDEVF_TRACE_FILE'
+
+# The maximum number of spans kept in the buffer.
+DEFAULT_CAPACITY = 100000
+
+# Interval (in seconds) to flush the buffer to PYDEVF_TRACE_FILE.
+_FLUSH_INTERVAL = 2.0
+
+enabled = False
+
+_events = collections.deque(maxlen=DEFAULT_CAPACITY)
+_local = threading.local()
+_request_ids = itertools.count(1)
+_process_name = None
+_flusher = None
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+
+    __slots__ = ['name', 'detail', 'start']
+
+    def __init__(self, name, detail):
+        self.name = name
+        self.detail = detail
+
+    def __enter__(self):
+        self.start = _monotonic()
+        return self
+
+    def __exit__(self, *args):
+        record(self.name, self.start, _monotonic(), self.detail)
+
+
+class _RequestContext(object):
+
+    __slots__ = ['request_id', 'previous']
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+
+    def __enter__(self):
+        self.previous = getattr(_local, 'request_id', None)
+        _local.request_id = self.request_id
+        return self
+
+    def __exit__(self, *args):
+        _local.request_id = self.previous
+
+
+def span(name, detail=None):
+    '''
+    :return context manager:
+        Records a span with the given name (and optional detail) while the context
+        is active (does nothing if tracing is disabled).
+    '''
+    if not enabled:
+        return _NULL_SPAN
+    return _Span(name, detail)
+
+
+def record(name, start, end, detail=None, request_id=None):
+    '''
+    Records a span from start to end (monotonic times).
+    '''
+    if request_id is None:
+        request_id = getattr(_local, 'request_id', None)
+    _events.append((name, start, end - start, _get_ident(), request_id, detail))
+
+
+def new_request_id():
+    return '%s-%s' % (os.getpid(), next(_request_ids))
+
+
+def get_request_id():
+    '''
+    :return unicode|NoneType:
+        The request id associated with the current thread.
+    '''
+    return getattr(_local, 'request_id', None)
+
+
+def request_context(request_id):
+    '''
+    :return context manager:
+        Associates the spans recorded by the current thread with the given request id
+        while the context is active (does nothing if tracing is disabled).
+    '''
+    if not enabled:
+        return _NULL_SPAN
+    return _RequestContext(request_id)
+
+
+def set_process_name(name):
+    global _process_name
+    _process_name = name
+
+
+def enable(capacity=None):
+    '''
+    Enables tracing (the buffer is cleared if its capacity changes).
+    '''
+    global enabled, _events
+    if capacity is not None and capacity != _events.maxlen:
+        _events = collections.deque(maxlen=capacity)
+    enabled = True
+    trace_file = os.environ.get(TRACE_FILE_ENV_VAR)
+    if trace_file:
+        _start_flusher(trace_file)
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def clear():
+    _events.clear()
+
+
+def get_events():
+    '''
+    :return list(dict):
+        The spans in the buffer as events in the Chrome trace format.
+    '''
+    pid = os.getpid()
+    events = []
+    if _process_name:
+        events.append({
+            'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': _process_name}})
+    for name, start, duration, tid, request_id, detail in list(_events):
+        args = {}
+        if request_id is not None:
+            args['request_id'] = request_id
+        if detail is not None:
+            args['detail'] = detail
+        events.append({
+            'name': name,
+            'cat': 'pydevf',
+            'ph': 'X',
+            'ts': start * 1000000,
+            'dur': duration * 1000000,
+            'pid': pid,
+            'tid': tid,
+            'args': args,
+        })
+    return events
+
+
+def dumps(events=None):
+    '''
+    :param list(dict) events:
+        The events to dump (by default the events in the buffer of this process).
+
+    :return unicode:
+        The events as Chrome trace json.
+    '''
+    import json
+    if events is None:
+        events = get_events()
+    return json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'})
+
+
+def dump(path, events=None):
+    '''
+    Writes the events as Chrome trace json to the given path.
+    '''
+    from . import _cache
+    contents = dumps(events).encode('utf-8')
+    tmp_path = path + '.%s.tmp' % (os.getpid(),)
+    with open(tmp_path, 'wb') as stream:
+        stream.write(contents)
+    _cache.replace_file(tmp_path, path)
+
+
+class _Flusher(threading.Thread):
+    '''
+    Flushes the buffer to a file from time to time (and at exit).
+    '''
+
+    def __init__(self, path):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path.replace('{pid}', '%s' % (os.getpid(),))
+        self._last = None
+
+    def run(self):
+        import time
+        while True:
+            time.sleep(_FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        last = _events[-1] if _events else None
+        if last is self._last:
+            return
+        self._last = last
+        try:
+            dump(self.path)
+        except (IOError, OSError):
+            pass
+
+
+def _start_flusher(path):
+    global _flusher
+    if _flusher is not None:
+        return
+    import atexit
+    _flusher = _Flusher(path)
+    _flusher.start()
+    atexit.register(_flusher.flush)
+
+
+if os.environ.get(TRACE_ENV_VAR, '') in ('1', 'True', 'true'):
+    enable()
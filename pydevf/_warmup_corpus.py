@@ -0,0 +1,150 @@
+'''
+Code used to warm up the java formatter processes of the daemon (so that the code
+paths used when formatting are compiled by the JIT before the first requests).
+
+The snippets cover the usual constructs found in python modules (and are purposefully
+not formatted). The last one has a syntax error (to warm up the error handling too).
+'''
+
+from __future__ import unicode_literals
+
+CORPUS = [
+    b'''#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Module docstring."""
+from __future__ import print_function
+import os,sys
+from collections import (OrderedDict,
+    namedtuple)
+
+CONSTANT=10
+Point=namedtuple( 'Point',['x','y'] )
+
+
+class Base( object ):
+    """Class docstring."""
+    attr=[1,2,3]
+
+    def __init__(self,a,b=None,*args,**kwargs):
+        super(Base,self).__init__()
+        self.a=a;self.b=b
+        self.args=args
+        self.kwargs=kwargs
+
+    @property
+    def value(self):
+        return self.a+self.b*2-(self.a/3)%4
+
+    @staticmethod
+    def create(  **kwargs ):
+        return Base(**kwargs)
+
+    def __repr__(self):
+        return '%s(%r, %r)'%(self.__class__.__name__,self.a,self.b)
+
+
+class Derived(Base):
+
+    def method(self,items):
+        result={}
+        for i,item in enumerate(items):
+            if item is None :continue
+            elif isinstance(item,(int,float)):
+                result[i]=item**2
+            else:
+                result[i]=str(item).strip().lower()
+        return result
+''',
+    b'''def process(data,callback=lambda x:x,*,key=None,reverse=False):
+    squares=[x*x for x in data if x%2==0]
+    mapping={k:v for k,v in zip(data,squares)}
+    unique={x for x in data}
+    gen=(callback(x) for x in sorted(data,key=key,reverse=reverse))
+    try:
+        with open('file.txt','r') as f,open('other.txt') as g:
+            contents=f.read()+g.read()
+    except (IOError,OSError) as e:
+        print('error',e,file=sys.stderr)
+        raise
+    except Exception:
+        pass
+    else:
+        return contents
+    finally:
+        del squares[:]
+    while True:
+        x=yield
+        if not x:break
+    assert len(mapping)>=0,'message'
+    return [a[1:-1] for a in data[::2]],mapping.get('a',{}).get('b')
+
+
+async def fetch(session,url,*args,timeout=10,**kwargs):
+    async with session.get(url,timeout=timeout) as response:
+        async for chunk in response.content.iter_chunked(1024):
+            await process(chunk)
+    return await response.text()
+''',
+    b'''@decorator
+@other.decorator(arg=1,other=[1,2,3])
+def decorated(a,b:int=1,c:'str'='c')->dict:
+    global CONSTANT
+    x=a if b else c
+    y=not a and b or c
+    z=a<b<=c!=a is not None
+    w=~a|b&c^a<<2>>1
+    values=[
+        1,2,3,
+        4,5,6,
+    ]
+    d={'a':1,'b':[1,2,{'c':(3,4)}],
+       'd':"string with 'quotes'",'e':"""triple
+quoted"""}
+    s=r'raw\\string'+b'bytes'.decode('utf-8')+u'unicode'
+    t=('a'
+       'b')
+    call(a,b,*values,key=d['a'],**d)
+    obj.attr.method(1)[0].other(  )
+    lambda_=lambda a,b=1,*c,**d:(a,b,c,d)
+    a+=1;b-=1;c*=2;d/=3;e//=4;f%=5;g**=6;h>>=1;i<<=1;j&=1;k|=1;l^=1
+    if a:
+        pass
+    elif b:
+        pass
+    else:
+        pass
+    return locals()
+''',
+    b'''import unittest
+
+
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.items=list(range(10))#comment
+        # Another comment
+        self.mapping=dict((str(i),i) for i in self.items)
+
+    def test_something(self):
+        self.assertEqual(len(self.items),10)
+        self.assertTrue(all(isinstance(i,int) for i in self.items))
+        with self.assertRaises(KeyError):
+            self.mapping['invalid']
+
+    def test_other(self):
+        for key,value in sorted(self.mapping.items(),key=lambda kv:kv[1]):
+            self.assertEqual(int(key),value)
+        class Local(object):
+            def __init__(self):
+                self.x=[[1,2],[3,4]]
+        self.assertEqual(Local().x[1][0],3)
+
+
+if __name__=='__main__':
+    unittest.main()
+''',
+    b'''class Broken(object):
+    def method(self:
+        pass
+''',
+]
@@ -0,0 +1,15 @@
+import os
+import sys
+
+import pytest
+
+if sys.version_info[:2] < (3, 6):
+    collect_ignore = ['test_code_format_async.py']
+
+
+@pytest.fixture(scope='session', autouse=True)
+def disable_result_cache():
+    # Tests should actually exercise the formatter (tests for the cache enable it explicitly).
+    os.environ['PYDEVF_CACHE'] = '0'
+    yield
+    del os.environ['PYDEVF_CACHE']
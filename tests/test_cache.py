@@ -0,0 +1,106 @@
+from __future__ import unicode_literals
+
+import pytest
+
+from test_code_format_api import code1, code1_expected, code_error
+
+
+@pytest.fixture
+def result_cache(tmpdir):
+    from pydevf import _pydevf
+    _pydevf._configure_result_cache(enabled=True, cache_dir=str(tmpdir.join('cache')))
+    yield _pydevf._get_result_cache()
+    _pydevf._configure_result_cache(enabled=False)
+
+
+def test_result_cache(tmpdir):
+    from pydevf import _cache
+
+    cache = _cache.ResultCache(str(tmpdir), 'identity', max_size=1000)
+    h1 = _cache.compute_content_hash(b'a = 1\n')
+    assert h1 == '1337a530cbc1bd7d20aee2d80f1f174a9182417d'  # Same as git hash-object.
+    assert cache.get(h1) is None
+
+    cache.put_result(h1, b'a = 1\n', b'a = 1\n')
+    assert cache.get(h1) == (_cache.ALREADY_FORMATTED, b'')
+
+    h2 = _cache.compute_content_hash(b'a=1')
+    cache.put_result(h2, b'a=1', b'a = 1\n')
+    assert cache.get(h2) == (_cache.FORMATTED, b'a = 1\n')
+
+    h3 = _cache.compute_content_hash(b'a=(')
+    cache.put(h3, _cache.SYNTAX_ERROR, b'error')
+    assert cache.get(h3) == (_cache.SYNTAX_ERROR, b'error')
+
+    # A different formatter doesn't see the entries.
+    assert _cache.ResultCache(str(tmpdir), 'identity2').get(h2) is None
+
+
+def test_result_cache_trim(tmpdir):
+    import os
+    import time
+    from pydevf import _cache
+
+    cache = _cache.ResultCache(str(tmpdir), 'identity', max_size=1000)
+    hashes = []
+    for i in range(10):
+        h = _cache.compute_content_hash(str(i).encode('ascii'))
+        cache.put(h, _cache.FORMATTED, b'x' * 199)
+        # Make sure the mtime reflects the order in which entries were used.
+        t = time.time() - 100 + i
+        os.utime(cache._get_entry_path(h), (t, t))
+        hashes.append(h)
+
+    cache.trim()
+    remaining = [h for h in hashes if cache.get(h) is not None]
+    # Only the most recently used entries are kept (up to 80% of the max size).
+    assert remaining == hashes[-4:]
+
+
+def test_file_index(tmpdir):
+    import os
+    import time
+    from pydevf import _cache
+
+    p = tmpdir.join('a.py')
+    p.write('a = 1\n')
+    index = _cache.FileIndex(str(tmpdir.join('index', 'index.json'))).load()
+    assert not index.is_unchanged(str(p))
+
+    # Recently modified: not recorded.
+    index.record(str(p), os.stat(str(p)), 'hash')
+    assert not index.is_unchanged(str(p))
+
+    t = time.time() - 10
+    os.utime(str(p), (t, t))
+    index.record(str(p), os.stat(str(p)), 'hash')
+    assert index.is_unchanged(str(p))
+    index.save()
+
+    index = _cache.FileIndex(str(tmpdir.join('index', 'index.json'))).load()
+    assert index.is_unchanged(str(p))
+    assert index.get_content_hash(str(p)) == 'hash'
+
+    p.write('a = 10\n')
+    os.utime(str(p), (t, t))
+    assert not index.is_unchanged(str(p))
+
+
+def test_format_code_cached(result_cache, monkeypatch):
+    from pydevf import _pydevf
+    from pydevf import format_code
+
+    assert format_code(code1) == code1_expected
+    assert format_code(code1_expected) == code1_expected
+    with pytest.raises(RuntimeError):
+        format_code(code_error)
+
+    def _create_process(mode):
+        raise AssertionError('Result should be cached.')
+
+    monkeypatch.setattr(_pydevf, '_create_process', _create_process)
+    assert format_code(code1) == code1_expected
+    assert format_code(code1.encode('utf-8')) == code1_expected.encode('utf-8')
+    assert format_code(code1_expected) == code1_expected
+    with pytest.raises(RuntimeError):
+        format_code(code_error)
@@ -1,5 +1,10 @@
+# coding: utf-8
 from __future__ import unicode_literals
 
+import sys
+
+import pytest
+
 code1 = '''
 class A( object ):
     def method(self,a,b,c):
@@ -53,6 +58,30 @@ def test_format_multiple():
     stop_format_server(process)
 
 
+def test_format_server_respawn():
+    from pydevf import start_format_server
+    from pydevf import format_code_server
+    from pydevf import stop_format_server
+    from pydevf._pydevf import _get_current_process, _get_restarts
+
+    process = start_format_server()
+    try:
+        assert format_code_server(process, code1) == code1_expected
+
+        # The java process dies: a new one is started transparently.
+        _get_current_process(process).kill()
+        _get_current_process(process).wait()
+        assert format_code_server(process, code1) == code1_expected
+        assert _get_restarts(process) == 1
+        assert _get_current_process(process) is not process
+    finally:
+        stop_format_server(process)
+
+    with pytest.raises(RuntimeError):
+        format_code_server(process, code1)
+    assert _get_restarts(process) == 1
+
+
 def test_format_daemon():
     import os.path
     import pydevf
@@ -70,3 +99,644 @@ def test_format_daemon():
 
         with pytest.raises(RuntimeError):
             format_code_using_daemon(code_error)
+
+
+def test_worker_pool():
+    import threading
+    from pydevf._pydevf import _WorkerPool
+
+    pool = _WorkerPool(2)
+    pool.start()
+    results = []
+    errors = []
+
+    def format_in_thread():
+        results.append(pool.format_code(code1))
+        try:
+            pool.format_code(code_error)
+        except RuntimeError as e:
+            errors.append(e)
+
+    try:
+        threads = [threading.Thread(target=format_in_thread) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        pool.stop()
+
+    assert results == [code1_expected] * 4
+    assert len(errors) == 4
+    assert len(pool._workers) <= 2
+
+
+def test_format_daemon_reuses_connection():
+    from pydevf import format_code_using_daemon
+    from pydevf._pydevf import _daemon_client
+
+    assert format_code_using_daemon(code1) == code1_expected
+    assert len(_daemon_client._idle_connections) == 1
+    connection = _daemon_client._idle_connections[0]
+
+    assert format_code_using_daemon(code1) == code1_expected
+    assert _daemon_client._idle_connections == [connection]
+
+    # Simulate a daemon restart: the broken connection must be transparently replaced.
+    connection.sock.shutdown(2)
+    assert format_code_using_daemon(code1) == code1_expected
+    assert _daemon_client._idle_connections[0] is not connection
+
+
+def test_format_many_daemon():
+    from pydevf import format_many_using_daemon
+
+    codes = [code1, code_error, code1.encode('utf-8'), '']
+    results = list(format_many_using_daemon(codes, batch_size=3))
+    assert len(results) == 4
+
+    assert results[0] == (code1_expected, None)
+
+    formatted, error = results[1]
+    assert formatted is None
+    assert 'Error' in error
+
+    assert results[2] == (code1_expected.encode('utf-8'), None)
+    assert results[3] == ('', None)
+
+    assert list(format_many_using_daemon([])) == []
+
+
+def test_format_daemon_pipelined():
+    from pydevf._pydevf import _connect_to_daemon_process, _read, _write
+
+    connection = _connect_to_daemon_process()
+    try:
+        codes = {'1': code1, '2': code_error, '3': code1_expected, '4': code1}
+        for request_id, code in codes.items():
+            headers = [('Operation', 'format'), ('Request-Id', request_id)]
+            if request_id == '3':
+                headers.append(('Compare-Input', '1'))
+            _write(connection.write_to_stream, code, headers)
+
+        answers = {}
+        for _ in codes:
+            header, body = _read(connection.read_from_stream)
+            answers[header['Request-Id']] = (header, body)
+
+        assert answers['1'][0]['Result'] == 'Ok'
+        assert answers['1'][1] == code1_expected
+        assert answers['2'][0]['Result'] == 'SyntaxError'
+        assert answers['3'][0]['Unchanged'] == '1'
+        assert answers['4'][1] == code1_expected
+    finally:
+        connection.close()
+
+
+def test_daemon_address():
+    import pytest
+    from pydevf._pydevf import _format_address, _parse_address
+
+    assert _parse_address(_format_address(1234)) == 1234
+    path = '/tmp/pydevf-0/daemon.sock'
+    assert _parse_address(_format_address(path)) == path
+    assert _parse_address(b'unix:/tmp/a.sock  \n') == '/tmp/a.sock'
+    for invalid in (b'', b'   ', b'unix:'):
+        with pytest.raises(ValueError):
+            _parse_address(invalid)
+
+
+@pytest.mark.parametrize('transport', ['unix', 'tcp'])
+def test_format_daemon_transport(transport, monkeypatch, tmpdir):
+    import socket
+    import sys
+    import time
+    from pydevf import exit_daemon
+    from pydevf import format_code_using_daemon
+    from pydevf._pydevf import (
+        _FormatFileNotAllowed, _format_file_using_daemon, _get_daemon_address)
+
+    if transport == 'unix' and (sys.platform == 'win32' or not hasattr(socket, 'AF_UNIX')):
+        pytest.skip('Unix sockets not available.')
+
+    monkeypatch.setenv('PYDEVF_TRANSPORT', transport)
+    exit_daemon()
+    time.sleep(1)
+    try:
+        assert format_code_using_daemon(code1) == code1_expected
+        address = _get_daemon_address(create_if_not_there=False)
+        if transport == 'tcp':
+            assert isinstance(address, int)
+            # Anyone may connect through tcp: files are never rewritten by the daemon.
+            target = tmpdir.join('target.py')
+            target.write_binary(code1.encode('utf-8'))
+            with pytest.raises(_FormatFileNotAllowed):
+                _format_file_using_daemon(str(target))
+            assert target.read_binary() == code1.encode('utf-8')
+        else:
+            import os
+            import stat
+            assert not isinstance(address, int)
+            assert stat.S_ISSOCK(os.stat(address).st_mode)
+            assert stat.S_IMODE(os.stat(os.path.dirname(address)).st_mode) == 0o700
+    finally:
+        # Don't keep a daemon with a non-default transport for the other tests.
+        exit_daemon()
+        time.sleep(1)
+
+
+def test_daemon_connection_check():
+    import socket
+    import threading
+    from pydevf._pydevf import _DaemonConnection, _create_client_socket
+
+    # Some other process listening on a (stale) port published by the daemon.
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+
+    def answer():
+        sock, _address = server.accept()
+        sock.recv(1024)
+        sock.sendall(b'Content-Length: 3\r\n\r\nbad')
+        sock.close()
+
+    t = threading.Thread(target=answer)
+    t.start()
+    connection = _DaemonConnection(_create_client_socket(server.getsockname()[1]))
+    try:
+        with pytest.raises(RuntimeError):
+            connection.check_daemon()
+    finally:
+        connection.close()
+        t.join()
+        server.close()
+
+
+def test_is_trusted_peer():
+    import socket
+    from pydevf._pydevf import _is_trusted_peer
+
+    if hasattr(socket, 'socketpair') and hasattr(socket, 'AF_UNIX'):
+        sock1, sock2 = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            assert _is_trusted_peer(sock1)
+        finally:
+            sock1.close()
+            sock2.close()
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    client = socket.create_connection(server.getsockname())
+    accepted, _address = server.accept()
+    try:
+        assert not _is_trusted_peer(accepted)
+    finally:
+        for sock in (client, accepted, server):
+            sock.close()
+
+
+def test_format_file_daemon(tmpdir):
+    from pydevf._cache import compute_content_hash
+    from pydevf._pydevf import _format_file_using_daemon
+
+    # Note: non-ascii paths must be properly sent to the daemon.
+    target = tmpdir.join('n\xe3o_formatado.py')
+    target.write_binary(code1.encode('utf-8'))
+    expected = code1_expected.encode('utf-8')
+
+    assert _format_file_using_daemon(str(target)) == (True, compute_content_hash(expected))
+    assert target.read_binary() == expected
+
+    assert _format_file_using_daemon(str(target), fsync=True) == (
+        False, compute_content_hash(expected))
+    assert target.read_binary() == expected
+
+    error_file = tmpdir.join('error.py')
+    error_file.write_binary(code_error.encode('utf-8'))
+    with pytest.raises(RuntimeError):
+        _format_file_using_daemon(str(error_file))
+    assert error_file.read_binary() == code_error.encode('utf-8')
+
+    with pytest.raises(RuntimeError):
+        _format_file_using_daemon(str(tmpdir.join('does_not_exist.py')))
+
+    # The daemon never uses the cache of the client (it refuses if it's not its own).
+    from pydevf._pydevf import _FormatFileNotAllowed, _configure_result_cache
+    _configure_result_cache(enabled=True, cache_dir=str(tmpdir.join('client_cache')))
+    try:
+        with pytest.raises(_FormatFileNotAllowed):
+            _format_file_using_daemon(str(target))
+    finally:
+        _configure_result_cache()
+
+
+def test_file_writer_fsync(tmpdir):
+    from pydevf._pydevf import _FileWriter
+
+    files = [tmpdir.join('file%s.py' % (i,)) for i in range(3)]
+    for f in files:
+        f.write_binary(b'old')
+
+    writer = _FileWriter(fsync=True, batch_size=2)
+    assert not writer.write(str(files[0]), b'new')
+    # The second write completes the batch (so, both files are replaced).
+    assert not writer.write(str(files[1]), b'new')
+    assert [f.read_binary() for f in files[:2]] == [b'new', b'new']
+
+    # An aborted run must not leave temporary files around.
+    assert not writer.write(str(files[2]), b'new')
+    writer.discard()
+    writer.flush()
+    assert files[2].read_binary() == b'old'
+    assert sorted(x.basename for x in tmpdir.listdir()) == [f.basename for f in files]
+
+
+def test_framing():
+    import io
+    from pydevf._pydevf import _read, _write, _get_stream_lock
+
+    stream = io.BytesIO()
+    _write(stream, 'ação', [('Operation', 'format')])
+    _write(stream, b'x' * 100000, [('Path', '/tmp/n\xe3o.py')])
+    stream.seek(0)
+
+    assert _read(stream) == ({'Content-Length': '6', 'Operation': 'format'}, 'ação')
+    header, body = _read(stream, decode=False)
+    assert header['Path'] == '/tmp/n\xe3o.py'
+    assert body == b'x' * 100000
+    assert _read(stream) == ({}, None)
+
+    # EOF in the middle of the body.
+    for decode in (True, False):
+        with pytest.raises(RuntimeError):
+            _read(io.BytesIO(b'Content-Length: 10\r\n\r\nabc'), decode=decode)
+
+    other = io.BytesIO()
+    assert _get_stream_lock(stream) is _get_stream_lock(stream)
+    assert _get_stream_lock(stream) is not _get_stream_lock(other)
+
+
+def test_format_daemon_bytes():
+    from pydevf import format_code_using_daemon
+
+    # Not valid utf-8: the daemon must not try to decode it.
+    code = b'# coding: latin-1\nx  =  "\xe3"\n'
+    assert format_code_using_daemon(code) == b'# coding: latin-1\nx = "\xe3"\n'
+
+    formatted = format_code_using_daemon(code1.encode('utf-8'))
+    assert isinstance(formatted, bytes)
+    assert formatted == code1_expected.encode('utf-8')
+
+    formatted = format_code_using_daemon(code1_expected)
+    assert formatted == code1_expected
+    assert not isinstance(formatted, bytes)
+
+
+def test_worker_pool_warmup():
+    import time
+    from pydevf._pydevf import _WorkerPool
+    from pydevf._warmup_corpus import CORPUS
+
+    pool = _WorkerPool(2, warmup_rounds=2)
+    pool.start()
+    try:
+        # Requests are answered while warming up (and don't start new workers).
+        assert pool.format_code(code1) == code1_expected
+        timeout_at = time.time() + 30
+        while not pool.get_stats()['workers'][0]['warmed_up']:
+            assert time.time() < timeout_at
+            time.sleep(.05)
+        stats = pool.get_stats()
+    finally:
+        pool.stop()
+
+    assert len(stats['workers']) == 1
+    worker_stats = stats['workers'][0]
+    assert worker_stats['warmup_snippets'] == 2 * len(CORPUS)
+    assert worker_stats['requests'] == 1
+    assert worker_stats['first_request_time'] > 0
+    assert stats['first_request_latency'] >= worker_stats['first_request_time']
+
+
+def test_daemon_concurrent_launch():
+    import threading
+    import time
+    from pydevf import exit_daemon
+    from pydevf._pydevf import _get_daemon_address, _read_published_address, _daemon_client
+
+    exit_daemon()
+    time.sleep(1)
+    assert _read_published_address() is None
+
+    addresses = []
+
+    def get_address():
+        addresses.append(_get_daemon_address())
+
+    # Only one of the threads launches the daemon (the others wait for it).
+    threads = [threading.Thread(target=get_address) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(set(addresses)) == 1
+    assert _read_published_address() == addresses[0]
+    header, body = _daemon_client.request('', [('Operation', 'ping')])
+    assert body == 'pong'
+
+
+def test_daemon_launch_ignores_cwd(tmpdir, monkeypatch):
+    import time
+    from pydevf import exit_daemon, format_code_using_daemon
+
+    # A decoy pydevf package in the current dir must not be imported by the daemon.
+    marker = tmpdir.join('decoy_imported')
+    decoy = tmpdir.mkdir('pydevf')
+    decoy.join('__init__.py').write('')
+    decoy.join('_pydevf.py').write(
+        'open(%r, "w").close()\nraise ImportError("decoy")\n' % (str(marker),))
+
+    exit_daemon()
+    time.sleep(1)
+    monkeypatch.chdir(tmpdir)
+    try:
+        assert format_code_using_daemon(code1) == code1_expected
+        assert not marker.exists()
+    finally:
+        monkeypatch.undo()
+        # Don't keep a daemon started from the temporary dir for the other tests.
+        exit_daemon()
+        time.sleep(1)
+
+
+def test_worker_pool_recycle():
+    import time
+    from pydevf._pydevf import _WorkerPool
+
+    pool = _WorkerPool(1, max_requests=2)
+    pool.start()
+    try:
+        initial_pid = pool.get_stats()['workers'][0]['pid']
+        for _ in range(2):
+            assert pool.format_code(code1) == code1_expected
+
+        # The replacement is started in the background and swapped when ready.
+        timeout_at = time.time() + 30
+        while pool.get_stats()['workers'][0]['recycles'] == 0:
+            assert time.time() < timeout_at
+            time.sleep(.05)
+
+        assert pool.format_code(code1) == code1_expected
+        stats = pool.get_stats()
+    finally:
+        pool.stop()
+
+    worker_stats = stats['workers'][0]
+    assert worker_stats['pid'] != initial_pid
+    assert worker_stats['requests'] == 3
+    assert worker_stats['process_requests'] == 1
+    assert not worker_stats['recycling']
+
+
+def test_process_rss():
+    import os
+    import sys
+    from pydevf._pydevf import _get_process_rss
+
+    rss = _get_process_rss(os.getpid())
+    if sys.platform.startswith('linux'):
+        assert rss > 0
+    else:
+        assert rss is None
+
+
+def test_daemon_idle_exit():
+    import os
+    import time
+    from pydevf import exit_daemon, format_code_using_daemon
+    from pydevf._pydevf import _get_daemon_address, _read_published_address
+
+    exit_daemon()
+    time.sleep(1)
+    os.environ['PYDEVF_IDLE_TIMEOUT'] = '0.02'  # ~1 second.
+    try:
+        _get_daemon_address()
+    finally:
+        del os.environ['PYDEVF_IDLE_TIMEOUT']
+
+    assert format_code_using_daemon(code1) == code1_expected
+    timeout_at = time.time() + 30
+    while _read_published_address() is not None:
+        assert time.time() < timeout_at
+        time.sleep(.1)
+
+
+def test_worker_pool_idle_exit():
+    import time
+    from pydevf._pydevf import _WorkerPool
+
+    pool = _WorkerPool(1)
+    time.sleep(.2)
+    # A request being received/handled keeps the daemon alive.
+    assert pool.begin_request()
+    time.sleep(.2)
+    assert not pool.start_exit_if_idle(.1)
+    assert pool.get_idle_time() == 0
+    pool.end_request()
+    assert not pool.start_exit_if_idle(.1)
+
+    time.sleep(.2)
+    assert pool.start_exit_if_idle(.1)
+    # Once exiting, new requests are refused.
+    assert not pool.begin_request()
+    assert pool.is_exiting()
+
+
+def test_worker_pool_respawn():
+    import time
+    from pydevf._pydevf import _WorkerPool, _get_current_process
+
+    pool = _WorkerPool(1)
+    pool.start()
+    try:
+        assert pool.format_code(code1) == code1_expected
+
+        # Dies while idle: respawned in the background.
+        worker = pool._workers[0]
+        initial_pid = pool.get_stats()['workers'][0]['pid']
+        _get_current_process(worker.process).kill()
+        timeout_at = time.time() + 30
+        while pool.get_stats()['workers'][0]['pid'] == initial_pid:
+            assert time.time() < timeout_at
+            time.sleep(.05)
+        assert pool.format_code(code1) == code1_expected
+
+        # Dies right before a request: the request is retried in a new process.
+        _get_current_process(worker.process).kill()
+        assert pool.format_code(code1) == code1_expected
+        stats = pool.get_stats()
+    finally:
+        pool.stop()
+
+    assert stats['restarts'] == 2
+    assert stats['workers'][0]['restarts'] == 2
+
+
+# A formatter which answers with the code unchanged (but never answers if the code
+# has 'stuck' in it).
+_FAKE_FORMATTER = r"""
+import sys, time
+stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+while True:
+    size = None
+    while True:
+        line = stdin.readline()
+        if not line:
+            sys.exit(0)
+        if not line.strip():
+            break
+        if line.startswith(b'Content-Length:'):
+            size = int(line.split(b':')[1])
+    body = stdin.read(size)
+    if b'stuck' in body:
+        time.sleep(60)
+    stdout.write(b'Result: Ok\r\nContent-Length: %d\r\n\r\n' % (len(body),) + body)
+    stdout.flush()
+"""
+
+
+@pytest.fixture
+def fake_formatter(monkeypatch):
+    import subprocess
+    import sys
+    from pydevf import _pydevf
+
+    def _create_process(mode, short_lived=False):
+        return subprocess.Popen(
+            [sys.executable, '-c', _FAKE_FORMATTER],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    monkeypatch.setattr(_pydevf, '_create_process', _create_process)
+
+
+def test_format_server_timeout(fake_formatter):
+    from pydevf import start_format_server
+    from pydevf import format_code_server
+    from pydevf import stop_format_server
+    from pydevf._pydevf import TimeoutError, _get_restarts
+
+    process = start_format_server()
+    try:
+        assert format_code_server(process, 'a = 1', timeout=5) == 'a = 1'
+        with pytest.raises(TimeoutError):
+            format_code_server(process, 'stuck', timeout=.5)
+        # The stuck process is killed and replaced.
+        assert format_code_server(process, 'a = 1') == 'a = 1'
+        assert _get_restarts(process) == 1
+    finally:
+        stop_format_server(process)
+
+
+def test_worker_pool_timeout(fake_formatter):
+    import time
+    from pydevf._pydevf import _WorkerPool, TimeoutError, _check_result
+
+    pool = _WorkerPool(2, timeout=30)
+    pool.start()
+    try:
+        initial_time = time.time()
+        stuck_task = pool.submit('stuck', timeout=.5)
+        # Other requests are answered by another worker meanwhile.
+        assert pool.format_code('a = 1') == 'a = 1'
+        stuck_task.event.wait()
+        assert isinstance(stuck_task.exception, TimeoutError)
+        assert time.time() - initial_time < 10
+
+        # Waiting in the queue counts for the timeout too.
+        tasks = [pool.submit('stuck', timeout=.5) for _ in range(3)]
+        for task in tasks:
+            task.event.wait()
+            assert isinstance(task.exception, TimeoutError)
+        assert pool.format_code('a = 1') == 'a = 1'
+        stats = pool.get_stats()
+    finally:
+        pool.stop()
+
+    assert stats['restarts'] >= 2
+    with pytest.raises(TimeoutError):
+        _check_result({'Result': 'Timeout'}, 'Timed out.')
+
+
+def test_worker_pool_timeout_queued(fake_formatter):
+    import threading
+    import time
+    from pydevf import start_format_server, format_code_server, stop_format_server
+    from pydevf._pydevf import _WorkerPool, TimeoutError
+
+    pool = _WorkerPool(1)
+    pool.start()
+    try:
+        # A task without timeout is stuck in the only worker.
+        stuck_task = pool.submit('stuck', timeout=0)
+        initial_time = time.time()
+        with pytest.raises(TimeoutError):
+            pool.format_code('a = 1', timeout=.5)
+        assert time.time() - initial_time < 5
+        assert not stuck_task.event.is_set()
+    finally:
+        pool.stop()
+
+    # Waiting for other threads using the same server also counts for the timeout.
+    process = start_format_server()
+
+    def format_stuck():
+        try:
+            format_code_server(process, 'stuck', timeout=0)
+        except Exception:
+            pass  # Expected: the server is stopped while formatting.
+
+    t = threading.Thread(target=format_stuck)
+    t.start()
+    try:
+        time.sleep(.5)
+        initial_time = time.time()
+        with pytest.raises(TimeoutError):
+            format_code_server(process, 'a = 1', timeout=.5)
+        assert time.time() - initial_time < 5
+    finally:
+        stop_format_server(process)
+        t.join()
+
+
+@pytest.mark.skipif(sys.version_info[:2] < (3, 7), reason='-X importtime requires python 3.7')
+def test_import_time():
+    import os
+    import subprocess
+    import pydevf
+
+    # Importing the library (as the daemon and editor integrations do) must not import
+    # the command line (click) nor the asyncio API.
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(pydevf.__file__)))
+    process = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', 'import pydevf._pydevf'],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=env,
+    )
+    _stdout, stderr = process.communicate()
+    assert process.returncode == 0, stderr
+    imported = set(
+        line.split('|')[-1].strip() for line in stderr.decode('utf-8').splitlines()
+        if line.startswith('import time:'))
+    assert 'pydevf._pydevf' in imported
+    for module in ('click', 'asyncio', 'pydevf._cli', 'pydevf._pydevf_async'):
+        assert module not in imported
+
+    # The asyncio API is still available (imported on first use).
+    assert pydevf.format_code_async is not None
@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+from test_code_format_api import code1, code1_expected, code_error
+
+
+@pytest.fixture
+def loop():
+    from pydevf._pydevf_async import _clients
+    loop = asyncio.new_event_loop()
+    yield loop
+    client = _clients.pop(loop, None)
+    if client is not None:
+        client.close()
+        loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+
+
+def test_format_code_async(loop):
+    from pydevf import format_code_async
+    from pydevf._pydevf_async import _get_client
+
+    async def check():
+        # Many requests may be in flight at the same time.
+        results = await asyncio.gather(*[format_code_async(code1) for _ in range(10)])
+        assert results == [code1_expected] * 10
+        assert await format_code_async(code1.encode('utf-8')) == code1_expected.encode('utf-8')
+
+        with pytest.raises(RuntimeError):
+            await format_code_async(code_error)
+
+        # All the requests are pipelined in a single connection.
+        client = _get_client()
+        connection = client._connection
+        await asyncio.gather(*[format_code_async(code1) for _ in range(10)])
+        assert client._connection is connection
+
+        # If the connection is broken a new one is transparently created.
+        connection.writer.close()
+        assert await format_code_async(code1) == code1_expected
+        assert client._connection is not connection
+
+    loop.run_until_complete(check())
+
+
+def test_format_code_async_large_concurrent(loop):
+    from pydevf import format_code_async
+
+    # Large requests fill the socket buffer (so, the writers must wait for the
+    # transport to be resumed while others are also writing to the same stream).
+    large_code = code1 * 5000
+
+    async def check():
+        expected = await format_code_async(large_code)
+        results = await asyncio.gather(*[format_code_async(large_code) for _ in range(20)])
+        assert results == [expected] * 20
+
+    loop.run_until_complete(check())
+
+
+def test_format_many_async(loop):
+    from pydevf import format_many_async
+
+    async def codes():
+        for code in [code1, code_error, code1.encode('utf-8')]:
+            yield code
+
+    async def check():
+        results = [result async for result in format_many_async(codes(), batch_size=2)]
+        assert results[0] == (code1_expected, None)
+        assert results[1][0] is None
+        assert results[2] == (code1_expected.encode('utf-8'), None)
+
+        results = [result async for result in format_many_async([code1])]
+        assert results == [(code1_expected, None)]
+
+    loop.run_until_complete(check())
+
+
+def test_format_many_async_pipelined(loop):
+    from pydevf import format_many_async
+
+    # Many batches of large snippets pipelined in the same connection at once.
+    large_code = code1 * 1000
+
+    async def format_all():
+        return [result async for result in format_many_async([large_code] * 6, batch_size=2)]
+
+    async def check():
+        expected = [result async for result in format_many_async([large_code])]
+        results = await asyncio.gather(*[format_all() for _ in range(8)])
+        assert results == [expected * 6] * 8
+
+    loop.run_until_complete(check())
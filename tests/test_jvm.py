@@ -0,0 +1,85 @@
+from __future__ import unicode_literals
+
+import os
+import sys
+
+import pytest
+
+
+def test_parse_java_version():
+    from pydevf._jvm import parse_java_version
+
+    assert parse_java_version('java version "1.8.0_111"\nJava(TM) SE Runtime') == 8
+    assert parse_java_version('openjdk version "11.0.2" 2019-01-15') == 11
+    assert parse_java_version('openjdk version "25" 2025-09-16') == 25
+    assert parse_java_version('openjdk version "9-ea"') == 9
+    assert parse_java_version('command not found') is None
+
+
+def test_java_options(monkeypatch):
+    from pydevf import _jvm
+
+    monkeypatch.delenv(_jvm.JAVA_OPTS_ENV_VAR, raising=False)
+    assert _jvm.get_java_options(8, True) == _jvm.STARTUP_OPTIONS + ['-Xverify:none']
+    assert _jvm.get_java_options(17, True) == _jvm.STARTUP_OPTIONS
+    assert _jvm.get_java_options(17, False) == _jvm.SERVER_OPTIONS
+
+    monkeypatch.setenv(_jvm.JAVA_OPTS_ENV_VAR, '-Xmx64m -Xshare:off')
+    assert _jvm.get_java_options(17, True) == ['-Xmx64m', '-Xshare:off']
+    # With -Xshare in the options the AppCDS archive isn't used.
+    assert _jvm.get_launch_args('java', 17, ['-Xshare:off'], 'f.jar', 'cache', 'id') == [
+        '-jar', 'f.jar']
+
+
+def test_cds_options():
+    from pydevf import _jvm
+
+    assert _jvm.get_cds_options(_jvm.STARTUP_OPTIONS) == ['-XX:+UseSerialGC']
+    assert _jvm.get_cds_options(
+        ['-Xmx64m', '-XX:TieredStopAtLevel=1', '-XX:-UseCompressedOops', '-XX:+UseG1GC',
+         '-Dname=value', '--add-opens', 'java.base/java.lang=ALL-UNNAMED']) == [
+        '-Xmx64m', '-XX:-UseCompressedOops', '-XX:+UseG1GC', '--add-opens',
+        'java.base/java.lang=ALL-UNNAMED']
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='Uses a shell script as java.')
+def test_java_version_cached(tmpdir):
+    from pydevf._jvm import get_java_version
+
+    java = tmpdir.join('java')
+    java.write('#!/bin/sh\necho \'openjdk version "17.0.1" 2021-10-19\'\n')
+    java.chmod(0o755)
+    cache_dir = str(tmpdir.join('cache'))
+    assert get_java_version(str(java), cache_dir) == 17
+
+    # Cached while the executable doesn't change (java isn't even executed).
+    java.chmod(0o644)
+    assert get_java_version(str(java), cache_dir) == 17
+
+    java.write('#!/bin/sh\necho \'openjdk version "21" 2023-09-19\'\n')
+    java.setmtime(java.mtime() - 10)
+    java.chmod(0o755)
+    assert get_java_version(str(java), cache_dir) == 21
+
+
+def test_cds_archive(tmpdir):
+    import subprocess
+    from pydevf import _jvm
+    from pydevf._pydevf import target_jar, java_executable, _get_formatter_identity
+
+    java_path = _jvm.find_java(java_executable)
+    version = _jvm.get_java_version(java_path, str(tmpdir))
+    if version is None or version < 11:
+        pytest.skip('AppCDS archive not created for java %s.' % (version,))
+
+    options = _jvm.get_java_options(version, True)
+    launch_args = _jvm.get_launch_args(
+        java_path, version, options, target_jar, str(tmpdir), _get_formatter_identity())
+    assert launch_args[-1] == _jvm.MAIN_CLASS
+    archive = launch_args[0].split('=', 1)[1]
+    assert os.path.exists(archive)
+
+    process = subprocess.Popen(
+        [java_path] + options + launch_args + ['-single'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    assert process.communicate(b'a  =  1\n')[0].strip() == b'a = 1'
@@ -0,0 +1,40 @@
+from __future__ import unicode_literals
+
+
+def test_histogram():
+    from pydevf._metrics import Histogram
+
+    histogram = Histogram(buckets=(.1, 1))
+    for value in (.05, .1, .5, 2):
+        histogram.observe(value)
+    assert histogram.to_dict() == {
+        'count': 4,
+        'sum': 2.65,
+        'buckets': [[.1, 2], [1, 3], ['+Inf', 4]],
+    }
+
+
+def test_openmetrics():
+    from pydevf._metrics import Metrics, to_openmetrics
+
+    metrics = Metrics()
+    metrics.on_connection(1)
+    metrics.on_request('format')
+    metrics.on_error('SyntaxError')
+    metrics.on_received(10)
+    metrics.on_sent(20, .001)
+    metrics.observe('format', .002)
+    stats = metrics.get_stats()
+    stats.update({'pending': 0, 'uptime': 1.5, 'workers': [{'rss': None, 'requests': 1}]})
+
+    text = to_openmetrics(stats)
+    lines = text.splitlines()
+    assert 'pydevf_requests_total{operation="format"} 1' in lines
+    assert 'pydevf_errors_total{result="SyntaxError"} 1' in lines
+    assert 'pydevf_received_bytes_total 10' in lines
+    assert 'pydevf_sent_bytes_total 20' in lines
+    assert 'pydevf_active_connections 1' in lines
+    assert 'pydevf_latency_seconds_bucket{stage="format",le="0.0025"} 1' in lines
+    assert 'pydevf_latency_seconds_count{stage="transfer"} 1' in lines
+    assert 'pydevf_worker_rss_bytes{worker="0"} NaN' in lines
+    assert lines[-1] == '# EOF'
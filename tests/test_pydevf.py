@@ -18,13 +18,16 @@ class _Result(object):
 
 class _Runner(object):
 
-    def invoke(self, args=[], input=None):
+    def invoke(self, args=[], input=None, env=None):
         import pydevf
+        if env is not None:
+            env = dict(os.environ, **env)
         process = subprocess.Popen(
             [sys.executable, pydevf.__file__] + args,
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT
+            stderr=subprocess.STDOUT,
+            env=env,
         )
         if input is not None and not isinstance(input, bytes):
             input = input.encode('utf-8')
@@ -104,3 +107,211 @@ def test_command_line_dir(subdir, hello_file, runner, mode):
     result = runner.invoke(args=[str(subdir)] + mode)
     check_result(result, output='')
     assert hello_file.read('rb') == b"call_it(a, b)" + os.linesep.encode('ascii')
+
+
+def test_command_line_jobs(subdir, runner, mode):
+    files = []
+    for i in range(5):
+        p = subdir.join('hello%s.py' % (i,))
+        p.write('call_%s(a,b)' % (i,))
+        files.append(p)
+    error_file = subdir.join('error.py')
+    error_file.write('call(a,b')
+
+    result = runner.invoke(args=[str(subdir), '--jobs', '3'] + mode)
+    check_result(result, output='Error formatting %s' % (error_file,), exit_code=1)
+    for i, p in enumerate(files):
+        assert p.read('rb') == ('call_%s(a, b)' % (i,)).encode('ascii') + os.linesep.encode('ascii')
+    assert error_file.read('rb') == b'call(a,b'
+
+
+def test_command_line_incremental(tmpdir, subdir, hello_file, runner):
+    cache_dir = str(tmpdir.join('cache'))
+    args = [str(subdir), '--no-daemon', '--incremental', '--cache-dir', cache_dir]
+    result = runner.invoke(args=args)
+    check_result(result, output='')
+    assert hello_file.read('rb') == b"call_it(a, b)" + os.linesep.encode('ascii')
+
+    # Recently modified files aren't trusted by the index (so, make it older
+    # and run again so that it's recorded).
+    hello_file.setmtime(hello_file.mtime() - 10)
+    result = runner.invoke(args=args)
+    check_result(result, output='')
+
+    # Without java in the PATH it still works because the file isn't even read.
+    result = runner.invoke(args=args + ['-v'], env={'PATH': ''})
+    check_result(result, output='Skipped 1 unchanged files.')
+
+    # A changed file must be formatted again.
+    hello_file.write("call_it(a,b,c)")
+    result = runner.invoke(args=args)
+    check_result(result, output='')
+    assert hello_file.read('rb') == b"call_it(a, b, c)" + os.linesep.encode('ascii')
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='Uses symlinks and posix permissions.')
+@pytest.mark.parametrize('fsync', [[], ['--fsync']])
+def test_command_line_write_changed(subdir, hello_file, runner, fsync, mode):
+    formatted = subdir.join('formatted.py')
+    formatted.write_binary(b'call_it(a, b)' + os.linesep.encode('ascii'))
+    formatted.setmtime(formatted.mtime() - 10)
+    formatted_mtime = formatted.mtime()
+
+    hello_file.chmod(0o751)
+    link = subdir.join('link.py')
+    link.mksymlinkto(hello_file)
+
+    result = runner.invoke(args=[str(subdir)] + mode + fsync)
+    check_result(result, output='1 of 2 files changed.')
+    assert hello_file.read('rb') == b"call_it(a, b)" + os.linesep.encode('ascii')
+    assert hello_file.stat().mode & 0o777 == 0o751
+    assert link.islink()
+    assert formatted.mtime() == formatted_mtime
+    assert sorted(x.basename for x in subdir.listdir()) == ['formatted.py', 'hello.py', 'link.py']
+
+
+def test_command_line_check(subdir, hello_file, runner, mode):
+    formatted = subdir.join('formatted.py')
+    formatted.write_binary(b'call_it(a, b)' + os.linesep.encode('ascii'))
+
+    result = runner.invoke(args=[str(subdir), '--check'] + mode)
+    check_result(result, output='Would reformat: %s' % (hello_file,), exit_code=1)
+    assert 'Would reformat: %s' % (formatted,) not in result.output
+    assert hello_file.read('rb') == b"call_it(a,b)"
+
+    result = runner.invoke(args=[str(formatted), '--check'] + mode)
+    check_result(result, output='0 of 1 files would be changed.')
+
+    result = runner.invoke(args=['-', '--check'] + mode, input='call(a,b)')
+    check_result(result, output='Would reformat: -', exit_code=1)
+
+
+def test_command_line_diff(subdir, hello_file, runner, mode):
+    result = runner.invoke(args=[str(subdir), '--diff'] + mode)
+    check_result(result, output='-call_it(a,b)\n+call_it(a, b)\n')
+    assert '%s\t(original)' % (hello_file,) in result.output
+    assert hello_file.read('rb') == b"call_it(a,b)"
+
+    result = runner.invoke(args=[str(subdir), '--diff', '--check'] + mode)
+    check_result(result, output='-call_it(a,b)\n+call_it(a, b)\n', exit_code=1)
+
+
+def test_command_line_stats(hello_file, runner):
+    import json
+    result = runner.invoke(args=[str(hello_file)])
+    check_result(result, output='1 of 1 files changed.')
+
+    result = runner.invoke(args=['--stats'])
+    check_result(result)
+    stats = json.loads(result.output)
+    assert stats['first_request_latency'] > 0
+    assert stats['workers']
+    assert stats['requests']['format_file'] >= 1
+    assert stats['latency']['format']['count'] >= 1
+    assert stats['active_connections'] >= 1
+    assert stats['bytes_in'] > 0 and stats['bytes_out'] > 0
+
+    result = runner.invoke(args=['--daemon-stats', '--stats-format', 'openmetrics'])
+    check_result(result)
+    assert 'pydevf_requests_total{operation="format_file"}' in result.output
+    assert result.output.endswith('# EOF\n')
+
+
+@pytest.mark.parametrize('mode', [[], ['--no-daemon']])
+def test_command_line_trace(hello_file, runner, tmpdir, mode):
+    import json
+    trace_file = str(tmpdir.join('trace.json'))
+    result = runner.invoke(args=[str(hello_file), '--trace', trace_file] + mode)
+    check_result(result, output='1 of 1 files changed.')
+
+    with open(trace_file, 'rb') as stream:
+        events = json.loads(stream.read().decode('utf-8'))['traceEvents']
+    names = set(event['name'] for event in events)
+    assert 'format_file' in names
+    if mode:
+        assert 'jvm_format' in names
+    else:
+        # The spans of the daemon are merged (with the request id of the client).
+        assert 'client_request' in names
+        request_ids = set(
+            event['args'].get('request_id') for event in events
+            if event['name'] in ('client_request', 'jvm_format'))
+        assert len(request_ids) == 1
+        assert None not in request_ids
+
+
+@pytest.fixture
+def git_repo(tmpdir):
+    repo = tmpdir.mkdir('repo')
+
+    def git(*args):
+        subprocess.check_call(
+            ['git', '-c', 'user.name=test', '-c', 'user.email=test@test'] + list(args),
+            cwd=str(repo), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    try:
+        git('init', '-q')
+    except (OSError, subprocess.CalledProcessError):
+        pytest.skip('git not available.')
+    # Regardless of init.defaultBranch (git init -b requires git 2.28).
+    git('symbolic-ref', 'HEAD', 'refs/heads/master')
+    repo.git = git
+    return repo
+
+
+def test_command_line_git(git_repo, runner):
+    git = git_repo.git
+    git_repo.mkdir('pkg').join('committed.py').write('a  =  1\n')
+    git_repo.join('pkg', 'modified.py').write('b = 2\n')
+    git_repo.join('pkg', 'deleted.py').write('c = 3\n')
+    git_repo.join('README').write('not python')
+    git('add', '.')
+    git('commit', '-q', '-m', 'initial')
+    git('checkout', '-q', '-b', 'feature')
+    git_repo.join('pkg', 'branch.py').write('d  =  4\n')
+    git('add', '.')
+    git('commit', '-q', '-m', 'branch')
+    git_repo.join('pkg', 'modified.py').write('b  =  2\n')
+    git_repo.join('pkg', 'untracked.py').write('e  =  5\n')
+    git_repo.join('pkg', 'deleted.py').remove()
+
+    def would_reformat(*args):
+        result = runner.invoke(args=['--check', str(git_repo)] + list(args))
+        return sorted(
+            line.split('Would reformat: ')[1].replace(os.sep, '/').split('/pkg/')[-1]
+            for line in result.output.splitlines() if 'Would reformat' in line)
+
+    assert would_reformat('--git-changed') == ['modified.py', 'untracked.py']
+    assert would_reformat('--since', 'master') == ['branch.py', 'modified.py', 'untracked.py']
+    assert would_reformat('--git-tracked') == ['branch.py', 'committed.py', 'modified.py']
+
+    # The sources restrict the files listed by git.
+    result = runner.invoke(args=[str(git_repo.join('pkg', 'modified.py')), '--git-changed'])
+    check_result(result, output='1 of 1 files changed.')
+    assert git_repo.join('pkg', 'modified.py').read() == 'b = 2\n'
+
+    result = runner.invoke(args=[str(git_repo), '--git-changed', '--staged'])
+    check_result(result, exit_code=2)
+
+
+def test_command_line_git_staged(git_repo, runner, tmpdir):
+    git = git_repo.git
+    git_repo.join('staged.py').write('a = 1\n')
+    git_repo.join('unstaged.py').write('b  =  2\n')
+    git('add', 'staged.py')
+    env = {'PYDEVF_CACHE': '1', 'PYDEVF_CACHE_DIR': str(tmpdir.join('cache'))}
+
+    result = runner.invoke(args=[str(git_repo), '--staged', '-v'], env=env)
+    check_result(result, output='0 of 1 files changed.')
+    assert 'staged.py' in result.output
+    assert 'unstaged.py' not in result.output
+
+    # Now the blob of the staged file is known to be formatted (it's not even read).
+    result = runner.invoke(args=[str(git_repo), '--staged', '-v'], env=env)
+    check_result(result, output='Skipped 1 files already formatted')
+    assert 'Formatted file' not in result.output
+
+    from pydevf import _git
+    from pydevf._cache import compute_content_hash
+    assert _git.list_staged_files(str(git_repo)) == [
+        ('staged.py', compute_content_hash(b'a = 1\n'))]
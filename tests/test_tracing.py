@@ -0,0 +1,72 @@
+from __future__ import unicode_literals
+
+import json
+
+import pytest
+
+
+@pytest.fixture
+def tracing():
+    from pydevf import _tracing
+    was_enabled = _tracing.enabled
+    _tracing.clear()
+    yield _tracing
+    _tracing.clear()
+    if was_enabled:
+        _tracing.enable()
+    else:
+        _tracing.disable()
+
+
+def test_tracing_disabled(tracing):
+    tracing.disable()
+    with tracing.request_context('r1'), tracing.span('read'):
+        pass
+    assert [event for event in tracing.get_events() if event['ph'] == 'X'] == []
+
+
+def test_tracing_spans(tracing):
+    tracing.enable()
+    tracing.set_process_name('test')
+    with tracing.request_context('r1'):
+        with tracing.span('client_request'):
+            with tracing.span('write', 10):
+                pass
+    with tracing.span('other'):
+        pass
+
+    events = json.loads(tracing.dumps())['traceEvents']
+    assert events[0] == {
+        'name': 'process_name', 'ph': 'M', 'pid': events[0]['pid'], 'args': {'name': 'test'}}
+    spans = dict((event['name'], event) for event in events[1:])
+    assert sorted(spans) == ['client_request', 'other', 'write']
+    assert spans['write']['args'] == {'request_id': 'r1', 'detail': 10}
+    assert spans['other']['args'] == {}
+    assert spans['write']['ph'] == 'X'
+    # The outer span contains the inner one.
+    assert spans['client_request']['ts'] <= spans['write']['ts']
+    assert spans['client_request']['dur'] >= spans['write']['dur']
+
+
+def test_tracing_ring_buffer(tracing):
+    tracing.enable(capacity=10)
+    try:
+        for i in range(25):
+            tracing.record('span', i, i + 1, detail=i)
+        details = [event['args']['detail'] for event in tracing.get_events()
+                   if event['ph'] == 'X']
+        assert details == list(range(15, 25))
+    finally:
+        tracing.enable(capacity=tracing.DEFAULT_CAPACITY)
+
+
+def test_tracing_dump(tracing, tmpdir):
+    tracing.enable()
+    with tracing.span('file_read'):
+        pass
+    path = str(tmpdir.join('trace.json'))
+    tracing.dump(path)
+    with open(path, 'rb') as stream:
+        contents = json.loads(stream.read().decode('utf-8'))
+    assert [event['name'] for event in contents['traceEvents']
+            if event['ph'] == 'X'] == ['file_read']